@@ -0,0 +1,157 @@
+"""
+Thin client for the refactoring server (see lib2to3.server).
+
+This takes most of the 2to3 options, but has a running server do the work,
+so it starts up quickly: it imports nothing else from lib2to3 but the
+tokenizer, to decode stdin.  Use it as
+
+    python -m lib2to3.client --socket SOCKET [options] file|dir|- ...
+"""
+
+import sys
+import os
+import json
+import socket
+import difflib
+import optparse
+import StringIO
+
+from .pgen2 import tokenize
+
+
+def request(socket_path, message):
+    """Send a request to the server on socket_path; return its response."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message) + "\n")
+        f = sock.makefile("rb")
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise IOError("no response from %s" % (socket_path,))
+    return json.loads(line)
+
+
+def log(msg):
+    print >> sys.stderr, "RefactoringTool: %s" % (msg,)
+
+
+def print_diff(diff):
+    try:
+        print diff
+    except UnicodeEncodeError:
+        print >> sys.stderr, ("WARNING: couldn't encode a diff for your "
+                              "terminal")
+
+
+def summarize(response):
+    were = "were" if response["wrote"] else "need to be"
+    changed = [filename for filename, diff in response["diffs"]]
+    if not changed:
+        log("No files %s modified." % (were,))
+    else:
+        log("Files that %s modified:" % (were,))
+        for filename in changed:
+            log(filename)
+    if response["messages"]:
+        log("Warnings/messages while refactoring:")
+        for message in response["messages"]:
+            log(message)
+    errors = response["errors"]
+    if errors:
+        if len(errors) == 1:
+            log("There was 1 error:")
+        else:
+            log("There were %d errors:" % (len(errors),))
+        for error in errors:
+            log(error)
+
+
+def main(args=None):
+    """Main program.
+
+    Returns a suggested exit status (0, 1, 2), like 2to3.
+    """
+    parser = optparse.OptionParser(usage="%prog --socket SOCKET [options] "
+                                   "file|dir ...")
+    parser.add_option("-s", "--socket", action="store",
+                      help="The socket the server listens on (required)")
+    parser.add_option("-d", "--doctests_only", action="store_true",
+                      help="Fix up doctests only")
+    parser.add_option("-f", "--fix", action="append", default=[],
+                      help="Each FIX specifies a transformation; default: all")
+    parser.add_option("-x", "--nofix", action="append", default=[],
+                      help="Prevent a fixer from being run.")
+    parser.add_option("-p", "--print-function", action="store_true",
+                      help="Modify the grammar so that print() is a function")
+    parser.add_option("--no-diffs", action="store_true",
+                      help="Don't show diffs of the refactoring")
+    parser.add_option("-w", "--write", action="store_true",
+                      help="Write back modified files")
+    parser.add_option("-n", "--nobackups", action="store_true", default=False,
+                      help="Don't write backups for modified files.")
+    options, args = parser.parse_args(args)
+    if not options.socket:
+        parser.error("--socket is required")
+    if not options.write and options.nobackups:
+        parser.error("Can't use -n without -w")
+    if not args:
+        print >> sys.stderr, ("At least one file or directory argument "
+                              "required.")
+        return 2
+    message = {"fix" : options.fix,
+               "nofix" : options.nofix,
+               "print_function" : bool(options.print_function),
+               "show_diffs" : not options.no_diffs}
+    if "-" in args:
+        if options.write:
+            print >> sys.stderr, "Can't write to stdin."
+            return 2
+        data = sys.stdin.read()
+        try:
+            # As 2to3 reads files, by the PEP 263 cookie or BOM.
+            encoding = tokenize.detect_encoding(
+                StringIO.StringIO(data).readline)[0]
+            source = data.decode(encoding)
+        except (SyntaxError, LookupError, UnicodeDecodeError), err:
+            print >> sys.stderr, "Can't decode stdin: %s" % (err,)
+            return 2
+        message.update(source=source, name="<stdin>")
+    else:
+        # The server doesn't share our working directory.
+        message.update(files=[os.path.abspath(arg) for arg in args],
+                       write=bool(options.write),
+                       nobackups=options.nobackups,
+                       doctests_only=bool(options.doctests_only))
+    try:
+        response = request(options.socket, message)
+    except (IOError, socket.error), err:
+        print >> sys.stderr, "Can't reach the server: %s" % (err,)
+        return 2
+    if "error" in response:
+        print >> sys.stderr, "The server failed: %s" % (response["error"],)
+        return 2
+    if "source" in message:
+        output = response["output"]
+        if output is not None and output != source:
+            response["diffs"] = [("<stdin>", None)]
+            log("Refactored <stdin>")
+            if not options.no_diffs:
+                print_diff(u"\n".join(difflib.unified_diff(
+                    source.splitlines(), output.splitlines(), "<stdin>",
+                    "<stdin>", "(original)", "(refactored)", lineterm="")))
+    else:
+        for filename, diff in response["diffs"]:
+            log("Refactored %s" % (filename,))
+            if diff is not None:
+                print_diff(diff)
+    summarize(response)
+    return int(bool(response["errors"]))
+
+if __name__ == "__main__":
+    sys.exit(main())
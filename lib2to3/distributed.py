@@ -0,0 +1,420 @@
+"""
+Refactoring distributed over TCP.
+
+A coordinator ("2to3 --coordinate HOST:PORT [options] file|dir ...") finds
+the files to refactor as 2to3 would, and hands them out in batches to the
+workers ("2to3 --worker HOST:PORT") that connect to it, a batch at a time
+as each asks for more.  So fast workers do more of the work, however
+uneven the files.  Workers needn't share a file system with the
+coordinator: it sends them the text of the files and gets the new text
+back, and it prints the diffs and writes the files itself.  The batches of
+a worker that goes away are handed out again.
+
+Workers send requests, one JSON object per line, and get a JSON object on
+a line back:
+
+    {"command": "hello", "token": "..."}
+
+gets the fixer configuration, {"fixers": [...], "explicit": [...],
+"options": {...}}, if the token is the coordinator's (from --token or
+the LIB2TO3_TOKEN environment variable), and then
+
+    {"command": "next", "results": [...]}
+
+reports the results of the last batch and gets the next one, {"batch":
+[[id, text, filename, doctests_only], ...]}, or {"batch": null} once
+there are no more files.  A result is {"id": id, "output": new text or
+null, "messages": [...], "errors": [...], "time": seconds, "exception":
+traceback or null}, like a refactor.FileResult.  A connection that
+doesn't start with a hello with the right token gets {"error": "..."}
+and is closed.
+
+The protocol is not encrypted: the token, and the text of the files, go
+over the network as they are.  Only use it on networks you trust; the
+coordinator listens on localhost unless given another host.
+"""
+
+# Python imports
+import hmac
+import json
+import time
+import signal
+import socket
+import logging
+import threading
+import SocketServer
+from itertools import count
+
+# Local imports
+from . import refactor
+
+
+# The options workers need; the rest only matter to the coordinator.
+WORKER_OPTIONS = ("print_function", "lazy_fixers", "fixpoint", "time_limit",
+                  "lazy_parsing", "recover", "lines")
+
+
+# The environment variable that may hold the token, instead of --token.
+TOKEN_VARIABLE = "LIB2TO3_TOKEN"
+
+
+def parse_address(address):
+    """Turn "HOST:PORT" (or "PORT", for localhost) into a (host, port)
+    pair."""
+    host, sep, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValueError("bad address %r; expected [HOST:]PORT" % (address,))
+    return host or "localhost", int(port)
+
+
+def check_token(token, expected):
+    """Return whether token (from a hello) is the expected one, taking
+    as long whatever part of it is wrong."""
+    if not isinstance(token, basestring):
+        return False
+    return hmac.compare_digest(token.encode("utf-8"),
+                               expected.encode("utf-8"))
+
+
+class Coordinator(SocketServer.ThreadingTCPServer):
+
+    """Hands out the files of refactor() calls to workers over TCP.
+
+    The tool (a MultiprocessRefactoringTool) prints, writes and records
+    the results, as it would for files it refactored itself.  Only the
+    workers that say hello with token are served.  Use it as
+
+        with Coordinator(("localhost", 8765), tool, token) as coordinator:
+            coordinator.refactor(items, write)
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    CLOSE_TIMEOUT = 5 # Seconds close() waits for workers to be told
+
+    def __init__(self, address, tool, token, num_workers=1):
+        if not token:
+            raise ValueError("the coordinator needs a token")
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 _CoordinatorHandler)
+        self.tool = tool
+        self.token = token
+        self.num_workers = num_workers # Expected, to size the batches
+        self.condition = threading.Condition()
+        self.batches = None # The schedule of the running refactor()
+        self.exhausted = False # Whether all of batches was handed out
+        self.requeued = [] # Tasks of workers that went away
+        self.running = {} # Task id -> (task, encoding, text for doctests)
+        self.finished = True
+        self.failure = None
+        self.closed = False
+        self.connections = 0
+        self.logger = logging.getLogger("Coordinator")
+        self._ids = count()
+        self._thread = None
+
+    def start(self):
+        """Start accepting workers in a thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop accepting workers; those connected are told to stop."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            deadline = time.time() + self.CLOSE_TIMEOUT
+            while self.connections and time.time() < deadline:
+                self.condition.wait(0.1)
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_config(self):
+        """Return the fixer configuration for workers."""
+        options = dict((name, self.tool.options.get(name))
+                       for name in WORKER_OPTIONS)
+        return {"fixers" : self.tool.fixers,
+                "explicit" : self.tool.explicit,
+                "options" : options}
+
+    def refactor(self, items, write=False, doctests_only=False, shard=None):
+        """Refactor files and directories, as the tool's refactor() would,
+        with the workers that connect."""
+        tool = self.tool
+        tool.load_timings()
+        tasks = tool.collect_tasks(items, write, doctests_only, shard)
+        if not tasks:
+            return
+        with self.condition:
+            self.batches = tool.schedule(tasks, self.num_workers)
+            self.exhausted = False
+            self.finished = False
+            self.condition.notify_all()
+            while not self.finished:
+                # With a time-out, so that KeyboardInterrupt gets through.
+                self.condition.wait(1.0)
+            self.batches = None
+            failure, self.failure = self.failure, None
+        if failure is not None:
+            raise failure
+        tool.save_timings()
+
+    def next_batch(self, held):
+        """Return the next batch for a worker, or None once the coordinator
+        is closed.  The ids of its tasks are added to held.
+
+        Workers wait here while there is nothing to hand out, in case
+        another worker goes away or there is another refactor() call.
+        """
+        with self.condition:
+            while not self.closed:
+                if not self.finished:
+                    batch = []
+                    while not batch:
+                        tasks = self._take_tasks()
+                        if not tasks:
+                            break
+                        batch = [self._prepare(task, held) for task in tasks]
+                        batch = [message for message in batch
+                                 if message is not None]
+                    if batch:
+                        return batch
+                    self._check_finished()
+                self.condition.wait(1.0)
+            return None
+
+    def _take_tasks(self):
+        if self.requeued:
+            tasks = self.requeued[:self.tool.BATCH_SIZE]
+            del self.requeued[:self.tool.BATCH_SIZE]
+            return tasks
+        if self.exhausted:
+            return []
+        tasks = next(self.batches, None)
+        if tasks is None:
+            self.exhausted = True
+            return []
+        return tasks
+
+    def _prepare(self, task, held):
+        # Read a file as refactor_file() does, for a worker's batch.
+        args, kwargs = task
+        filename, write, doctests_only = refactor._file_task(*args, **kwargs)
+        input, encoding = self.tool._read_python_source(filename)
+        if input is None:
+            self.tool.flush_summary()
+            return None
+        if not self.tool.could_match(input):
+            self.tool.log_debug("No fixer triggers in %s", filename)
+            return None
+        input += u"\n" # Silence certain parse errors
+        task_id = next(self._ids)
+        # Only doctests need the old text kept for processed_file().
+        self.running[task_id] = (task, encoding,
+                                 input if doctests_only else None)
+        held.add(task_id)
+        return [task_id, input, filename, doctests_only]
+
+    def handle_results(self, held, results):
+        """Merge a worker's results into the tool."""
+        with self.condition:
+            for result in results:
+                task_id = result["id"]
+                if task_id not in self.running:
+                    continue
+                task, encoding, old_text = self.running.pop(task_id)
+                held.discard(task_id)
+                args, kwargs = task
+                filename, write, doctests_only = refactor._file_task(
+                    *args, **kwargs)
+                output = result["output"]
+                if output is not None:
+                    output = (output, old_text, write, encoding)
+                errors = [("%s", (error,), {}) for error in result["errors"]]
+                file_result = refactor.FileResult(
+                    filename, output, result["messages"], errors,
+                    result["time"], result["exception"])
+                try:
+                    self.tool.handle_result(file_result)
+                except refactor.WorkerError, err:
+                    self.failure = err
+                    self.finished = True
+            self._check_finished()
+            self.condition.notify_all()
+
+    def lost_worker(self, held):
+        """Hand out the unfinished tasks of a worker that went away."""
+        if not held:
+            return
+        with self.condition:
+            self.logger.info("Lost a worker; handing out its %d files again",
+                             len(held))
+            for task_id in sorted(held):
+                task, encoding, old_text = self.running.pop(task_id)
+                self.requeued.append(task)
+            held.clear()
+            self.condition.notify_all()
+
+    def _check_finished(self):
+        if self.exhausted and not self.running and not self.requeued:
+            self.finished = True
+            self.condition.notify_all()
+
+
+class _CoordinatorHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        held = set()
+        authenticated = False
+        with server.condition:
+            server.connections += 1
+        try:
+            for line in iter(self.rfile.readline, ""):
+                try:
+                    message = json.loads(line)
+                    command = message.get("command")
+                except (ValueError, AttributeError), err:
+                    response = {"error" : "Bad request: %s" % (err,)}
+                else:
+                    if command == "hello":
+                        authenticated = check_token(message.get("token"),
+                                                    server.token)
+                        if authenticated:
+                            response = server.get_config()
+                        else:
+                            response = {"error" : "Bad token"}
+                    elif not authenticated:
+                        response = {"error" : "Say hello with the token "
+                                    "first"}
+                    elif command == "next":
+                        server.handle_results(held,
+                                              message.get("results", []))
+                        response = {"batch" : server.next_batch(held)}
+                    else:
+                        response = {"error" : "Unknown command %r" %
+                                    (command,)}
+                self.wfile.write(json.dumps(response) + "\n")
+                self.wfile.flush()
+                if (not authenticated or
+                        response.get("batch", True) is None):
+                    break
+        except socket.error, err:
+            server.logger.info("Lost the connection to a worker: %s", err)
+        finally:
+            server.lost_worker(held)
+            with server.condition:
+                server.connections -= 1
+                server.condition.notify_all()
+
+
+class WorkerRefactoringTool(refactor.MultiprocessRefactoringTool):
+    """
+    Records errors for the coordinator instead of raising them.
+    """
+
+    def log_error(self, msg, *args, **kwargs):
+        self.errors.append((msg, args, kwargs))
+        self.logger.error(msg, *args, **kwargs)
+
+
+class Worker(object):
+
+    """Refactors the batches of a Coordinator with the given token."""
+
+    def __init__(self, address, token):
+        self.address = address
+        self.token = token
+        self.logger = logging.getLogger("Worker")
+        self.tool = None
+        self._socket = None
+        self._rfile = None
+        self._wfile = None
+
+    def request(self, message):
+        self._wfile.write(json.dumps(message) + "\n")
+        self._wfile.flush()
+        line = self._rfile.readline()
+        if not line:
+            raise IOError("the coordinator closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise IOError("the coordinator failed: %s" % (response["error"],))
+        return response
+
+    def run(self):
+        """Refactor batches until the coordinator has no more.
+
+        Returns the number of files refactored.
+        """
+        self._socket = socket.create_connection(self.address)
+        try:
+            self._rfile = self._socket.makefile("rb")
+            self._wfile = self._socket.makefile("wb")
+            config = self.request({"command" : "hello",
+                                   "token" : self.token})
+            self.tool = self._make_tool(config)
+            done = 0
+            results = []
+            while True:
+                response = self.request({"command" : "next",
+                                         "results" : results})
+                if response["batch"] is None:
+                    return done
+                results = [self.refactor(*task) for task in response["batch"]]
+                done += len(results)
+        finally:
+            self._socket.close()
+
+    def _make_tool(self, config):
+        options = config["options"]
+        if options.get("time_limit") is not None:
+            signal.signal(signal.SIGALRM, refactor._on_time_limit)
+        return WorkerRefactoringTool(
+            config["fixers"], options, config["explicit"])
+
+    def refactor(self, task_id, text, filename, doctests_only):
+        """Refactor one file of a batch; return its result message."""
+        tool = self.tool
+        result, timed_out = tool._run_task(
+            "refactor_text", (text, filename, doctests_only), {},
+            tool.options["time_limit"])
+        if timed_out:
+            # The fixers may have been left in any state.
+            self.tool = WorkerRefactoringTool(
+                tool.fixers, tool.options, tool.explicit)
+        return {"id" : task_id,
+                "output" : result.output,
+                "messages" : result.messages,
+                "errors" : [args[0] for msg, args, kwds in result.errors],
+                "time" : result.time,
+                "exception" : result.exception}
+
+
+def work(address, token):
+    """Run a Worker for the coordinator at address ((host, port)) with
+    token.
+
+    Returns a suggested exit status.
+    """
+    worker = Worker(address, token)
+    try:
+        done = worker.run()
+    except (IOError, socket.error, ValueError), err:
+        worker.logger.error("Can't work for %s:%d: %s", address[0],
+                            address[1], err)
+        return 2
+    worker.logger.info("Refactored %d files for %s:%d", done, address[0],
+                       address[1])
+    return 0
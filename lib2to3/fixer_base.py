@@ -12,6 +12,18 @@ from .patcomp import PatternCompiler
 from . import pygram
 from .fixer_util import does_tree_import
 
+
+class _FileLoggerAdapter(logging.LoggerAdapter):
+
+    """Prefixes the messages of a fixer's logger with the filename.
+
+    Unlike a logger per file, this is freed with the fixer's next file.
+    """
+
+    def process(self, msg, kwargs):
+        return "%s: %s" % (self.extra["filename"], msg), kwargs
+
+
 class BaseFix(object):
 
     """Optional base class for fixers.
@@ -33,6 +45,9 @@ class BaseFix(object):
     explicit = False # Is this ignored by refactor.py -f all?
     run_order = 5   # Fixers will be sorted by run order before execution
                     # Lower numbers will be run first.
+    triggers = None # Token values of which at least one must occur in the
+                    # source for the fixer to match; derived from PATTERN
+                    # if None (see refactor.get_fixer_triggers()).
     _accept_type = None # [Advanced and not public] This tells RefactoringTool
                         # which node type to accept when there's not a pattern.
 
@@ -66,7 +81,8 @@ class BaseFix(object):
         The main refactoring tool should call this.
         """
         self.filename = filename
-        self.logger = logging.getLogger(filename)
+        self.logger = _FileLoggerAdapter(logging.getLogger("RefactoringTool"),
+                                         {"filename" : filename})
 
     def match(self, node):
         """Returns match for a given parse tree node.
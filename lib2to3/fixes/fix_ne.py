@@ -13,6 +13,7 @@ class FixNe(fixer_base.BaseFix):
     # This is so simple that we don't need the pattern compiler.
 
     _accept_type = token.NOTEQUAL
+    triggers = [u"<>"]
 
     def match(self, node):
         # Override
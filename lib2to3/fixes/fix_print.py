@@ -32,6 +32,7 @@ class FixPrint(fixer_base.BaseFix):
               simple_stmt< any* bare='print' any* > | print_stmt
               """
     explicit = True # The user must ask for this fixers
+    triggers = [u"print"] # print_stmt has no literal in the pattern
 
     def transform(self, node, results):
         assert results
@@ -0,0 +1,337 @@
+"""Manifest of the fixers in this package.
+
+Generated by scripts/generate_manifest.py; do not edit.
+"""
+
+MANIFEST = {'fix_apply': {'explicit': False,
+               'heads': ['power'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'apply']},
+ 'fix_basestring': {'explicit': True,
+                    'heads': ['NAME'],
+                    'order': 'post',
+                    'run_order': 5,
+                    'triggers': [u'basestring']},
+ 'fix_buffer': {'explicit': True,
+                'heads': ['power'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'buffer']},
+ 'fix_callable': {'explicit': False,
+                  'heads': ['power'],
+                  'order': 'post',
+                  'run_order': 5,
+                  'triggers': [u'callable']},
+ 'fix_dict': {'explicit': False,
+              'heads': ['power'],
+              'order': 'post',
+              'run_order': 5,
+              'triggers': [u'items',
+                           u'iteritems',
+                           u'iterkeys',
+                           u'itervalues',
+                           u'keys',
+                           u'values',
+                           u'viewitems',
+                           u'viewkeys',
+                           u'viewvalues']},
+ 'fix_except': {'explicit': False,
+                'heads': ['try_stmt'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'try']},
+ 'fix_exec': {'explicit': False,
+              'heads': ['exec_stmt'],
+              'order': 'post',
+              'run_order': 5,
+              'triggers': [u'exec']},
+ 'fix_execfile': {'explicit': False,
+                  'heads': ['power'],
+                  'order': 'post',
+                  'run_order': 5,
+                  'triggers': [u'execfile']},
+ 'fix_exitfunc': {'explicit': False,
+                  'heads': ['expr_stmt', 'import_name'],
+                  'order': 'post',
+                  'run_order': 5,
+                  'triggers': [u'sys']},
+ 'fix_filter': {'explicit': False,
+                'heads': ['power'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'filter']},
+ 'fix_funcattrs': {'explicit': False,
+                   'heads': ['power'],
+                   'order': 'post',
+                   'run_order': 5,
+                   'triggers': [u'func_closure',
+                                u'func_code',
+                                u'func_defaults',
+                                u'func_dict',
+                                u'func_doc',
+                                u'func_globals',
+                                u'func_name']},
+ 'fix_future': {'explicit': True,
+                'heads': ['import_from'],
+                'order': 'post',
+                'run_order': 10,
+                'triggers': [u'__future__']},
+ 'fix_getcwdu': {'explicit': False,
+                 'heads': ['power'],
+                 'order': 'post',
+                 'run_order': 5,
+                 'triggers': [u'os']},
+ 'fix_has_key': {'explicit': False,
+                 'heads': ['not_test', 'power'],
+                 'order': 'post',
+                 'run_order': 5,
+                 'triggers': [u'has_key']},
+ 'fix_idioms': {'explicit': True,
+                'heads': None,
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'list', u'sort', u'type', u'while']},
+ 'fix_import': {'explicit': True,
+                'heads': ['import_from', 'import_name'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'from', u'import']},
+ 'fix_imports': {'explicit': True,
+                 'heads': ['import_from', 'import_name', 'power'],
+                 'order': 'post',
+                 'run_order': 6,
+                 'triggers': [u'BaseHTTPServer',
+                              u'CGIHTTPServer',
+                              u'ConfigParser',
+                              u'Cookie',
+                              u'Dialog',
+                              u'DocXMLRPCServer',
+                              u'FileDialog',
+                              u'HTMLParser',
+                              u'Queue',
+                              u'ScrolledText',
+                              u'SimpleDialog',
+                              u'SimpleHTTPServer',
+                              u'SimpleXMLRPCServer',
+                              u'SocketServer',
+                              u'StringIO',
+                              u'Tix',
+                              u'Tkconstants',
+                              u'Tkdnd',
+                              u'Tkinter',
+                              u'UserList',
+                              u'UserString',
+                              u'__builtin__',
+                              u'_winreg',
+                              u'cPickle',
+                              u'cStringIO',
+                              u'commands',
+                              u'cookielib',
+                              u'copy_reg',
+                              u'dbhash',
+                              u'dbm',
+                              u'dumbdbm',
+                              u'dummy_thread',
+                              u'gdbm',
+                              u'htmlentitydefs',
+                              u'httplib',
+                              u'markupbase',
+                              u'repr',
+                              u'robotparser',
+                              u'thread',
+                              u'tkColorChooser',
+                              u'tkCommonDialog',
+                              u'tkFileDialog',
+                              u'tkFont',
+                              u'tkMessageBox',
+                              u'tkSimpleDialog',
+                              u'ttk',
+                              u'urlparse',
+                              u'xmlrpclib']},
+ 'fix_imports2': {'explicit': True,
+                  'heads': ['import_from', 'import_name', 'power'],
+                  'order': 'post',
+                  'run_order': 7,
+                  'triggers': [u'anydbm', u'whichdb']},
+ 'fix_input': {'explicit': False,
+               'heads': ['power'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'input']},
+ 'fix_intern': {'explicit': False,
+                'heads': ['power'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'intern']},
+ 'fix_isinstance': {'explicit': False,
+                    'heads': ['power'],
+                    'order': 'post',
+                    'run_order': 6,
+                    'triggers': [u'isinstance']},
+ 'fix_itertools': {'explicit': True,
+                   'heads': ['power'],
+                   'order': 'post',
+                   'run_order': 6,
+                   'triggers': [u'ifilter',
+                                u'ifilterfalse',
+                                u'imap',
+                                u'itertools',
+                                u'izip']},
+ 'fix_itertools_imports': {'explicit': True,
+                           'heads': ['import_from'],
+                           'order': 'post',
+                           'run_order': 5,
+                           'triggers': [u'itertools']},
+ 'fix_long': {'explicit': True,
+              'heads': ['NAME'],
+              'order': 'post',
+              'run_order': 5,
+              'triggers': [u'long']},
+ 'fix_map': {'explicit': False,
+             'heads': ['power'],
+             'order': 'post',
+             'run_order': 5,
+             'triggers': [u'map']},
+ 'fix_metaclass': {'explicit': True,
+                   'heads': ['classdef'],
+                   'order': 'post',
+                   'run_order': 5,
+                   'triggers': None},
+ 'fix_methodattrs': {'explicit': True,
+                     'heads': ['power'],
+                     'order': 'post',
+                     'run_order': 5,
+                     'triggers': [u'im_class', u'im_func', u'im_self']},
+ 'fix_ne': {'explicit': False,
+            'heads': ['NOTEQUAL'],
+            'order': 'post',
+            'run_order': 5,
+            'triggers': [u'<>']},
+ 'fix_next': {'explicit': False,
+              'heads': ['classdef', 'global_stmt', 'power'],
+              'order': 'pre',
+              'run_order': 5,
+              'triggers': [u'next']},
+ 'fix_nonzero': {'explicit': True,
+                 'heads': ['classdef'],
+                 'order': 'post',
+                 'run_order': 5,
+                 'triggers': [u'__nonzero__']},
+ 'fix_numliterals': {'explicit': True,
+                     'heads': ['NUMBER'],
+                     'order': 'post',
+                     'run_order': 5,
+                     'triggers': None},
+ 'fix_operator': {'explicit': False,
+                  'heads': ['power'],
+                  'order': 'post',
+                  'run_order': 5,
+                  'triggers': [u'isCallable',
+                               u'operator',
+                               u'sequenceIncludes']},
+ 'fix_paren': {'explicit': False,
+               'heads': ['atom'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'for']},
+ 'fix_print': {'explicit': True,
+               'heads': ['print_stmt', 'simple_stmt'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'print']},
+ 'fix_raise': {'explicit': False,
+               'heads': ['raise_stmt'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'raise']},
+ 'fix_raw_input': {'explicit': False,
+                   'heads': ['power'],
+                   'order': 'post',
+                   'run_order': 5,
+                   'triggers': [u'raw_input']},
+ 'fix_reduce': {'explicit': True,
+                'heads': ['power'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'reduce']},
+ 'fix_renames': {'explicit': True,
+                 'heads': ['import_from', 'power'],
+                 'order': 'pre',
+                 'run_order': 5,
+                 'triggers': [u'sys']},
+ 'fix_repr': {'explicit': False,
+              'heads': ['atom'],
+              'order': 'post',
+              'run_order': 5,
+              'triggers': [u'`']},
+ 'fix_set_literal': {'explicit': True,
+                     'heads': ['power'],
+                     'order': 'post',
+                     'run_order': 5,
+                     'triggers': [u'set']},
+ 'fix_standarderror': {'explicit': False,
+                       'heads': ['NAME'],
+                       'order': 'post',
+                       'run_order': 5,
+                       'triggers': [u'StandardError']},
+ 'fix_sys_exc': {'explicit': False,
+                 'heads': ['power'],
+                 'order': 'post',
+                 'run_order': 5,
+                 'triggers': [u'sys']},
+ 'fix_throw': {'explicit': True,
+               'heads': ['power'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'throw']},
+ 'fix_tuple_params': {'explicit': False,
+                      'heads': ['funcdef', 'lambdef'],
+                      'order': 'post',
+                      'run_order': 5,
+                      'triggers': [u'def', u'lambda']},
+ 'fix_types': {'explicit': True,
+               'heads': ['power'],
+               'order': 'post',
+               'run_order': 5,
+               'triggers': [u'types']},
+ 'fix_unicode': {'explicit': True,
+                 'heads': ['NAME', 'STRING'],
+                 'order': 'post',
+                 'run_order': 5,
+                 'triggers': None},
+ 'fix_urllib': {'explicit': True,
+                'heads': ['import_from', 'import_name', 'power'],
+                'order': 'post',
+                'run_order': 6,
+                'triggers': [u'urllib', u'urllib2']},
+ 'fix_ws_comma': {'explicit': False,
+                  'heads': None,
+                  'order': 'post',
+                  'run_order': 5,
+                  'triggers': [u',']},
+ 'fix_ws_equal': {'explicit': False,
+                  'heads': None,
+                  'order': 'post',
+                  'run_order': 5,
+                  'triggers': [u'=']},
+ 'fix_ws_operator': {'explicit': False,
+                     'heads': None,
+                     'order': 'post',
+                     'run_order': 5,
+                     'triggers': [u'%', u'*', u'+', u'-', u'/']},
+ 'fix_xrange': {'explicit': False,
+                'heads': ['power'],
+                'order': 'post',
+                'run_order': 5,
+                'triggers': [u'range', u'xrange']},
+ 'fix_xreadlines': {'explicit': False,
+                    'heads': ['power'],
+                    'order': 'post',
+                    'run_order': 5,
+                    'triggers': [u'xreadlines']},
+ 'fix_zip': {'explicit': False,
+             'heads': ['power'],
+             'order': 'post',
+             'run_order': 5,
+             'triggers': [u'zip']}}
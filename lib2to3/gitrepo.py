@@ -0,0 +1,199 @@
+"""
+Refactoring with git.
+
+Walking a big tree to refactor the few files that were touched wastes
+nearly the whole run.  select_files() asks git instead for the Python
+files that changed since a commit, that are staged, or that are
+untracked, as "2to3 --git-changed REF", "--git-staged" and
+"--git-untracked" do.
+
+refactor_commit() refactors the files of a commit (or any tree-ish)
+straight from the repository, without a checkout, for "2to3 --git-tree
+TREE-ISH" to print one patch for the commit.
+"""
+
+# Python imports
+import os
+import subprocess
+import StringIO
+
+# Local imports
+from .pgen2 import tokenize
+
+
+class GitError(Exception):
+    """git could not be run, or failed."""
+
+
+def run_git(args, cwd=None):
+    """Run git with args in cwd; return its output."""
+    try:
+        p = subprocess.Popen(["git"] + list(args), cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, err:
+        raise GitError("can't run git: %s" % (err,))
+    out, err = p.communicate()
+    if p.returncode:
+        raise GitError("git %s failed in %s: %s" %
+                       (args[0], cwd or os.curdir, err.strip()))
+    return out
+
+
+def _is_python_file(name):
+    # As RefactoringTool.find_python_files() would find it.
+    parts = name.split("/")
+    return (not any(part.startswith(".") for part in parts) and
+            os.path.splitext(parts[-1])[1].endswith("py"))
+
+
+def select_files(paths, since=None, staged=False, untracked=False):
+    """Return the Python files under paths (files and directories in git
+    work trees) that git lists, sorted.
+
+    Those are the files changed in the work tree since the commit since,
+    if given; with staged, the files whose changes are staged; and with
+    untracked, the files git doesn't track (or ignore).  Deleted files
+    are left out, as are files in directories starting with ".", as in
+    RefactoringTool.find_python_files().  Paths that are files are kept
+    whatever their names, if git lists them.  Raises GitError if git
+    fails, e.g. because a path isn't in a work tree.
+    """
+    commands = []
+    if since is not None:
+        commands.append(["diff", "--name-only", "-z", "--relative",
+                         "--diff-filter=d", since, "--"])
+    if staged:
+        commands.append(["diff", "--name-only", "-z", "--relative",
+                         "--diff-filter=d", "--cached", "--"])
+    if untracked:
+        commands.append(["ls-files", "-z", "--others", "--exclude-standard",
+                         "--"])
+    selected = set()
+    for path in paths:
+        if os.path.isdir(path):
+            # Names are listed relative to cwd.
+            cwd, pathspec = path, "."
+        else:
+            cwd, pathspec = os.path.split(path)
+            cwd = cwd or os.curdir
+        for command in commands:
+            for name in run_git(command + [pathspec], cwd).split("\0"):
+                if not name:
+                    continue
+                if pathspec == ".":
+                    if not _is_python_file(name):
+                        continue
+                    filename = os.path.join(path, *name.split("/"))
+                else:
+                    filename = path
+                if os.path.isfile(filename):
+                    selected.add(filename)
+    return sorted(selected)
+
+
+def list_tree(tree_ish, paths=(), cwd=None):
+    """Return the Python files of tree_ish (in the repository of cwd) under
+    paths, all of them by default, as sorted (path, object name) pairs.
+
+    Paths are relative to cwd, as for git ls-tree; symbolic links and
+    submodules are left out.
+    """
+    out = run_git(["ls-tree", "-r", "-z", tree_ish, "--"] + list(paths), cwd)
+    files = []
+    for entry in out.split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        mode, type, name = info.split()
+        if type == "blob" and mode != "120000" and _is_python_file(path):
+            files.append((path, name))
+    files.sort()
+    return files
+
+
+class BlobReader(object):
+
+    """Reads objects from a repository through one "git cat-file --batch"
+    process.  Use it as
+
+        with BlobReader(cwd) as reader:
+            data = reader.read(name)
+    """
+
+    def __init__(self, cwd=None):
+        try:
+            self._process = subprocess.Popen(
+                ["git", "cat-file", "--batch"], cwd=cwd,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError, err:
+            raise GitError("can't run git: %s" % (err,))
+
+    def read(self, name):
+        """Return the contents of the object name."""
+        p = self._process
+        p.stdin.write(name + "\n")
+        p.stdin.flush()
+        header = p.stdout.readline().split()
+        if len(header) != 3:
+            raise GitError("can't read %s: %s" % (name, " ".join(header) or
+                                                  "git cat-file exited"))
+        size = int(header[2])
+        data = p.stdout.read(size)
+        p.stdout.read(1) # The newline after the contents
+        if len(data) != size:
+            raise GitError("can't read %s: git cat-file exited" % (name,))
+        return data
+
+    def close(self):
+        p = self._process
+        p.stdin.close()
+        p.stdout.close()
+        p.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def decode_source(data):
+    """Decode the bytes of a Python source file; return the text, with
+    CRLF newlines made LF as refactor_file() reads them, and its
+    encoding."""
+    encoding = tokenize.detect_encoding(StringIO.StringIO(data).readline)[0]
+    return data.decode(encoding).replace(u"\r\n", u"\n"), encoding
+
+
+def refactor_commit(tool, tree_ish, paths=(), doctests_only=False,
+                    cwd=None):
+    """Refactor the Python files of tree_ish under paths (see list_tree())
+    with tool, a RefactoringTool, as refactor_file() would.
+
+    Generates (path, old text, new text, encoding) for each file that
+    changes; nothing is written.  The old text is that of the file; the
+    new text has CRLF newlines if the file has any, as refactor_file()
+    would write it on Windows.
+    """
+    files = list_tree(tree_ish, paths, cwd)
+    with BlobReader(cwd) as reader:
+        for path, name in files:
+            data = reader.read(name)
+            try:
+                input, encoding = decode_source(data)
+            except (SyntaxError, UnicodeDecodeError, LookupError), err:
+                tool.log_error("Can't decode %s: %s", path, err)
+                continue
+            if not tool.could_match(input):
+                tool.log_debug("No fixer triggers in %s", path)
+                continue
+            output = tool.refactor_text(input + u"\n", path, doctests_only)
+            if output is None:
+                continue
+            if doctests_only:
+                # refactor_docstring() kept the newline we added.
+                output = output[:-1]
+            if "\r\n" in data:
+                input = data.decode(encoding)
+                output = output.replace(u"\n", u"\r\n")
+            yield path, input, output, encoding
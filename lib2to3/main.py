@@ -4,12 +4,14 @@ Main program for 2to3.
 
 import sys
 import os
+import re
+import json
 import difflib
 import logging
 import shutil
 import optparse
 
-from . import refactor
+from . import refactor, gitrepo
 
 
 def diff_texts(a, b, filename):
@@ -21,65 +23,250 @@ def diff_texts(a, b, filename):
                                 lineterm="")
 
 
+def _patch_lines(text):
+    # The lines of text with their ends, "\r\n" or "\n", for a patch.
+    lines = [line + u"\n" for line in text.split(u"\n")]
+    if lines[-1] == u"\n":
+        del lines[-1]
+    return lines
+
+
+_hunk_header = re.compile(r"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@$")
+
+
+def shift_hunks(diff_lines, old_offset, new_offset):
+    """Add offsets to the line numbers in the hunk headers of a diff."""
+    for line in diff_lines:
+        match = _hunk_header.match(line)
+        if match is not None:
+            old, old_len, new, new_len = match.groups()
+            line = "@@ -%d%s +%d%s @@" % (int(old) + old_offset,
+                                          old_len or "",
+                                          int(new) + new_offset,
+                                          new_len or "")
+        yield line
+
+
 class StdoutRefactoringTool(refactor.MultiprocessRefactoringTool):
     """
     Prints output to stdout.
     """
 
-    def __init__(self, fixers, options, explicit, nobackups, show_diffs):
+    def __init__(self, fixers, options, explicit, nobackups, show_diffs,
+                 report=None):
         self.nobackups = nobackups
         self.show_diffs = show_diffs
+        self.report = report # A file for the --report, see write_report()
         super(StdoutRefactoringTool, self).__init__(fixers, options, explicit)
 
     def log_error(self, msg, *args, **kwargs):
         self.errors.append((msg, args, kwargs))
         self.logger.error(msg, *args, **kwargs)
 
-    def write_file(self, new_text, filename, old_text, encoding):
-        if not self.nobackups:
-            # Make backup
-            backup = filename + ".bak"
-            if os.path.lexists(backup):
-                try:
-                    os.remove(backup)
-                except os.error, err:
-                    self.log_message("Can't remove backup %s", backup)
+    def make_backup(self, filename):
+        """Move filename to filename.bak; return the backup's name."""
+        backup = filename + ".bak"
+        if os.path.lexists(backup):
             try:
-                os.rename(filename, backup)
+                os.remove(backup)
             except os.error, err:
-                self.log_message("Can't rename %s to %s", filename, backup)
+                self.log_message("Can't remove backup %s", backup)
+        try:
+            os.rename(filename, backup)
+        except os.error, err:
+            self.log_message("Can't rename %s to %s", filename, backup)
+        return backup
+
+    def write_file(self, new_text, filename, old_text, encoding):
+        if not self.nobackups:
+            backup = self.make_backup(filename)
         # Actually write the new file
         write = super(StdoutRefactoringTool, self).write_file
         write(new_text, filename, old_text, encoding)
         if not self.nobackups:
             shutil.copymode(backup, filename)
 
+    def replace_file(self, temp, filename):
+        if not self.nobackups:
+            shutil.copymode(filename, temp)
+            self.make_backup(filename)
+        return super(StdoutRefactoringTool, self).replace_file(temp, filename)
+
     def print_output(self, old, new, filename, equal):
         if equal:
             self.log_message("No changes to %s", filename)
         else:
             self.log_message("Refactored %s", filename)
+            if self.report is not None:
+                diff = None
+                if self.show_diffs:
+                    diff = u"\n".join(diff_texts(old, new, filename))
+                self._report_entry("diff", filename, diff)
             if self.show_diffs:
                 diff_lines = diff_texts(old, new, filename)
                 try:
-                    if self.output_lock is not None:
-                        with self.output_lock:
-                            for line in diff_lines:
-                                print line
-                            sys.stdout.flush()
-                    else:
-                        for line in diff_lines:
-                            print line
+                    for line in diff_lines:
+                        print line
                 except UnicodeEncodeError:
                     warn("couldn't encode %s's diff for your terminal" %
                          (filename,))
                     return
 
+    def print_chunk_output(self, old_text, new_text, filename, old_lineno,
+                           new_lineno, first):
+        if first:
+            self.log_message("Refactored %s", filename)
+        if self.show_diffs:
+            diff_lines = list(diff_texts(old_text, new_text, filename))
+            if not first:
+                # Leave out the file header.
+                diff_lines = diff_lines[2:]
+            diff = u"\n".join(shift_hunks(diff_lines, old_lineno - 1,
+                                          new_lineno - 1))
+            if self.report is not None:
+                self._report_entry("diff", filename, diff)
+            try:
+                print diff
+                sys.stdout.flush()
+            except UnicodeEncodeError:
+                warn("couldn't encode %s's diff for your terminal" %
+                     (filename,))
+        elif self.report is not None and first:
+            self._report_entry("diff", filename, None)
+
+    def write_report(self):
+        """Finish the report with the summary of the run.
+
+        A report has one JSON list per line: ["diff", filename, diff] for
+        each file that changed (with a null diff if diffs aren't shown) as
+        it is refactored, then ["file", filename], ["message", message],
+        ["error", error] and finally ["wrote", wrote] for the summary.
+        merge_reports() combines the reports of several runs.
+        """
+        files, messages, errors = self.get_summary()
+        for filename in files:
+            self._report_entry("file", filename)
+        for message in messages:
+            self._report_entry("message", message)
+        for msg, args, kwds in errors:
+            self._report_entry("error", msg % args if args else msg)
+        self._report_entry("wrote", self.wrote)
+        self.report.flush()
+
+    def _report_entry(self, *entry):
+        self.report.write(json.dumps(entry) + "\n")
+
 
 def warn(msg):
     print >> sys.stderr, "WARNING: %s" % (msg,)
 
 
+def merge_reports(filenames, show_diffs=True):
+    """Print the diffs and the summary of the reports written by several
+    runs (with --report), as if they had been one run.
+
+    Returns a suggested exit status (0, 1, 2).
+    """
+    # Nothing gets refactored; this is for its logging and _summarize().
+    rt = refactor.RefactoringTool([])
+    files = []
+    messages = []
+    errors = []
+    name = None
+    for filename in filenames:
+        try:
+            f = open(filename, "rb")
+        except IOError, err:
+            print >> sys.stderr, "Can't open report %s: %s" % (filename, err)
+            return 2
+        with f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                    kind, values = entry[0], entry[1:]
+                except (ValueError, IndexError):
+                    print >> sys.stderr, "Bad report %s line %d" % (filename,
+                                                                    lineno)
+                    return 2
+                if kind == "diff":
+                    # Streamed files have a diff for each changed chunk.
+                    if values[0] != name:
+                        rt.log_message("Refactored %s", values[0])
+                    name, diff = values
+                    if show_diffs and diff is not None:
+                        try:
+                            print diff
+                        except UnicodeEncodeError:
+                            warn("couldn't encode %s's diff for your "
+                                 "terminal" % (name,))
+                elif kind == "file":
+                    files.append(values[0])
+                elif kind == "message":
+                    messages.append(values[0])
+                elif kind == "error":
+                    errors.append(("%s", (values[0],), {}))
+                elif kind == "wrote":
+                    rt.wrote = rt.wrote or values[0]
+    rt._summarize(files, messages, errors)
+    return int(bool(errors))
+
+
+def print_git_patch(rt, tree_ish, paths=(), doctests_only=False, cwd=None):
+    """Print the diffs of the files of tree_ish (in the git repository of
+    cwd) under paths that rt changes, as one patch.
+
+    Each diff has the lines of its file in its encoding and with its
+    newlines, so the patch applies with "git apply -p0" whatever the
+    terminal.  The rest of the patch is utf-8; a byte order mark is kept
+    only at the start of the lines of the file that start with one.
+    """
+    for path, old, new, encoding in gitrepo.refactor_commit(
+            rt, tree_ish, paths, doctests_only, cwd):
+        rt.files.append(path)
+        rt.log_message("Refactored %s", path)
+        diff = None
+        if rt.show_diffs:
+            diff = u"\n".join(diff_texts(old, new, path))
+            if encoding == "utf-8-sig":
+                old, new, encoding = u"\ufeff" + old, u"\ufeff" + new, "utf-8"
+            lines = difflib.unified_diff(_patch_lines(old), _patch_lines(new),
+                                         path, path, "(original)",
+                                         "(refactored)")
+            for i, line in enumerate(lines):
+                # The file names, then hunk headers and the file's lines.
+                if i < 2 or line.startswith(u"@@"):
+                    sys.stdout.write(line.encode("utf-8"))
+                else:
+                    sys.stdout.write(line.encode(encoding))
+            sys.stdout.flush()
+        if rt.report is not None:
+            rt._report_entry("diff", path, diff)
+        rt.flush_summary()
+
+
+def get_fixer_names(fixer_pkg, fix=(), nofix=()):
+    """Return the fixers to run for the -f/--fix and -x/--nofix options.
+
+    Returns (fixer_names, explicit), sorted lists of the full module names
+    of the fixers to run and of those that were asked for by name.
+    """
+    avail_fixes = set(refactor.get_fixers_from_package(fixer_pkg))
+    unwanted_fixes = set(fixer_pkg + ".fix_" + name for name in nofix)
+    explicit = set()
+    if fix:
+        all_present = False
+        for name in fix:
+            if name == "all":
+                all_present = True
+            else:
+                explicit.add(fixer_pkg + ".fix_" + name)
+        requested = avail_fixes.union(explicit) if all_present else explicit
+    else:
+        requested = avail_fixes.union(explicit)
+    fixer_names = requested.difference(unwanted_fixes)
+    return sorted(fixer_names), sorted(explicit)
+
+
 def main(fixer_pkg, args=None):
     """Main program.
 
@@ -98,12 +285,50 @@ def main(fixer_pkg, args=None):
                       help="Each FIX specifies a transformation; default: all")
     parser.add_option("-j", "--processes", action="store", default=1,
                       type="int", help="Run 2to3 concurrently")
+    parser.add_option("--timings-file", action="store", metavar="FILE",
+                      help="Keep per-file timings in FILE to schedule "
+                      "files across processes (see -j)")
+    parser.add_option("--time-limit", action="store", type="float",
+                      metavar="SECONDS",
+                      help="Give up on files that take longer than SECONDS "
+                      "to refactor (with -j)")
+    parser.add_option("--max-worker-tasks", action="store", type="int",
+                      metavar="N",
+                      help="Replace a worker process after N files (with -j)")
+    parser.add_option("--max-worker-memory", action="store", type="int",
+                      metavar="MB",
+                      help="Replace a worker process once it uses more than "
+                      "MB megabytes (with -j)")
+    parser.add_option("--stream-size", action="store", type="int",
+                      metavar="BYTES",
+                      help="Refactor files of at least BYTES bytes a few "
+                      "statements at a time, to bound memory use")
+    parser.add_option("--split-size", action="store", type="int",
+                      metavar="BYTES",
+                      help="Refactor files of at least BYTES bytes in parts "
+                      "across processes, where the fixers allow (with -j)")
     parser.add_option("-x", "--nofix", action="append", default=[],
                       help="Prevent a fixer from being run.")
     parser.add_option("-l", "--list-fixes", action="store_true",
                       help="List available transformations (fixes/fix_*.py)")
     parser.add_option("-p", "--print-function", action="store_true",
                       help="Modify the grammar so that print() is a function")
+    parser.set_defaults(fixpoint=False)
+    if fixer_pkg != "lib2to3.fixes":
+        # The 2to3 fixers don't leave their own output alone; see
+        # RefactoringTool.MAX_FIXPOINT_ROUNDS.
+        parser.add_option("--fixpoint", action="store_true",
+                          help="Run the fixers again over the code they "
+                          "changed until nothing changes")
+    parser.add_option("--lazy-parsing", action="store_true",
+                      help="Only parse the function and class bodies in "
+                      "which a fixer may match")
+    parser.add_option("--recover", action="store_true",
+                      help="Refactor the rest of a file with syntax errors, "
+                      "leaving the statements that have them as they are")
+    parser.add_option("--lines", action="store", metavar="RANGES",
+                      help="Only refactor the code on these lines of the "
+                      "files, e.g. 10-20,35")
     parser.add_option("-v", "--verbose", action="store_true",
                       help="More verbose logging")
     parser.add_option("--no-diffs", action="store_true",
@@ -112,22 +337,123 @@ def main(fixer_pkg, args=None):
                       help="Write back modified files")
     parser.add_option("-n", "--nobackups", action="store_true", default=False,
                       help="Don't write backups for modified files.")
+    parser.add_option("--shard", action="store", metavar="INDEX/COUNT",
+                      help="Only refactor shard INDEX (from 1) of COUNT of "
+                      "the files found, e.g. 2/8")
+    parser.add_option("--shard-by", action="store", default="hash",
+                      choices=refactor.Shard.METHODS,
+                      help="Assign files to shards by a hash of their path "
+                      "(the default) or so that shards hold about as many "
+                      "bytes")
+    parser.add_option("--git-changed", action="store", metavar="REF",
+                      help="Only refactor the files git says were changed "
+                      "since commit REF")
+    parser.add_option("--git-staged", action="store_true",
+                      help="Only refactor the files with changes staged in "
+                      "git (with the other --git options, those too)")
+    parser.add_option("--git-untracked", action="store_true",
+                      help="Only refactor the files git doesn't track (with "
+                      "the other --git options, those too)")
+    parser.add_option("--git-tree", action="store", metavar="TREE-ISH",
+                      help="Refactor the files of TREE-ISH (e.g. a commit) "
+                      "in the git repository instead, without a checkout; "
+                      "the arguments are paths in it, by default all")
+    parser.add_option("--cache-dir", action="store", metavar="DIR",
+                      help="Keep the results and parse trees for files in "
+                      "DIR, to skip the files that haven't changed on later "
+                      "runs, or at least their parsing")
+    parser.add_option("--report", action="store", metavar="FILE",
+                      help="Also write the diffs and summary to FILE, for "
+                      "--merge-reports")
+    parser.add_option("--merge-reports", action="store_true",
+                      help="Print the diffs and summary of the report files "
+                      "given as arguments as one run's")
+    parser.add_option("--coordinate", action="store", metavar="[HOST:]PORT",
+                      help="Hand out the files to workers (see --worker) "
+                      "that connect to HOST (by default localhost):PORT; "
+                      "-j is how many are expected.  Not encrypted; use on "
+                      "trusted networks only")
+    parser.add_option("--worker", action="store", metavar="[HOST:]PORT",
+                      help="Refactor files for the coordinator at HOST:PORT "
+                      "(see --coordinate)")
+    parser.add_option("--token", action="store",
+                      help="The secret workers need to give the coordinator "
+                      "(required for --coordinate and --worker; by default "
+                      "that of the LIB2TO3_TOKEN environment variable)")
+    parser.add_option("--serve", action="store", metavar="SOCKET",
+                      help="Serve refactoring requests on the Unix socket "
+                      "SOCKET; see lib2to3.client")
 
     # Parse command line arguments
     refactor_stdin = False
     flags = {}
     options, args = parser.parse_args(args)
-    if not options.write and options.no_diffs:
+    if not options.write and options.no_diffs and not options.merge_reports:
         warn("not writing files and not printing diffs; that's not very useful")
     if not options.write and options.nobackups:
         parser.error("Can't use -n without -w")
+    address = options.coordinate or options.worker
+    if address:
+        # The distributed module imports this one.
+        from . import distributed
+        try:
+            address = distributed.parse_address(address)
+        except ValueError, err:
+            parser.error(str(err))
+        token = options.token or os.environ.get(distributed.TOKEN_VARIABLE)
+        if not token:
+            parser.error("--coordinate and --worker need --token or %s" %
+                         (distributed.TOKEN_VARIABLE,))
+    lines = None
+    if options.lines:
+        try:
+            lines = refactor.LineRanges.parse(options.lines)
+        except ValueError, err:
+            parser.error(str(err))
+    shard = None
+    if options.shard:
+        try:
+            shard = refactor.Shard.parse(options.shard, options.shard_by)
+        except ValueError, err:
+            parser.error(str(err))
     if options.list_fixes:
         print "Available transformations for the -f/--fix option:"
         for fixname in refactor.get_all_fix_names(fixer_pkg):
             print fixname
         if not args:
             return 0
-    if not args:
+    if options.serve:
+        # The server imports this module.
+        from . import server
+        logging.basicConfig(format='%(name)s: %(message)s',
+                            level=logging.DEBUG if options.verbose else
+                            logging.INFO)
+        return server.serve(options.serve, fixer_pkg, options.processes)
+    if options.worker:
+        logging.basicConfig(format='%(name)s: %(message)s',
+                            level=logging.DEBUG if options.verbose else
+                            logging.INFO)
+        return distributed.work(address, token)
+    if options.merge_reports:
+        logging.basicConfig(format='%(name)s: %(message)s',
+                            level=logging.INFO)
+        if not args:
+            print >> sys.stderr, "At least one report argument required."
+            return 2
+        return merge_reports(args, not options.no_diffs)
+    use_git = (options.git_changed is not None or options.git_staged or
+               options.git_untracked)
+    if not args and use_git:
+        args = [os.curdir]
+    if options.git_tree:
+        if options.write:
+            print >> sys.stderr, "Can't write to a git tree."
+            return 2
+        if "-" in args or use_git or shard is not None or options.coordinate:
+            print >> sys.stderr, ("Can't use --git-tree with stdin, --shard, "
+                                  "--coordinate or the other --git options.")
+            return 2
+    elif not args:
         print >> sys.stderr, "At least one file or directory argument required."
         print >> sys.stderr, "Use --help to show usage."
         return 2
@@ -136,45 +462,102 @@ def main(fixer_pkg, args=None):
         if options.write:
             print >> sys.stderr, "Can't write to stdin."
             return 2
+        if shard is not None or options.coordinate:
+            print >> sys.stderr, "Can't share out stdin."
+            return 2
+        if use_git:
+            print >> sys.stderr, "Can't ask git about stdin."
+            return 2
+    if use_git:
+        try:
+            args = gitrepo.select_files(args, options.git_changed,
+                                        options.git_staged,
+                                        options.git_untracked)
+        except gitrepo.GitError, err:
+            print >> sys.stderr, "Can't select the files with git: %s" % (
+                err,)
+            return 2
     if options.print_function:
         flags["print_function"] = True
+    if options.fixpoint:
+        flags["fixpoint"] = True
+    if options.timings_file:
+        flags["timings_file"] = options.timings_file
+    if options.time_limit:
+        flags["time_limit"] = options.time_limit
+    if options.max_worker_tasks:
+        flags["max_worker_tasks"] = options.max_worker_tasks
+    if options.max_worker_memory:
+        flags["max_worker_memory"] = options.max_worker_memory
+    if options.split_size:
+        flags["split_size"] = options.split_size
+    if options.stream_size:
+        flags["stream_size"] = options.stream_size
+    if options.lazy_parsing:
+        flags["lazy_parsing"] = True
+    if options.recover:
+        flags["recover"] = True
+    if lines is not None:
+        flags["lines"] = lines
+    if options.cache_dir:
+        flags["cache_dir"] = options.cache_dir
+    # Keep memory use flat however many files there are.
+    flags["spool_summary"] = True
+    # Only import the fixers a file actually needs.
+    flags["lazy_fixers"] = True
 
     # Set up logging handler
     level = logging.DEBUG if options.verbose else logging.INFO
     logging.basicConfig(format='%(name)s: %(message)s', level=level)
 
     # Initialize the refactoring tool
-    avail_fixes = set(refactor.get_fixers_from_package(fixer_pkg))
-    unwanted_fixes = set(fixer_pkg + ".fix_" + fix for fix in options.nofix)
-    explicit = set()
-    if options.fix:
-        all_present = False
-        for fix in options.fix:
-            if fix == "all":
-                all_present = True
-            else:
-                explicit.add(fixer_pkg + ".fix_" + fix)
-        requested = avail_fixes.union(explicit) if all_present else explicit
-    else:
-        requested = avail_fixes.union(explicit)
-    fixer_names = requested.difference(unwanted_fixes)
-    rt = StdoutRefactoringTool(sorted(fixer_names), flags, sorted(explicit),
-                               options.nobackups, not options.no_diffs)
+    fixer_names, explicit = get_fixer_names(fixer_pkg, options.fix,
+                                            options.nofix)
+    report = None
+    if options.report:
+        try:
+            report = open(options.report, "wb")
+        except IOError, err:
+            print >> sys.stderr, "Can't write report %s: %s" % (
+                options.report, err)
+            return 2
+    rt = StdoutRefactoringTool(fixer_names, flags, explicit,
+                               options.nobackups, not options.no_diffs,
+                               report)
 
     # Refactor all files and directories passed as arguments
     if not rt.errors:
         if refactor_stdin:
             rt.refactor_stdin()
+        elif options.git_tree:
+            try:
+                print_git_patch(rt, options.git_tree, args,
+                                options.doctests_only)
+            except gitrepo.GitError, err:
+                print >> sys.stderr, "Can't read the git tree: %s" % (err,)
+                return 2
+        elif options.coordinate:
+            coordinator = distributed.Coordinator(address, rt, token,
+                                                  options.processes)
+            coordinator.logger.info("Waiting for workers on %s:%d",
+                                    *coordinator.server_address[:2])
+            with coordinator:
+                coordinator.refactor(args, options.write,
+                                     options.doctests_only, shard)
         else:
             try:
                 rt.refactor(args, options.write, options.doctests_only,
-                            options.processes)
+                            options.processes, shard)
             except refactor.MultiprocessingUnsupported:
                 assert options.processes > 1
                 print >> sys.stderr, "Sorry, -j isn't " \
                     "supported on this platform."
                 return 1
         rt.summarize()
+        if report is not None:
+            rt.write_report()
+    if report is not None:
+        report.close()
 
-    # Return error status (0 if rt.errors is zero)
-    return int(bool(rt.errors))
+    # Return error status (0 if there were no errors)
+    return int(rt.has_errors())
@@ -13,7 +13,7 @@ This provides a high-level interface to parse a file into a syntax tree.
 
 __author__ = "Guido van Rossum <guido@python.org>"
 
-__all__ = ["Driver", "load_grammar"]
+__all__ = ["Driver", "load_grammar", "detect_future_features"]
 
 # Python imports
 import codecs
@@ -34,34 +34,69 @@ class Driver(object):
         self.logger = logger
         self.convert = convert
 
-    def parse_tokens(self, tokens, debug=False):
-        """Parse a series of tokens and return the syntax tree."""
-        # XXX Move the prefix computation into a wrapper around tokenize.
+    def parse_tokens(self, tokens, debug=False, lazy=None, source=None):
+        """Parse a series of tokens and return the syntax tree.
+
+        If lazy is given, it is called with the text of each function and
+        class body, and the bodies for which it returns True are left
+        unparsed: the statements of each become a single UNPARSED token,
+        whose value is their text, for parse_body() to parse should they
+        be needed.  The names in them are still added to used_names.
+
+        If source, the text the tokens were made from, is given, syntax
+        errors don't end the parse.  Each top-level statement the parser
+        or the tokenizer gives up on becomes a single ERRORTOKEN, whose
+        value is the text from the start of the statement up to the start
+        of the next one (or, for the tokenizer, to the end of source), so
+        the tree still reproduces source exactly.  The errors are listed
+        in the parse_errors attribute of the tree.
+        """
+        return self._parse(_prefix_tokens(tokens), debug, lazy, source)
+
+    def _parse(self, tokens, debug=False, lazy=None, source=None):
         p = parse.Parser(self.grammar, self.convert)
         p.setup()
-        lineno = 1
-        column = 0
-        type = value = start = end = line_text = None
-        prefix = u""
-        for quintuple in tokens:
-            type, value, start, end, line_text = quintuple
-            if start != (lineno, column):
-                assert (lineno, column) <= start, ((lineno, column), start)
-                s_lineno, s_column = start
-                if lineno < s_lineno:
-                    prefix += "\n" * (s_lineno - lineno)
-                    lineno = s_lineno
-                    column = 0
-                if column < s_column:
-                    prefix += line_text[column:s_column]
-                    column = s_column
-            if type in (tokenize.COMMENT, tokenize.NL):
-                prefix += value
-                lineno, column = end
-                if value.endswith("\n"):
-                    lineno += 1
-                    column = 0
-                continue
+        statements = None
+        if source is not None:
+            tokens = statements = _Statements(p, tokens)
+        errors = []
+        while True:
+            try:
+                try:
+                    self._feed(p, tokens, debug, lazy)
+                    break
+                except parse.ParseError, err:
+                    if statements is None:
+                        raise
+                    region = statements.take_region()
+                    if region is None:
+                        raise
+                    errors.append(err)
+                    p.used_names.update(t[1] for t in region
+                                        if t[0] == token.NAME)
+                    text = region[0][1] + u"".join(t[2] + t[1]
+                                                   for t in region[1:])
+                    p.recover(token.ERRORTOKEN, text,
+                              (region[0][2], region[0][3]))
+            except (tokenize.TokenError, IndentationError), err:
+                if statements is None:
+                    raise
+                errors.append(err)
+                # The rest of source is all there is to go on.
+                prefix, start, text = statements.take_rest(source)
+                p.recover(token.ERRORTOKEN, text, (prefix, start))
+                p.addtoken(token.ENDMARKER, u"", (u"", start))
+                break
+        if source is not None:
+            p.rootnode.parse_errors = errors
+        return p.rootnode
+
+    def _feed(self, p, tokens, debug, lazy):
+        # Feed tokens to parser p until it is done.
+        if lazy is not None:
+            tokens = self._defer_bodies(p, tokens, lazy)
+        type = value = prefix = start = None
+        for type, value, prefix, start in tokens:
             if type == token.OP:
                 type = grammar.opmap[value]
             if debug:
@@ -71,16 +106,50 @@ class Driver(object):
                 if debug:
                     self.logger.debug("Stop.")
                 break
-            prefix = ""
-            lineno, column = end
-            if value.endswith("\n"):
-                lineno += 1
-                column = 0
         else:
             # We never broke out -- EOF is too soon (how can this happen???)
             raise parse.ParseError("incomplete input",
                                    type, value, (prefix, start))
-        return p.rootnode
+
+    def _defer_bodies(self, p, tokens, lazy):
+        """Pass tokens through to parser p, but for the bodies lazy picks.
+
+        Such a body is fed to the parser as a pass statement, which then
+        gives way to an UNPARSED token holding the body's text.
+        """
+        in_header = False # Whether we are in a def or class header
+        at_body = False # Whether a def or class header just ended
+        for quadruple in tokens:
+            type, value, prefix, start = quadruple
+            if type == token.INDENT and at_body:
+                yield quadruple
+                body = list(_take_suite(tokens))
+                dedent = body.pop()
+                text = u"".join(t[2] + t[1] for t in body)
+                if lazy(text):
+                    p.used_names.update(t[1] for t in body
+                                        if t[0] == token.NAME)
+                    body_start = body[0][3]
+                    yield token.NAME, u"pass", u"", body_start
+                    yield token.NEWLINE, u"\n", u"", body_start
+                    # The suite being parsed now ends with the pass
+                    # statement; swap in the body.
+                    leaf = self.convert(self.grammar,
+                                        (token.UNPARSED, text,
+                                         (u"", body_start), None))
+                    p.stack[-1][2][-1][-1] = leaf
+                else:
+                    for quadruple in self._defer_bodies(p, iter(body), lazy):
+                        yield quadruple
+                quadruple = dedent
+                type = token.DEDENT
+            at_body = False
+            if type == token.NAME and value in (u"def", u"class"):
+                in_header = True
+            elif type == token.NEWLINE:
+                at_body = in_header
+                in_header = False
+            yield quadruple
 
     def parse_stream_raw(self, stream, debug=False):
         """Parse a stream and return the syntax tree."""
@@ -99,10 +168,293 @@ class Driver(object):
         finally:
             stream.close()
 
-    def parse_string(self, text, debug=False):
-        """Parse a string and return the syntax tree."""
+    def parse_string(self, text, debug=False, recover=False):
+        """Parse a string and return the syntax tree.
+
+        With recover, syntax errors don't end the parse; see parse_tokens().
+        """
         tokens = tokenize.generate_tokens(generate_lines(text).next)
-        return self.parse_tokens(tokens, debug)
+        return self.parse_tokens(tokens, debug,
+                                 source=text if recover else None)
+
+    def parse_body(self, text, indent, lineno, debug=False, lazy=None,
+                   recover=False):
+        """Parse the text of an UNPARSED token left by parse_tokens().
+
+        The body starts on line lineno (the lineno of the token) and is
+        indented by indent (the value of the INDENT before the token).
+        Returns the syntax tree of its statements, as for a module; lazy
+        is as for parse_tokens(), and with recover, syntax errors don't
+        end the parse, as with its source.
+        """
+        lines = generate_lines(indent + text)
+        tokens = tokenize.generate_tokens(lines.next)
+        if lineno != 1:
+            tokens = _shift_tokens(tokens, lineno - 1)
+        # The statements start after the indentation, which isn't theirs.
+        tokens = _prefix_tokens(_dedent_tokens(tokens), (lineno, len(indent)))
+        return self._parse(tokens, debug, lazy, text if recover else None)
+
+    def parse_fragment(self, text, debug=False):
+        """Parse statements that may be indented as a whole.
+
+        This is like parse_string(), but text may be a piece of a suite,
+        e.g. the text of a statement inside a function body.  The
+        indentation of its first line becomes part of the prefix of the
+        first statement.
+        """
+        tokens = tokenize.generate_tokens(generate_lines(text).next)
+        return self.parse_tokens(_dedent_tokens(tokens), debug)
+
+
+# Keywords that go on with a statement at the start of a line.
+_clause_keywords = frozenset((u"else", u"elif", u"except", u"finally"))
+
+
+class _Statements(object):
+
+    """Passes the tokens on to parser p, keeping those of the top-level
+    statements it hasn't finished, so as to skip a statement the parser
+    gives up on."""
+
+    def __init__(self, p, tokens):
+        self.p = p
+        self.tokens = tokens
+        self.buffered = [] # The tokens of the unfinished statements
+        self.starts = [] # Where statements start in buffered
+        self.done = 0 # The statements the parser finished before buffered
+        self.offset = 0 # The length of the text before buffered
+        self.pending = [] # (token, starts a statement) pairs to pass again
+        self.depth = 0 # Of indentation
+        self.at_start = True # Whether a line starts with the next token
+        self.decorated = False # Whether the last line was a decorator
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.pending:
+            quadruple, start = self.pending.pop(0)
+        else:
+            quadruple = next(self.tokens)
+            start = self._starts_statement(quadruple)
+        if len(self.p.stack) == 1:
+            # The parser has finished all the statements so far.
+            self._flush(len(self.buffered), len(self.p.stack[0][2][-1]))
+            start = True
+        if start:
+            self.starts.append(len(self.buffered))
+        self.buffered.append(quadruple)
+        return quadruple
+
+    def _starts_statement(self, quadruple):
+        type, value = quadruple[:2]
+        if type == token.INDENT:
+            self.depth += 1
+            return False
+        if type == token.DEDENT:
+            self.depth -= 1
+            return False
+        start = False
+        if self.at_start and self.depth == 0:
+            start = not self.decorated and value not in _clause_keywords
+            self.decorated = value == u"@"
+        self.at_start = type == token.NEWLINE
+        return start or type == token.ENDMARKER
+
+    def _flush(self, index, done):
+        # Forget the tokens of buffered before index, which are of the
+        # statements the parser finished (done in all) or skipped.
+        self.offset += sum(len(t[2]) + len(t[1])
+                           for t in self.buffered[:index])
+        del self.buffered[:index]
+        self.starts = [i - index for i in self.starts if i >= index]
+        self.done = done
+
+    def _unfinished(self):
+        # Drop the statements the parser finished from buffered.
+        done = len(self.p.stack[0][2][-1])
+        finished = done - self.done
+        if finished < len(self.starts):
+            self._flush(self.starts[finished], done)
+        else:
+            self._flush(len(self.buffered), done)
+        return done
+
+    def take_region(self):
+        """Return the tokens of the statement the parser gave up on, up to
+        the start of the next statement, which is passed on next; or None
+        if the tokens end first."""
+        done = self._unfinished()
+        if len(self.starts) == 1:
+            for quadruple in self.tokens:
+                start = self._starts_statement(quadruple)
+                self.buffered.append(quadruple)
+                if start:
+                    break
+            else:
+                return None
+            self.starts.append(len(self.buffered) - 1)
+        end = self.starts[1]
+        region = self.buffered[:end]
+        self._flush(end, done + 1)
+        starts = set(self.starts)
+        self.pending = [(quadruple, i in starts)
+                        for i, quadruple in enumerate(self.buffered)]
+        del self.buffered[:]
+        self.starts = []
+        return region
+
+    def take_rest(self, source):
+        """Return (prefix, start, text) for the statement the parser was
+        in and the rest of source, which the tokenizer gave up on."""
+        self._unfinished()
+        text = source[self.offset:]
+        if self.buffered:
+            type, value, prefix, start = self.buffered[0]
+            return prefix, start, text[len(prefix):]
+        lineno = source.count(u"\n", 0, self.offset) + 1
+        column = self.offset - (source.rfind(u"\n", 0, self.offset) + 1)
+        return u"", (lineno, column), text
+
+
+def _prefix_tokens(tokens, start=(1, 0)):
+    """Turn tokenizer output into (type, value, prefix, start) tuples for
+    the parser, where prefix is the whitespace, comments and blank lines
+    before the token.  The tokens follow position start."""
+    lineno, column = start
+    prefix = u""
+    for quintuple in tokens:
+        type, value, start, end, line_text = quintuple
+        if start != (lineno, column):
+            assert (lineno, column) <= start, ((lineno, column), start)
+            s_lineno, s_column = start
+            if lineno < s_lineno:
+                prefix += "\n" * (s_lineno - lineno)
+                lineno = s_lineno
+                column = 0
+            if column < s_column:
+                prefix += line_text[column:s_column]
+                column = s_column
+        if type in (tokenize.COMMENT, tokenize.NL):
+            prefix += value
+            lineno, column = end
+            if value.endswith("\n"):
+                lineno += 1
+                column = 0
+            continue
+        yield type, value, prefix, start
+        prefix = ""
+        lineno, column = end
+        if value.endswith("\n"):
+            lineno += 1
+            column = 0
+
+
+def _take_suite(tokens):
+    """Yield the tokens of a suite, after its INDENT, up to and including
+    the matching DEDENT."""
+    depth = 0
+    for quadruple in tokens:
+        yield quadruple
+        type = quadruple[0]
+        if type == token.INDENT:
+            depth += 1
+        elif type == token.DEDENT:
+            if depth == 0:
+                return
+            depth -= 1
+
+
+def _shift_tokens(tokens, offset):
+    """Add offset to the line numbers of a token stream."""
+    for type, value, (line0, col0), (line1, col1), line_text in tokens:
+        yield type, value, (line0 + offset, col0), (line1 + offset, col1), \
+            line_text
+
+
+def _dedent_tokens(tokens):
+    """Drop the INDENT opening a token stream and its matching DEDENT."""
+    depth = None
+    for quintuple in tokens:
+        type = quintuple[0]
+        if depth is None:
+            if type in (tokenize.COMMENT, tokenize.NL):
+                yield quintuple
+                continue
+            depth = 0
+            if type == token.INDENT:
+                continue
+        elif type == token.INDENT:
+            depth += 1
+        elif type == token.DEDENT:
+            if depth == 0:
+                continue
+            depth -= 1
+        yield quintuple
+
+
+def detect_future_features(tokens):
+    """Scan the module header of a token stream for __future__ imports.
+
+    Only the tokens up to the first statement that can't be part of the
+    header are read.  Returns (features, tokens), where features is a
+    frozenset of feature names and tokens an iterator yielding the whole
+    original token stream, so the caller can pick a grammar before the
+    stream is fed to the parser without tokenizing anything twice.
+    """
+    tokens = iter(tokens)
+    buffered = []
+    def advance():
+        tok = next(tokens)
+        buffered.append(tok)
+        return tok[0], tok[1]
+    ignore = frozenset((token.NEWLINE, tokenize.NL, token.COMMENT))
+    have_docstring = False
+    features = set()
+    error = None
+    try:
+        while True:
+            tp, value = advance()
+            if tp in ignore:
+                continue
+            elif tp == token.STRING:
+                if have_docstring:
+                    break
+                have_docstring = True
+            elif tp == token.NAME and value == u"from":
+                tp, value = advance()
+                if tp != token.NAME or value != u"__future__":
+                    break
+                tp, value = advance()
+                if tp != token.NAME or value != u"import":
+                    break
+                tp, value = advance()
+                if tp == token.OP and value == u"(":
+                    tp, value = advance()
+                while tp == token.NAME:
+                    features.add(value)
+                    tp, value = advance()
+                    if tp != token.OP or value != u",":
+                        break
+                    tp, value = advance()
+            else:
+                break
+    except StopIteration:
+        pass
+    except tokenize.TokenError, err:
+        # Report it where the parser would have run into it.
+        error = err
+    return frozenset(features), _replay(buffered, tokens, error)
+
+
+def _replay(buffered, tokens, error):
+    for tok in buffered:
+        yield tok
+    if error is not None:
+        raise error
+    for tok in tokens:
+        yield tok
 
 
 def generate_lines(text):
@@ -48,9 +48,9 @@ class Parser(object):
     Parsing is complete when addtoken() returns True; the root of the
     abstract syntax tree can then be retrieved from the rootnode
     instance variable.  When a syntax error occurs, addtoken() raises
-    the ParseError exception.  There is no error recovery; the parser
-    cannot be used after a syntax error was reported (but it can be
-    reinitialized by calling setup()).
+    the ParseError exception.  The parser can then only be used again
+    after calling setup(), or, to skip the statement it was parsing,
+    recover().
 
     """
 
@@ -158,6 +158,20 @@ class Parser(object):
                     # No success finding a transition
                     raise ParseError("bad input", type, value, context)
 
+    def recover(self, type, value, context):
+        """Give up on the top-level statement being parsed.
+
+        This may be called after addtoken() raised ParseError.  The
+        statement is replaced by a token of the given type, whose value
+        should be the statement's text (see driver.py); parsing goes on
+        with the token that starts the next statement.
+        """
+        del self.stack[1:]
+        dfa, state, node = self.stack[0]
+        newnode = self.convert(self.grammar, (type, value, context, None))
+        if newnode is not None:
+            node[-1].append(newnode)
+
     def classify(self, type, value, context):
         """Turn a token into a label.  (Internal)"""
         if type == token.NAME:
@@ -62,7 +62,8 @@ COMMENT = 52
 NL = 53
 RARROW = 54
 ERRORTOKEN = 55
-N_TOKENS = 56
+UNPARSED = 56
+N_TOKENS = 57
 NT_OFFSET = 256
 #--end constants--
 
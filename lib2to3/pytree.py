@@ -13,7 +13,10 @@ There's also a pattern matching implementation here.
 __author__ = "Guido van Rossum <guido@python.org>"
 
 import sys
+import zlib
+import marshal
 import warnings
+from array import array
 from StringIO import StringIO
 
 
@@ -286,7 +289,7 @@ class Node(Base):
         """Return a pre-order iterator for the tree."""
         yield self
         for child in self.children:
-            for node in child.post_order():
+            for node in child.pre_order():
                 yield node
 
     @property
@@ -422,6 +425,104 @@ def convert(gr, raw_node):
         return Leaf(type, value, context=context)
 
 
+# The version of the format of dump_tree(), for load_tree() to check.
+_DUMP_FORMAT = 1
+
+# Root attributes dump_tree() keeps.
+_DUMPED_ATTRIBUTES = ("used_names", "future_features")
+
+
+def dump_tree(tree):
+    """
+    Serialize a tree, as returned by the parser, to a string for
+    load_tree().
+
+    The nodes are listed bottom-up as integers, a leaf as its type, the
+    indexes of its value and prefix in a table of strings, its line and
+    column, a node as its type and number of children, and the whole is
+    compressed.  The used_names and future_features attributes of the
+    root are kept too.
+    """
+    strings = []
+    indexes = {}
+    def index(string):
+        i = indexes.get(string)
+        if i is None:
+            i = indexes[string] = len(strings)
+            strings.append(string)
+        return i
+    codes = array("i")
+    stack = [(tree, False)]
+    while stack:
+        node, done = stack.pop()
+        if isinstance(node, Leaf):
+            codes.extend((node.type, index(node.value), index(node.prefix),
+                          node.lineno, node.column))
+        elif done:
+            codes.extend((node.type, len(node.children)))
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+    attributes = [getattr(tree, name, None) for name in _DUMPED_ATTRIBUTES]
+    # Level 1 takes it to not much more than the size of the source, and
+    # costs little to undo.
+    return zlib.compress(marshal.dumps((_DUMP_FORMAT, strings,
+                                        codes.tostring(), attributes)), 1)
+
+
+def load_tree(data):
+    """
+    Rebuild a tree from a string made by dump_tree().
+
+    Raises ValueError if data isn't such a string.
+    """
+    try:
+        fields = marshal.loads(zlib.decompress(data))
+        format, strings, code_string, attributes = fields
+        if format != _DUMP_FORMAT:
+            raise ValueError("dumped tree format %r, not %r" %
+                             (format, _DUMP_FORMAT))
+        codes = array("i")
+        codes.fromstring(code_string)
+    except (zlib.error, EOFError, TypeError):
+        raise ValueError("not a dumped tree")
+    # Making the nodes without their __init__()s is what makes this fast.
+    new = object.__new__
+    stack = []
+    i = 0
+    try:
+        while i < len(codes):
+            type = codes[i]
+            if type < 256:
+                leaf = new(Leaf)
+                leaf.type = type
+                leaf.value = strings[codes[i+1]]
+                leaf._prefix = strings[codes[i+2]]
+                leaf.lineno = codes[i+3]
+                leaf.column = codes[i+4]
+                stack.append(leaf)
+                i += 5
+            else:
+                count = codes[i+1]
+                if count > len(stack):
+                    raise ValueError("bad dumped tree")
+                node = new(Node)
+                node.type = type
+                node.children = children = stack[len(stack)-count:]
+                del stack[len(stack)-count:]
+                for child in children:
+                    child.parent = node
+                stack.append(node)
+                i += 2
+        tree, = stack
+    except (IndexError, ValueError):
+        raise ValueError("bad dumped tree")
+    for name, value in zip(_DUMPED_ATTRIBUTES, attributes):
+        if value is not None:
+            setattr(tree, name, value)
+    return tree
+
+
 class BasePattern(object):
 
     """
@@ -13,16 +13,29 @@ __author__ = "Guido van Rossum <guido@python.org>"
 
 # Python imports
 import os
+import re
 import sys
+import json
+import time
+import types
+import heapq
+import Queue
+import shutil
+import hashlib
 import logging
 import operator
+import signal
+import cPickle
+import pkgutil
+import tempfile
+import traceback
 import collections
-import StringIO
-from itertools import chain
+from bisect import bisect_right
+from itertools import chain, count
 
 # Local imports
-from .pgen2 import driver, tokenize, token
-from . import pytree, pygram
+from .pgen2 import driver, parse, tokenize, token
+from . import pytree, pygram, fixer_base, fixer_util
 
 
 def get_all_fix_names(fixer_pkg, remove_prefix=True):
@@ -95,6 +108,158 @@ def _get_headnode_dict(fixer_list):
     return dict(head_nodes)
 
 
+def _get_triggers(pat):
+    """ Accepts a pytree Pattern and returns a frozenset of token values
+        one of which must occur in any node sequence the pattern matches,
+        or None if no such set can be derived. """
+
+    if isinstance(pat, pytree.LeafPattern):
+        if pat.content is None:
+            return None
+        return frozenset([pat.content])
+
+    if isinstance(pat, pytree.NodePattern):
+        if pat.content is None:
+            return None
+        return _get_sequence_triggers(pat.content)
+
+    if isinstance(pat, pytree.WildcardPattern):
+        # bare_name wildcards may match nothing at all (see pytree).
+        if pat.content is None or pat.min == 0 or pat.name == "bare_name":
+            return None
+        r = set()
+        for alt in pat.content:
+            triggers = _get_sequence_triggers(alt)
+            if triggers is None:
+                return None
+            r.update(triggers)
+        return frozenset(r)
+
+    # Negated patterns never require anything.
+    return None
+
+
+def _is_common_trigger(value):
+    """Keywords and operators occur in nearly every file."""
+    return value in pygram.python_grammar.keywords or not _is_name(value)
+
+
+def _get_sequence_triggers(patterns):
+    """Return the most selective triggers of a sequence of patterns, all of
+    which must match."""
+    best = None
+    best_key = None
+    for pat in patterns:
+        triggers = _get_triggers(pat)
+        if triggers is None:
+            continue
+        key = (any(_is_common_trigger(t) for t in triggers), len(triggers))
+        if best is None or key < best_key:
+            best, best_key = triggers, key
+    return best
+
+
+def get_fixer_triggers(fixer):
+    """Return the trigger values of a fixer instance, or None if it may
+    match anywhere."""
+    if fixer.triggers is not None:
+        return frozenset(fixer.triggers)
+    if fixer.pattern is not None:
+        return _get_triggers(fixer.pattern)
+    return None
+
+
+def _is_name(value):
+    return value[:1].isalpha() or value[:1] == u"_"
+
+
+def _compile_trigger_scanner(triggers):
+    """Return a regex whose findall() lists the identifiers in a source plus
+    the occurrences of the non-identifier triggers, in one pass."""
+    others = sorted((t for t in triggers if not _is_name(t)),
+                    key=lambda t: (-len(t), t))
+    alternatives = [ur"[^\W\d]\w*"] + [re.escape(t) for t in others]
+    return re.compile(u"|".join(alternatives), re.UNICODE)
+
+
+def _get_head_names(fixer):
+    """Return the sorted names of the node types a fixer matches first, or
+    None if it is offered every node."""
+    if fixer.pattern:
+        try:
+            heads = _get_head_types(fixer.pattern)
+        except _EveryNode:
+            return None
+    elif fixer._accept_type is not None:
+        heads = [fixer._accept_type]
+    else:
+        return None
+    grammar = pygram.python_grammar
+    return sorted(grammar.number2symbol.get(t) or token.tok_name[t]
+                  for t in heads)
+
+
+def _get_fixer_class(fix_mod_path, class_prefix="Fix", file_prefix="fix_"):
+    mod = __import__(fix_mod_path, {}, {}, ["*"])
+    fix_name = fix_mod_path.rsplit(".", 1)[-1]
+    if fix_name.startswith(file_prefix):
+        fix_name = fix_name[len(file_prefix):]
+    parts = fix_name.split("_")
+    class_name = class_prefix + "".join([p.title() for p in parts])
+    try:
+        return fix_name, getattr(mod, class_name)
+    except AttributeError:
+        raise FixerError("Can't find %s.%s" % (fix_name, class_name))
+
+
+def build_fixer_manifest(pkg_name, options=None):
+    """Import every fixer in pkg_name and describe it.
+
+    Returns a dict mapping each fixer module name (e.g. "fix_has_key") to a
+    dict with its "order", "run_order", "explicit" flag, "heads" (node type
+    names, None for every node) and "triggers" (sorted token values, None if
+    the fixer may match anywhere).
+    """
+    opts = RefactoringTool._default_options.copy()
+    if options is not None:
+        opts.update(options)
+    manifest = {}
+    for mod_name in get_all_fix_names(pkg_name, False):
+        fix_name, fix_class = _get_fixer_class(pkg_name + "." + mod_name)
+        fixer = fix_class(opts, [])
+        triggers = get_fixer_triggers(fixer)
+        if triggers is not None:
+            triggers = sorted(triggers)
+        manifest[mod_name] = {"order": fixer.order,
+                              "run_order": fixer.run_order,
+                              "explicit": bool(fixer.explicit),
+                              "heads": _get_head_names(fixer),
+                              "triggers": triggers}
+    return manifest
+
+
+_manifests = {}
+
+def get_fixer_manifest(pkg_name):
+    """Return the declared manifest of a fixer package without importing any
+    fixers, or an empty dict if the package has no "manifest" module.
+
+    See build_fixer_manifest() for the format.
+    """
+    try:
+        return _manifests[pkg_name]
+    except KeyError:
+        pass
+    try:
+        mod = __import__(pkg_name + ".manifest", {}, {}, ["MANIFEST"])
+    except ImportError:
+        manifest = {}
+    else:
+        manifest = mod.MANIFEST
+    _manifests[pkg_name] = manifest
+    return manifest
+
+
 def get_fixers_from_package(pkg_name):
     """
     Return the fully qualified names for fixers in the package pkg_name.
@@ -123,52 +288,457 @@ else:
 
 
 def _detect_future_features(source):
-    have_docstring = False
-    gen = tokenize.generate_tokens(StringIO.StringIO(source).readline)
-    def advance():
-        tok = next(gen)
-        return tok[0], tok[1]
-    ignore = frozenset((token.NEWLINE, tokenize.NL, token.COMMENT))
-    features = set()
-    try:
-        while True:
-            tp, value = advance()
-            if tp in ignore:
+    tokens = tokenize.generate_tokens(driver.generate_lines(source).next)
+    return driver.detect_future_features(tokens)[0]
+
+
+# Keywords that continue a compound statement at the same indentation.
+_CLAUSE_KEYWORDS = frozenset([u"else", u"elif", u"except", u"finally"])
+
+
+def _iter_chunks(lines, chunk_size, recover=False):
+    """Generate the chunks of whole top-level statements of a module, of
+    at least chunk_size characters where there is a choice.
+
+    lines is an iterable of the lines of the module, which is read as the
+    chunks are needed; memory use depends on the size of the chunks, not
+    that of the module.  This is a single pass of the tokenizer, which
+    keeps track of brackets and indentation; nothing is parsed.  Generates
+    (lineno, text) pairs, lineno being the first line of a chunk.  Raises
+    tokenize.TokenError or IndentationError if the module can't be
+    tokenized, unless recover is set: the rest of the module is then the
+    last chunk.
+
+    The module header (its docstring and __future__ imports, or so it
+    seems from the first token of each statement) is kept in the first
+    chunk, so that the features it imports can be found there.
+    """
+    lines = iter(lines)
+    buffered = [] # The lines from line first on
+    def readline():
+        line = next(lines, u"")
+        if line:
+            buffered.append(line)
+        return line
+    first = 0
+    counted = 0 # The buffered lines whose size is in head_size
+    head_size = 0
+    indents = 0
+    last_newline = 0
+    new_statement = True
+    decorator = False
+    header = True
+    tokens = tokenize.generate_tokens(readline)
+    while True:
+        try:
+            type, value, start, end, line_text = next(tokens)
+        except (tokenize.TokenError, IndentationError):
+            if not recover:
+                raise
+            buffered.extend(lines)
+            break
+        if type == token.INDENT:
+            indents += 1
+        elif type == token.DEDENT:
+            indents -= 1
+        elif type == token.NEWLINE:
+            last_newline = end[0]
+            new_statement = True
+        elif type == token.ENDMARKER:
+            break
+        elif type not in (tokenize.COMMENT, tokenize.NL) and new_statement:
+            new_statement = False
+            if indents:
                 continue
-            elif tp == token.STRING:
-                if have_docstring:
-                    break
-                have_docstring = True
-            elif tp == token.NAME and value == u"from":
-                tp, value = advance()
-                if tp != token.NAME or value != u"__future__":
-                    break
-                tp, value = advance()
-                if tp != token.NAME or value != u"import":
+            if header:
+                if type == token.STRING or value == u"from":
+                    continue
+                header = False
+            # Comments before a statement go with it.
+            if (last_newline > first and not decorator and
+                    value not in _CLAUSE_KEYWORDS):
+                end_index = last_newline - first
+                head_size += sum(len(line)
+                                 for line in buffered[counted:end_index])
+                counted = end_index
+                if head_size >= chunk_size:
+                    yield first + 1, u"".join(buffered[:end_index])
+                    del buffered[:end_index]
+                    first = last_newline
+                    counted = head_size = 0
+            decorator = value == u"@"
+    if buffered:
+        yield first + 1, u"".join(buffered)
+
+
+def _split_module(source, chunk_size):
+    """Split the source of a module into chunks, as _iter_chunks() does.
+
+    Returns a list of (lineno, text) pairs, or None if the source can't be
+    tokenized.
+    """
+    try:
+        return list(_iter_chunks(source.splitlines(True), chunk_size))
+    except (tokenize.TokenError, IndentationError):
+        return None
+
+
+# fixer_util functions that look beyond the node they are given.
+_WHOLE_TREE_HELPERS = ("touch_import", "find_binding", "does_tree_import",
+                       "find_root")
+
+
+def needs_whole_tree(fixer):
+    """Return whether fixer may depend on or change parts of the tree other
+    than the nodes it matches, so that it must see a whole module.
+
+    That is the case for fixers that override start_tree() or
+    finish_tree(), and for those in modules that use the fixer_util
+    functions that look up or add imports.
+    """
+    cls = type(fixer)
+    if (cls.start_tree.im_func is not fixer_base.BaseFix.start_tree.im_func or
+            cls.finish_tree.im_func is not
+            fixer_base.BaseFix.finish_tree.im_func):
+        return True
+    module = sys.modules.get(cls.__module__)
+    for name in _WHOLE_TREE_HELPERS:
+        if getattr(module, name, None) is getattr(fixer_util, name):
+            return True
+    return False
+
+
+class _ChangedRegions(object):
+
+    """Groups the changed chunks of a streamed file into regions for
+    print_chunk_output(), as they come.
+
+    A region gets CONTEXT unchanged lines on either side, from the chunks
+    around it, so that its diff has the context a diff of the whole file
+    would have.  A region ends once more than twice CONTEXT unchanged
+    lines follow it, as a hunk of difflib.unified_diff() would, so the
+    diffs of regions never overlap and only the unchanged lines between
+    changes are held on to.
+    """
+
+    CONTEXT = 3 # As for difflib.unified_diff()
+
+    def __init__(self, report):
+        self.report = report
+        self.before = [] # The unchanged lines before the region
+        self.old = [] # The chunks of the region
+        self.new = []
+        self.after = [] # The unchanged lines since its last change
+        self.start = None # The lines it starts on, with self.before
+        self.first = True
+
+    def add(self, old, new, old_lineno, new_lineno):
+        n = self.CONTEXT
+        if old != new:
+            if self.old:
+                self.old.extend(self.after)
+                self.new.extend(self.after)
+                self.after = []
+            else:
+                self.start = (old_lineno - len(self.before),
+                              new_lineno - len(self.before))
+            self.old.append(old)
+            self.new.append(new)
+        elif self.old:
+            self.after.extend(old.splitlines(True))
+            if len(self.after) > 2 * n:
+                after = self.after
+                self._flush(after[:n])
+                self.before = after[-n:]
+        else:
+            self.before = (self.before + old.splitlines(True))[-n:]
+
+    def close(self):
+        if self.old:
+            self._flush(self.after[:self.CONTEXT])
+
+    def _flush(self, after):
+        before = u"".join(self.before)
+        after = u"".join(after)
+        self.report(before + u"".join(self.old) + after,
+                    before + u"".join(self.new) + after,
+                    self.start[0], self.start[1], self.first)
+        self.first = False
+        self.old = []
+        self.new = []
+        self.after = []
+
+
+def _ancestors(node):
+    node = node.parent
+    while node is not None:
+        yield node
+        node = node.parent
+
+
+_statement_parents = frozenset((pygram.python_symbols.file_input,
+                                pygram.python_symbols.suite))
+
+_body_owners = frozenset((pygram.python_symbols.funcdef,
+                          pygram.python_symbols.classdef))
+
+
+def _get_statement(node):
+    """Return the innermost statement containing node."""
+    while (node.parent is not None and
+           node.parent.type not in _statement_parents):
+        node = node.parent
+    return node
+
+
+def _child_index(node):
+    # Can't use index(); we need to test by identity
+    for i, child in enumerate(node.parent.children):
+        if child is node:
+            return i
+
+
+def _is_in_tree(node, tree):
+    while node.parent is not None:
+        node = node.parent
+    return node is tree
+
+
+def _statements_around(tree, start, end):
+    """Return the statements of tree whose text spans offsets start to end,
+    innermost first, as (statement, offset, length) triples."""
+    found = []
+    node, offset = tree, 0
+    while node.children:
+        spans = []
+        for child in node.children:
+            length = len(unicode(child))
+            spans.append((child, offset, length))
+            offset += length
+        # An insertion between two nodes goes with the second, unless that
+        # is empty (like an ENDMARKER with no prefix).
+        for child, offset, length in spans:
+            if offset <= start < offset + length and end <= offset + length:
+                break
+        else:
+            for child, offset, length in spans:
+                if (child.children and offset <= start and
+                        end <= offset + length):
                     break
-                tp, value = advance()
-                if tp == token.OP and value == u"(":
-                    tp, value = advance()
-                while tp == token.NAME:
-                    features.add(value)
-                    tp, value = advance()
-                    if tp != token.OP or value != u",":
-                        break
-                    tp, value = advance()
             else:
                 break
-    except StopIteration:
-        pass
-    return frozenset(features)
+        if child.children and node.type in _statement_parents:
+            found.append((child, offset, length))
+        node = child
+    found.reverse()
+    return found
+
+
+def _first_leaf(node):
+    while node.children:
+        node = node.children[0]
+    return node
+
+
+def _next_leaf(node):
+    while node.next_sibling is None:
+        node = node.parent
+    return _first_leaf(node.next_sibling)
+
+
+def _restore_tail(stmts, tail):
+    """Put tail, the indentation of the line after stmts that was split off
+    their text to parse it, back in the tree.
+
+    It goes after the blank lines and comments of the DEDENTs that close
+    the last statement's suites, or else before the next token.
+    """
+    leaves = [node for node in stmts[-1].pre_order() if not node.children]
+    while len(leaves) > 1 and leaves[-2].type == token.DEDENT:
+        leaves.pop()
+    leaf = leaves[-1]
+    if leaf.type == token.DEDENT:
+        leaf.prefix += tail
+    else:
+        leaf = _next_leaf(leaf)
+        leaf.prefix = tail + leaf.prefix
+
+
+def _line_span(node):
+    """Return the first and last line of node's tokens, or None if a fixer
+    made up (and so didn't number) the first or last of them."""
+    first = _first_leaf(node)
+    # The DEDENTs closing a suite have the line number of the next token.
+    last = node
+    while last.children:
+        for child in reversed(last.children):
+            if child.children or child.value:
+                last = child
+                break
+        else:
+            return None
+    if not first.lineno or not last.lineno:
+        return None
+    return (first.lineno,
+            last.lineno + last.value.rstrip(u"\r\n").count(u"\n"))
 
 
 class FixerError(Exception):
     """A fixer could not be loaded."""
 
 
+class Shard(collections.namedtuple("Shard", "index count by")):
+    """One of count slices of the files to refactor, numbered from 1.
+
+    Files are assigned to shards either by a hash of their path (by="hash")
+    or so that the shards hold about the same number of bytes (by="size").
+    Either way, every file lands in exactly one shard, and the same one on
+    every machine that finds the same files under the same relative paths.
+    """
+    __slots__ = ()
+
+    METHODS = ("hash", "size")
+
+    def __new__(cls, index, count, by="hash"):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError("no shard %d of %d" % (index, count))
+        if by not in cls.METHODS:
+            raise ValueError("can't shard by %r" % (by,))
+        return super(Shard, cls).__new__(cls, index, count, by)
+
+    @classmethod
+    def parse(cls, spec, by="hash"):
+        """Make a Shard from a string like "2/8"."""
+        try:
+            index, count = [int(part) for part in spec.split("/")]
+        except ValueError:
+            raise ValueError("bad shard %r; expected INDEX/COUNT" % (spec,))
+        return cls(index, count, by)
+
+    def __str__(self):
+        return "%d/%d" % (self.index, self.count)
+
+    def select(self, filenames):
+        """Return the filenames that belong to this shard, in order."""
+        if self.by == "size":
+            mine = self._balance(filenames)
+            return [filename for filename in filenames if filename in mine]
+        return [filename for filename in filenames
+                if self._hash(filename) % self.count == self.index - 1]
+
+    @staticmethod
+    def _hash(filename):
+        path = os.path.normpath(filename).replace(os.sep, "/")
+        return int(hashlib.md5(path).hexdigest()[:8], 16)
+
+    def _balance(self, filenames):
+        # Biggest files first, each into the least full shard; ties are
+        # broken by name so that every shard comes to the same answer.
+        sizes = []
+        for filename in set(filenames):
+            try:
+                size = os.path.getsize(filename)
+            except os.error:
+                size = 0 # refactor_file() reports it
+            sizes.append((-size, filename))
+        sizes.sort()
+        shards = [(0, i) for i in xrange(self.count)]
+        mine = set()
+        for size, filename in sizes:
+            total, i = heapq.heappop(shards)
+            if i == self.index - 1:
+                mine.add(filename)
+            heapq.heappush(shards, (total - size, i))
+        return mine
+
+
+class LineRanges(tuple):
+    """The lines to refactor, as sorted, disjoint (first, last) pairs of
+    line numbers (counting from 1, and including last); see the lines
+    option."""
+    __slots__ = ()
+
+    def __new__(cls, ranges):
+        merged = []
+        for first, last in sorted(ranges):
+            if not 1 <= first <= last:
+                raise ValueError("bad line range %d-%d" % (first, last))
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return super(LineRanges, cls).__new__(cls, merged)
+
+    @classmethod
+    def parse(cls, spec):
+        """Make LineRanges from a string like "10-20,35"."""
+        ranges = []
+        for part in spec.split(","):
+            first, sep, last = part.partition("-")
+            try:
+                first = int(first)
+                last = int(last) if sep else first
+            except ValueError:
+                raise ValueError("bad line range %r; expected FIRST-LAST or "
+                                 "LINE" % (part,))
+            ranges.append((first, last))
+        return cls(ranges)
+
+    def __str__(self):
+        return ",".join(str(first) if first == last else
+                        "%d-%d" % (first, last) for first, last in self)
+
+    def overlaps(self, first, last):
+        """Return whether any of the lines first to last is in a range."""
+        i = bisect_right(self, (last, sys.maxint)) - 1
+        return i >= 0 and self[i][1] >= first
+
+
 class RefactoringTool(object):
 
-    _default_options = {"print_function" : False}
+    # With the stream_size option, files of at least that many bytes are
+    # refactored a chunk of top-level statements at a time; see
+    # refactor_stream().  With lazy_parsing, function and class bodies in
+    # which no fixer can match are left unparsed; see traverse_tree().
+    # With recover, the top-level statements of a file (or body) that
+    # can't be parsed are left as they are, and the rest is refactored.
+    # With lines (LineRanges, or a sequence of (first, last) pairs), only
+    # the nodes on those lines are offered to the fixers.  With cache_dir,
+    # the results of refactor_file() are kept in a ResultCache there, with
+    # the fixers each file was found clean for (see _refactor_input()),
+    # and the parse trees of the code in a TreeCache.
+    _default_options = {"print_function" : False,
+                        "lazy_fixers" : False,
+                        "fixpoint" : False,
+                        "stream_size" : None,
+                        "lazy_parsing" : False,
+                        "recover" : False,
+                        "lines" : None,
+                        "cache_dir" : None}
+
+    # The options that may change what the fixers make of a file.
+    _OUTPUT_OPTIONS = ("print_function", "fixpoint", "recover")
+
+    # The modules besides the fixers' that results depend on, for the
+    # cache_dir option.
+    _CORE_MODULES = ("lib2to3.refactor", "lib2to3.fixer_base",
+                     "lib2to3.fixer_util", "lib2to3.pytree",
+                     "lib2to3.patcomp", "lib2to3.pygram",
+                     "lib2to3.pgen2.driver", "lib2to3.pgen2.parse",
+                     "lib2to3.pgen2.tokenize")
+
+    # The modules parse trees depend on, for the TreeCache.
+    _PARSER_MODULES = ("lib2to3.pytree", "lib2to3.pygram",
+                       "lib2to3.pgen2.driver", "lib2to3.pgen2.parse",
+                       "lib2to3.pgen2.tokenize", "lib2to3.pgen2.grammar")
+
+    # With the fixpoint option, code changed by a fixer is offered to the
+    # fixers again, at most this many times.  Only fixers that leave their
+    # own output alone (which most of the 2to3 fixers don't, as their output
+    # is Python 3) should be run this way.
+    MAX_FIXPOINT_ROUNDS = 10
+
+    STREAM_CHUNK_SIZE = 2**16 # Characters refactored at once when streaming
 
     CLASS_PREFIX = "Fix" # The prefix for fixer classes
     FILE_PREFIX = "fix_" # The prefix for modules with a fixer within
@@ -190,6 +760,8 @@ class RefactoringTool(object):
             self.grammar = pygram.python_grammar_no_print_statement
         else:
             self.grammar = pygram.python_grammar
+        if self.options["lines"] is not None:
+            self.options["lines"] = LineRanges(self.options["lines"])
         self.errors = []
         self.logger = logging.getLogger("RefactoringTool")
         self.fixer_log = []
@@ -197,7 +769,29 @@ class RefactoringTool(object):
         self.driver = driver.Driver(self.grammar,
                                     convert=pytree.convert,
                                     logger=self.logger)
-        self.pre_order, self.post_order = self.get_fixers()
+        self._pending_fixers = {} # Fixer path -> triggers, see lazy_fixers
+        self._current_tree = None
+        self._trigger_scanner = None # Computed by find_triggers()
+        self._required_names = {}
+        self._fixer_triggers = {}
+        self._heads_cache = {}
+        self._tree_fixers = None
+        self._lines = None # The LineRanges of the tree being refactored
+        self._cache_salt = None # See _cache_key()
+        self._core_salt = None
+        self._fixer_ids = {} # Fixer module -> its name and source hash
+        self._skipped_fixers = frozenset() # Fixers refactor_tree() leaves out
+        if self.options["cache_dir"] is not None:
+            self.cache = ResultCache(self.options["cache_dir"])
+            self.tree_cache = TreeCache(self.options["cache_dir"])
+        else:
+            self.cache = self.tree_cache = None
+        self._tree_salt = None # See _tree_key()
+        self._worklist = None # Changed nodes, with the fixpoint option
+        if self.options["lazy_fixers"]:
+            self.pre_order, self.post_order = self.get_lazy_fixers()
+        else:
+            self.pre_order, self.post_order = self.get_fixers()
 
         self.pre_order_heads = _get_headnode_dict(self.pre_order)
         self.post_order_heads = _get_headnode_dict(self.post_order)
@@ -212,38 +806,231 @@ class RefactoringTool(object):
           want a pre-order AST traversal, and post_order is the list that want
           post-order traversal.
         """
-        pre_order_fixers = []
-        post_order_fixers = []
+        fixers = []
         for fix_mod_path in self.fixers:
-            mod = __import__(fix_mod_path, {}, {}, ["*"])
-            fix_name = fix_mod_path.rsplit(".", 1)[-1]
-            if fix_name.startswith(self.FILE_PREFIX):
-                fix_name = fix_name[len(self.FILE_PREFIX):]
-            parts = fix_name.split("_")
-            class_name = self.CLASS_PREFIX + "".join([p.title() for p in parts])
-            try:
-                fix_class = getattr(mod, class_name)
-            except AttributeError:
-                raise FixerError("Can't find %s.%s" % (fix_name, class_name))
-            fixer = fix_class(self.options, self.fixer_log)
-            if fixer.explicit and self.explicit is not True and \
-                    fix_mod_path not in self.explicit:
-                self.log_message("Skipping implicit fixer: %s", fix_name)
-                continue
+            fixer = self._load_fixer(fix_mod_path)
+            if fixer is not None:
+                fixers.append(fixer)
+        return self._split_fixers(fixers)
 
-            self.log_debug("Adding transformation: %s", fix_name)
-            if fixer.order == "pre":
-                pre_order_fixers.append(fixer)
-            elif fixer.order == "post":
-                post_order_fixers.append(fixer)
-            else:
-                raise FixerError("Illegal fixer order: %r" % fixer.order)
+    def get_lazy_fixers(self):
+        """Like get_fixers(), but only imports the fixers that have no
+        manifest entry or no triggers (see get_fixer_manifest()).
 
+        The other fixers are recorded as pending and loaded by
+        activate_fixers() once a source contains one of their triggers.
+        """
+        self._fixer_ranks = {}
+        self._loaded_fixers = [] # (rank, fixer) tuples
+        for rank, fix_mod_path in enumerate(self.fixers):
+            self._fixer_ranks[fix_mod_path] = rank
+            pkg_name, _, mod_name = fix_mod_path.rpartition(".")
+            info = get_fixer_manifest(pkg_name).get(mod_name)
+            if info is None or info["triggers"] is None:
+                fixer = self._load_fixer(fix_mod_path)
+                if fixer is not None:
+                    self._loaded_fixers.append((rank, fixer))
+            elif info["explicit"] and not self._is_selected(fix_mod_path):
+                self.log_message("Skipping implicit fixer: %s",
+                                 self._fix_name(fix_mod_path))
+            else:
+                self._pending_fixers[fix_mod_path] = info["triggers"]
+        return self._split_fixers([f for r, f in self._loaded_fixers])
+
+    def _fix_name(self, fix_mod_path):
+        fix_name = fix_mod_path.rsplit(".", 1)[-1]
+        if fix_name.startswith(self.FILE_PREFIX):
+            fix_name = fix_name[len(self.FILE_PREFIX):]
+        return fix_name
+
+    def _is_selected(self, fix_mod_path):
+        return self.explicit is True or fix_mod_path in self.explicit
+
+    def _load_fixer(self, fix_mod_path):
+        """Import and instantiate one fixer; None if it is skipped."""
+        fix_name, fix_class = _get_fixer_class(fix_mod_path,
+                                               self.CLASS_PREFIX,
+                                               self.FILE_PREFIX)
+        fixer = fix_class(self.options, self.fixer_log)
+        if fixer.explicit and not self._is_selected(fix_mod_path):
+            self.log_message("Skipping implicit fixer: %s", fix_name)
+            return None
+
+        self.log_debug("Adding transformation: %s", fix_name)
+        if fixer.order not in ("pre", "post"):
+            raise FixerError("Illegal fixer order: %r" % fixer.order)
+        return fixer
+
+    def _split_fixers(self, fixers):
+        pre_order_fixers = [f for f in fixers if f.order == "pre"]
+        post_order_fixers = [f for f in fixers if f.order == "post"]
         key_func = operator.attrgetter("run_order")
         pre_order_fixers.sort(key=key_func)
         post_order_fixers.sort(key=key_func)
         return (pre_order_fixers, post_order_fixers)
 
+    def activate_fixers(self, text):
+        """Load the pending fixers that have a trigger occurring in text.
+
+        Returns the list of newly loaded fixers.
+        """
+        if not self._pending_fixers:
+            return []
+        found = self._scan_triggers(text)
+        paths = [path for path, triggers in self._pending_fixers.iteritems()
+                 if not found.isdisjoint(triggers)]
+        if not paths:
+            return []
+        new = []
+        for path in paths:
+            del self._pending_fixers[path]
+            fixer = self._load_fixer(path)
+            if fixer is not None:
+                new.append(fixer)
+                self._loaded_fixers.append((self._fixer_ranks[path], fixer))
+        if not new:
+            return []
+
+        # Keep the order get_fixers() would have produced.
+        self._loaded_fixers.sort(key=operator.itemgetter(0))
+        fixers = [f for r, f in self._loaded_fixers]
+        self.pre_order[:], self.post_order[:] = self._split_fixers(fixers)
+        # Update in place; a traversal may be holding on to these dicts.
+        for heads, fixers in ((self.pre_order_heads, self.pre_order),
+                              (self.post_order_heads, self.post_order)):
+            heads.clear()
+            heads.update(_get_headnode_dict(fixers))
+        return new
+
+    def get_required_names(self, fixer):
+        """Return the identifiers of which at least one must be used in a
+        tree for fixer to match, or None if its triggers are not all names.
+        """
+        try:
+            return self._required_names[fixer]
+        except KeyError:
+            pass
+        names = self._get_triggers(fixer)
+        if names is not None and not all(_is_name(t) for t in names):
+            names = None
+        self._required_names[fixer] = names
+        return names
+
+    def _get_triggers(self, fixer):
+        try:
+            return self._fixer_triggers[fixer]
+        except KeyError:
+            pass
+        triggers = get_fixer_triggers(fixer)
+        self._fixer_triggers[fixer] = triggers
+        return triggers
+
+    def _may_match(self, fixer, names):
+        required = self.get_required_names(fixer)
+        return required is None or not required.isdisjoint(names)
+
+    def get_tree_fixers(self, tree):
+        """Return the (pre_order, post_order) fixers that can match in tree,
+        judging by the names the parser recorded in tree.used_names.
+        """
+        used_names = getattr(tree, "used_names", None)
+        skipped = self._skipped_fixers
+        if used_names is None:
+            return ([f for f in self.pre_order if f not in skipped],
+                    [f for f in self.post_order if f not in skipped])
+        return ([f for f in self.pre_order
+                 if f not in skipped and self._may_match(f, used_names)],
+                [f for f in self.post_order
+                 if f not in skipped and self._may_match(f, used_names)])
+
+    def _get_tree_heads(self, pre_order, post_order):
+        """Return fresh head node dicts for a subset of the fixers."""
+        key = (tuple(pre_order), tuple(post_order))
+        try:
+            pre_heads, post_heads = self._heads_cache[key]
+        except KeyError:
+            if len(self._heads_cache) >= 64:
+                self._heads_cache.clear()
+            pre_heads = _get_headnode_dict(pre_order)
+            post_heads = _get_headnode_dict(post_order)
+            self._heads_cache[key] = (pre_heads, post_heads)
+        # Copies, since _activate_in_tree() updates them in place.
+        return dict(pre_heads), dict(post_heads)
+
+    def _has_inactive_fixers(self):
+        if self._tree_fixers is None:
+            return False
+        pre_order, post_order = self._tree_fixers[:2]
+        return (bool(self._pending_fixers) or
+                len(pre_order) + len(post_order) <
+                len(self.pre_order) + len(self.post_order))
+
+    def _activate_in_tree(self, text):
+        """Start the fixers triggered by text, which a transformation just
+        added to the tree being refactored."""
+        self.activate_fixers(text)
+        tree, name = self._current_tree
+        pre_order, post_order, pre_heads, post_heads = self._tree_fixers
+        active = set(pre_order + post_order)
+        found = None
+        new = []
+        for fixer in chain(self.pre_order, self.post_order):
+            if fixer in active or fixer in self._skipped_fixers:
+                continue
+            if found is None:
+                found = self._scan_triggers(text)
+            if self._may_match(fixer, found):
+                new.append(fixer)
+        if not new:
+            return
+        for fixer in new:
+            fixer.start_tree(tree, name)
+        active.update(new)
+        # Update in place; the traversal is holding on to these.
+        pre_order[:] = [f for f in self.pre_order if f in active]
+        post_order[:] = [f for f in self.post_order if f in active]
+        for heads, fixers in ((pre_heads, pre_order),
+                              (post_heads, post_order)):
+            heads.clear()
+            heads.update(_get_headnode_dict(fixers))
+
+    def find_triggers(self, text):
+        """Scan text for the triggers of the enabled fixers.
+
+        Returns the set of trigger values occurring in text, or None if some
+        enabled fixer has no triggers and may therefore match anything.
+        """
+        found = self._scan_triggers(text)
+        if self._untriggered:
+            return None
+        return found
+
+    def _scan_triggers(self, text):
+        if self._trigger_scanner is None:
+            triggers = set()
+            self._untriggered = False
+            for fixer in chain(self.pre_order, self.post_order):
+                fixer_triggers = get_fixer_triggers(fixer)
+                if fixer_triggers is None:
+                    self._untriggered = True
+                else:
+                    triggers.update(fixer_triggers)
+            for fixer_triggers in self._pending_fixers.itervalues():
+                triggers.update(fixer_triggers)
+            self._all_triggers = frozenset(triggers)
+            self._trigger_scanner = _compile_trigger_scanner(triggers)
+        return self._all_triggers.intersection(
+            self._trigger_scanner.findall(text))
+
+    def could_match(self, text):
+        """Return False if no enabled fixer can match anything in text."""
+        found = self.find_triggers(text)
+        return found is None or bool(found)
+
+    def _can_defer(self, body):
+        # Whether the driver can leave a function or class body unparsed.
+        return not self.could_match(body)
+
     def log_error(self, msg, *args, **kwds):
         """Called when an error occurs."""
         raise
@@ -264,17 +1051,42 @@ class RefactoringTool(object):
         refactored file."""
         pass
 
-    def refactor(self, items, write=False, doctests_only=False):
-        """Refactor a list of files and directories."""
+    def refactor(self, items, write=False, doctests_only=False, shard=None):
+        """Refactor a list of files and directories.
+
+        With a Shard, only the files in that shard are refactored (or even
+        read).
+        """
+        if shard is None:
+            for dir_or_file in items:
+                if os.path.isdir(dir_or_file):
+                    self.refactor_dir(dir_or_file, write, doctests_only)
+                else:
+                    self.refactor_file(dir_or_file, write, doctests_only)
+            return
+        filenames = []
         for dir_or_file in items:
             if os.path.isdir(dir_or_file):
-                self.refactor_dir(dir_or_file, write, doctests_only)
+                filenames.extend(self.find_python_files(dir_or_file))
             else:
-                self.refactor_file(dir_or_file, write, doctests_only)
+                filenames.append(dir_or_file)
+        selected = shard.select(filenames)
+        self.log_debug("Refactoring %d of %d files in shard %s",
+                       len(selected), len(filenames), shard)
+        for filename in selected:
+            self.refactor_file(filename, write, doctests_only)
 
     def refactor_dir(self, dir_name, write=False, doctests_only=False):
         """Descends down a directory and refactor every Python file found.
 
+        See find_python_files() for the files that are refactored.
+        """
+        for fullname in self.find_python_files(dir_name):
+            self.refactor_file(fullname, write, doctests_only)
+
+    def find_python_files(self, dir_name):
+        """Generates the Python files in a directory and its subdirectories.
+
         Python files are assumed to have a .py extension.
 
         Files and subdirectories starting with '.' are skipped.
@@ -286,8 +1098,7 @@ class RefactoringTool(object):
             for name in filenames:
                 if not name.startswith(".") and \
                         os.path.splitext(name)[1].endswith("py"):
-                    fullname = os.path.join(dirpath, name)
-                    self.refactor_file(fullname, write, doctests_only)
+                    yield os.path.join(dirpath, name)
             # Modify dirnames in-place to remove subdirs with leading dots
             dirnames[:] = [dn for dn in dirnames if not dn.startswith(".")]
 
@@ -295,6 +1106,18 @@ class RefactoringTool(object):
         """
         Do our best to decode a Python source file correctly.
         """
+        f, encoding = self._open_python_source(filename)
+        if f is None:
+            return None, None
+        with f:
+            return _from_system_newlines(f.read()), encoding
+
+    def _open_python_source(self, filename):
+        """Open a Python source file for reading with the right encoding.
+
+        Returns the file and its encoding, or (None, None) if it can't be
+        opened.
+        """
         try:
             f = open(filename, "rb")
         except IOError, err:
@@ -304,59 +1127,521 @@ class RefactoringTool(object):
             encoding = tokenize.detect_encoding(f.readline)[0]
         finally:
             f.close()
-        with _open_with_encoding(filename, "r", encoding=encoding) as f:
-            return _from_system_newlines(f.read()), encoding
+        return _open_with_encoding(filename, "r", encoding=encoding), encoding
+
+    def refactor_file(self, filename, write=False, doctests_only=False,
+                      lines=None):
+        """Refactors a file.
 
-    def refactor_file(self, filename, write=False, doctests_only=False):
-        """Refactors a file."""
+        With lines (LineRanges, or a sequence of (first, last) pairs), only
+        the code on those lines is refactored; by default that is the lines
+        option.
+        """
+        if self._should_stream(filename, doctests_only):
+            if self.refactor_stream(filename, write, lines):
+                return
         input, encoding = self._read_python_source(filename)
         if input is None:
             # Reading the file failed.
             return
+        output = self._refactor_input(input, filename, doctests_only, lines)
+        if output is None:
+            return
+        if doctests_only:
+            self.processed_file(output, filename, input + u"\n", write,
+                                encoding)
+        else:
+            self.processed_file(output, filename, write=write,
+                                encoding=encoding)
+
+    def _refactor_input(self, input, filename, doctests_only, lines):
+        """Return the new text of a file read by refactor_file(), or None
+        if nothing changed; from the cache, with the cache_dir option, if
+        it has the result.
+
+        The cache also records the fixers a text was found clean for: those
+        that neither changed it nor logged anything.  When the fixers
+        change, only those it isn't clean for are run, unless one of them
+        needs the whole tree (see needs_whole_tree()).  Should they change
+        the text, all the fixers are run again, since the others may have
+        something to do with the new code.
+
+        Results are kept without the filename, which other files with the
+        same text share them under; see _cached_messages().
+        """
+        if self.cache is None:
+            return self._run_fixers(input, filename, doctests_only, lines)
+        key = self._cache_key(input, doctests_only, lines)
+        result = self.cache.get(key)
+        if result is not None:
+            self.log_debug("Cached result for %s", filename)
+            self.fixer_log.extend(
+                self._cached_messages(result["messages"], filename))
+            return result["output"]
+        n_messages = len(self.fixer_log)
+        n_errors = len(self.errors)
+        clean_key = self._cache_key(input, doctests_only, lines, False)
+        record = self.cache.get(clean_key)
+        clean = set(record["clean"]) if record is not None else set()
+        output = self._run_new_fixers(input, filename, doctests_only, lines,
+                                      clean)
+        messages = self.fixer_log[n_messages:]
+        # The cache doesn't keep errors, which a hit would then hide.
+        if len(self.errors) == n_errors:
+            messages = self._cached_messages(messages, filename, False)
+            self.cache.put(key, {"output" : output, "messages" : messages})
+            if output is None and not messages:
+                clean.update(self._fixer_id(path)
+                             for path in self._enabled_fixers())
+                self.cache.put(clean_key, {"clean" : sorted(clean)})
+        return output
+
+    def _cached_messages(self, messages, filename, replay=True):
+        """Return the fixer_log entries of a cached result of
+        _refactor_input() for filename; without replay, the messages of the
+        result to cache.
+
+        The messages of _log_parse_errors() name the file, so they are kept
+        as the [before, after] parts around the name.
+        """
+        if replay:
+            return [message if isinstance(message, basestring)
+                    else filename.join(message)
+                    for message in messages]
+        named = re.compile(r"(Line \d+ of )%s(: could not parse: )" %
+                           re.escape(filename))
+        cached = []
+        for message in messages:
+            match = named.match(message)
+            if match is not None:
+                message = [match.group(1),
+                           match.group(2) + message[match.end():]]
+            cached.append(message)
+        return cached
+
+    def _run_fixers(self, input, filename, doctests_only, lines):
+        if not self.could_match(input):
+            # Skip tokenizing and parsing files no fixer could change.
+            self.log_debug("No fixer triggers in %s", filename)
+            return None
         input += u"\n" # Silence certain parse errors
+        return self.refactor_text(input, filename, doctests_only, lines)
+
+    def _run_new_fixers(self, input, filename, doctests_only, lines, clean):
+        """Refactor input as _run_fixers() does, but run only the fixers it
+        isn't known to be clean for (by their _fixer_id()s) at first.
+
+        All the fixers are run if one of those needs the whole tree, or
+        changes the text.
+        """
+        if not clean:
+            return self._run_fixers(input, filename, doctests_only, lines)
+        self.activate_fixers(input)
+        fixers = list(chain(self.pre_order, self.post_order))
+        skipped = frozenset(
+            f for f in fixers
+            if self._fixer_id(f.__class__.__module__) in clean)
+        for fixer in fixers:
+            if fixer not in skipped and needs_whole_tree(fixer):
+                self.log_debug("Running all the fixers on %s, for %s",
+                               filename, fixer.__class__.__name__)
+                return self._run_fixers(input, filename, doctests_only,
+                                        lines)
+        if len(skipped) == len(fixers):
+            self.log_debug("Clean for the fixers: %s", filename)
+            return None
+        self.log_debug("Running %d new fixers on %s",
+                       len(fixers) - len(skipped), filename)
+        n_messages = len(self.fixer_log)
+        n_errors = len(self.errors)
+        self._skipped_fixers = skipped
+        try:
+            output = self._run_fixers(input, filename, doctests_only, lines)
+        finally:
+            self._skipped_fixers = frozenset()
+        if output is None:
+            return None
+        # Start over, as the others may have something to do with the new
+        # code.
+        del self.fixer_log[n_messages:]
+        del self.errors[n_errors:]
+        return self._run_fixers(input, filename, doctests_only, lines)
+
+    def _enabled_fixers(self):
+        """Return the module paths of the fixers that are run, loaded or
+        not (see the lazy_fixers option)."""
+        paths = set(self._pending_fixers)
+        paths.update(f.__class__.__module__
+                     for f in chain(self.pre_order, self.post_order))
+        return paths
+
+    def _fixer_id(self, path):
+        """Return the name of the fixer module path, with a hash of its
+        source and those of the fixer modules it uses (see
+        _fixer_modules()), for clean records."""
+        try:
+            return self._fixer_ids[path]
+        except KeyError:
+            pass
+        digest = hashlib.sha1()
+        for name in _fixer_modules(path):
+            digest.update(name + "\0" + _module_source(name) + "\0")
+        digest = digest.hexdigest()
+        fixer_id = self._fixer_ids[path] = path + ":" + digest
+        return fixer_id
+
+    def _cache_key(self, input, doctests_only=False, lines=None,
+                   fixers=True):
+        """Return the key of the result of refactor_file() for a file with
+        the text input, for the cache_dir option; without fixers, the key
+        of its clean record.
+
+        Besides the text, that depends on the fixers (in order) and the
+        lib2to3 modules and grammar (their names and the contents of their
+        files), the options that change the output, and the arguments of
+        refactor_file().
+        """
+        if self._core_salt is None:
+            salt = hashlib.sha1()
+            options = dict((name, self.options[name])
+                           for name in self._OUTPUT_OPTIONS)
+            salt.update(json.dumps(options, sort_keys=True))
+            salt.update(_grammar_source() + "\0")
+            for name in self._CORE_MODULES:
+                salt.update(name + "\0" + _module_source(name) + "\0")
+            self._core_salt = salt.hexdigest()
+        if self._cache_salt is None:
+            salt = hashlib.sha1(self._core_salt)
+            explicit = self.explicit
+            if explicit is not True:
+                explicit = sorted(explicit)
+            # In their order, which breaks the ties in run_order.
+            salt.update(json.dumps([list(self.fixers), explicit]))
+            for name in self.fixers:
+                salt.update(self._fixer_id(name) + "\0")
+            self._cache_salt = salt.hexdigest()
+        if lines is None:
+            lines = self.options["lines"]
+        elif not isinstance(lines, LineRanges):
+            lines = LineRanges(lines)
+        key = hashlib.sha1(self._cache_salt if fixers else self._core_salt)
+        key.update(json.dumps([doctests_only, lines]) + "\0")
+        key.update(input.encode("utf-8"))
+        return key.hexdigest()
+
+    def _should_stream(self, filename, doctests_only=False):
+        stream_size = self.options["stream_size"]
+        if stream_size is None or doctests_only:
+            return False
+        try:
+            return os.path.getsize(filename) >= stream_size
+        except os.error:
+            return False
+
+    def refactor_stream(self, filename, write=False, lines=None):
+        """Refactor a file a chunk of top-level statements at a time.
+
+        Memory use depends on the size of the chunks (STREAM_CHUNK_SIZE or
+        the largest statement) rather than that of the file.  Each chunk is
+        parsed and refactored on its own, with the __future__ features of
+        the first; the changes are passed to processed_chunk() as they
+        are made, and the new text goes to a temporary file that replaces
+        the file if write is set.  Should a chunk not parse, the file is
+        left alone (though the changes before it have been shown).
+
+        Returns False without changing anything if a fixer that needs the
+        whole tree (see needs_whole_tree()) may apply, as the file must
+        then be refactored as a whole; else True.  Chunks with none of
+        lines (as for refactor_file()) aren't even parsed.
+        """
+        if lines is None:
+            ranges = self.options["lines"]
+        else:
+            ranges = LineRanges(lines)
+        # First see which fixers may apply, without keeping the text.
+        f, encoding = self._open_python_source(filename)
+        if f is None:
+            return True
+        found = set()
+        untriggered = False
+        with f:
+            for block in iter(lambda: f.read(self.STREAM_CHUNK_SIZE), u""):
+                # Complete the last line; triggers don't span lines.
+                block += f.readline()
+                self.activate_fixers(block)
+                triggers = self.find_triggers(block)
+                if triggers is None:
+                    untriggered = True
+                    triggers = self._scan_triggers(block)
+                found.update(triggers)
+        for fixer in chain(self.pre_order, self.post_order):
+            if self._may_match(fixer, found) and needs_whole_tree(fixer):
+                self.log_debug("Not streaming %s, for %s", filename,
+                               fixer.__class__.__name__)
+                return False
+        if not found and not untriggered:
+            self.log_debug("No fixer triggers in %s", filename)
+            return True
+
+        f, encoding = self._open_python_source(filename)
+        if f is None:
+            return True
+        out = temp = None
+        changed = False
+        try:
+            if write:
+                fd, temp = tempfile.mkstemp(
+                    prefix=os.path.basename(filename) + ".",
+                    dir=os.path.dirname(filename) or os.curdir)
+                os.close(fd)
+                out = _open_with_encoding(temp, "w", encoding=encoding)
+            self.log_debug("Streaming %s", filename)
+            n_errors = len(self.errors)
+            features = None
+            new_lineno = 1
+            regions = _ChangedRegions(
+                lambda old, new, old_lineno, new_lineno, first:
+                    self.processed_chunk(old, new, filename, old_lineno,
+                                         new_lineno, first))
+            lines = (_from_system_newlines(line) for line in f)
+            try:
+                for lineno, text in _iter_chunks(lines,
+                                                 self.STREAM_CHUNK_SIZE,
+                                                 self.options["recover"]):
+                    if features is None:
+                        features = _detect_future_features(text)
+                    new = None
+                    if (ranges is None or ranges.overlaps(
+                            lineno, lineno + text.count(u"\n") - 1)) and \
+                            self.could_match(text):
+                        new = self.refactor_chunk(text, filename, lineno,
+                                                  features, ranges)
+                    if len(self.errors) > n_errors:
+                        return True
+                    if new is not None and new != text:
+                        changed = True
+                    else:
+                        new = text
+                    regions.add(text, new, lineno, new_lineno)
+                    new_lineno += new.count(u"\n")
+                    if out is not None:
+                        out.write(_to_system_newlines(new))
+            except (tokenize.TokenError, IndentationError), err:
+                self.log_error("Can't parse %s: %s: %s",
+                               filename, err.__class__.__name__, err)
+                return True
+            if not changed:
+                self.log_debug("No changes in %s", filename)
+                return True
+            regions.close()
+            wrote = False
+            if out is not None:
+                out.close()
+                wrote = self.replace_file(temp, filename)
+                if wrote:
+                    temp = None
+            else:
+                self.log_debug("Not writing changes to %s", filename)
+            self.processed_stream(filename, wrote)
+            return True
+        finally:
+            f.close()
+            if out is not None:
+                out.close()
+            if temp is not None:
+                os.remove(temp)
+
+    def processed_chunk(self, old_text, new_text, filename, old_lineno,
+                        new_lineno, first):
+        """Called by refactor_stream() with each changed region of a file;
+        see print_chunk_output()."""
+        self.print_chunk_output(old_text, new_text, filename, old_lineno,
+                                new_lineno, first)
+
+    def print_chunk_output(self, old_text, new_text, filename, old_lineno,
+                           new_lineno, first):
+        """Called with the old and new version of each changed region of a
+        file refactored by refactor_stream().
+
+        Regions are made of whole chunks plus a few unchanged lines around
+        them (but not beyond the file), so that their diffs, put together,
+        make a diff of the file.  old_lineno and new_lineno are the lines
+        the region starts on in the old and new file; first is True for
+        the first region.
+        """
+        pass
+
+    def replace_file(self, temp, filename):
+        """Replace filename by the file temp, written by refactor_stream().
+
+        Returns whether that worked.
+        """
+        try:
+            if os.path.exists(filename):
+                shutil.copymode(filename, temp)
+                if os.name == "nt":
+                    os.remove(filename)
+            os.rename(temp, filename)
+        except (IOError, os.error), err:
+            self.log_error("Can't write %s: %s", filename, err)
+            return False
+        self.log_debug("Wrote changes to %s", filename)
+        return True
+
+    def processed_stream(self, filename, wrote=False):
+        """Called when refactor_stream() has made changes to a file, and
+        written them if wrote is True."""
+        self.files.append(filename)
+        if wrote:
+            self.wrote = True
+
+    def refactor_text(self, input, filename, doctests_only=False, lines=None):
+        """Refactor the text of a file, read by refactor_file().
+
+        Returns the new text, or None if nothing changed.
+        """
         if doctests_only:
             self.log_debug("Refactoring doctests in %s", filename)
-            output = self.refactor_docstring(input, filename)
+            output = self.refactor_docstring(input, filename, lines)
             if output != input:
-                self.processed_file(output, filename, input, write, encoding)
-            else:
-                self.log_debug("No doctest changes in %s", filename)
+                return output
+            self.log_debug("No doctest changes in %s", filename)
         else:
-            tree = self.refactor_string(input, filename)
+            if lines is None:
+                # As refactor_string() was called before it took lines.
+                tree = self.refactor_string(input, filename)
+            else:
+                tree = self.refactor_string(input, filename, lines)
             if tree and tree.was_changed:
                 # The [:-1] is to take off the \n we added earlier
-                self.processed_file(unicode(tree)[:-1], filename,
-                                    write=write, encoding=encoding)
-            else:
-                self.log_debug("No changes in %s", filename)
+                return unicode(tree)[:-1]
+            self.log_debug("No changes in %s", filename)
+        return None
 
-    def refactor_string(self, data, name):
+    def refactor_string(self, data, name, lines=None):
         """Refactor a given input string.
 
         Args:
             data: a string holding the code to be refactored.
             name: a human-readable name for use in error/log messages.
+            lines: the lines to refactor, as for refactor_tree().
 
         Returns:
             An AST corresponding to the refactored input stream; None if
             there were errors during the parse.
         """
-        features = _detect_future_features(data)
-        if "print_function" in features:
-            self.driver.grammar = pygram.python_grammar_no_print_statement
+        return self._parse_and_refactor(data, name, lines=lines)
+
+    def refactor_chunk(self, text, filename, lineno, features, lines=None):
+        """Refactor some top-level statements of a file on their own.
+
+        Args:
+            text: the statements, which start on line lineno of the file.
+            filename: the name of the file.
+            features: the __future__ features the file imports.
+            lines: the lines of the file to refactor, as for
+                refactor_tree().
+
+        Returns:
+            The new text, or None if nothing changed.
+        """
+        tree = self._parse_and_refactor(text + u"\n", filename, features,
+                                        lineno, lines)
+        if not tree or not tree.was_changed:
+            return None
+        # The driver made up for the missing lines with newlines, as for
+        # doctests; take them off, and the \n we added.
+        new = unicode(tree)[:-1]
+        padding = u"\n" * (lineno - 1)
+        assert new.startswith(padding), (filename, lineno)
+        return new[len(padding):]
+
+    def _parse_and_refactor(self, data, name, features=None, lineno=1,
+                            lines=None):
+        self.activate_fixers(data)
+        tokens = tokenize.generate_tokens(driver.generate_lines(data).next)
+        if features is None:
+            # This only reads ahead over the module header.
+            features, tokens = driver.detect_future_features(tokens)
+        if lineno != 1:
+            tokens = driver._shift_tokens(tokens, lineno - 1)
+        lazy = None
+        if self.options["lazy_parsing"] and not any(
+                self._looks_into_body(t, self.pre_order_heads,
+                                      self.post_order_heads)
+                for t in _body_owners):
+            lazy = self._can_defer
+        source = None
+        if self.options["recover"]:
+            # The driver makes up for the lines before lineno with newlines.
+            source = u"\n" * (lineno - 1) + data
+        key = tree = None
+        if self.tree_cache is not None and lazy is None:
+            # Trees with bodies left unparsed depend on the fixers.
+            key = self._tree_key(data, features, lineno)
+            tree = self.tree_cache.get(key)
+            if tree is not None and source is not None:
+                tree.parse_errors = []
+        if tree is None:
+            if "print_function" in features:
+                self.driver.grammar = pygram.python_grammar_no_print_statement
+            try:
+                tree = self.driver.parse_tokens(tokens, lazy=lazy,
+                                                source=source)
+            except Exception, err:
+                self.log_error("Can't parse %s: %s: %s",
+                               name, err.__class__.__name__, err)
+                return
+            finally:
+                self.driver.grammar = self.grammar
+            tree.future_features = features
+            # Trees with errors are left to be parsed again, so that the
+            # errors are logged.
+            if key is not None and not getattr(tree, "parse_errors", None):
+                self.tree_cache.put(key, tree)
+        if source is not None:
+            self._log_parse_errors(tree, name)
+        self.log_debug("Refactoring %s", name)
         try:
-            tree = self.driver.parse_string(data)
-        except Exception, err:
+            self.refactor_tree(tree, name, lines)
+        except parse.ParseError, err:
+            # In a body left unparsed until the traversal got to it.
             self.log_error("Can't parse %s: %s: %s",
                            name, err.__class__.__name__, err)
             return
-        finally:
-            self.driver.grammar = self.grammar
-        tree.future_features = features
-        self.log_debug("Refactoring %s", name)
-        self.refactor_tree(tree, name)
         return tree
 
+    def _tree_key(self, data, features, lineno=1):
+        """Return the key of the parse tree of data for the TreeCache; see
+        _parse_and_refactor() for the arguments.
+
+        Besides data, that depends on the grammar (Grammar.txt, and which
+        grammar is used) and the modules that parse.
+        """
+        if self._tree_salt is None:
+            salt = hashlib.sha1()
+            salt.update(_grammar_source() + "\0")
+            for name in self._PARSER_MODULES:
+                salt.update(name + "\0" + _module_source(name) + "\0")
+            self._tree_salt = salt.hexdigest()
+        print_function = ("print_function" in features or
+                          self.grammar is not pygram.python_grammar)
+        key = hashlib.sha1(self._tree_salt)
+        key.update(json.dumps([sorted(features), print_function, lineno]) +
+                   "\0")
+        key.update(data.encode("utf-8"))
+        return key.hexdigest()
+
+    def _log_parse_errors(self, tree, name):
+        # Tell of the statements the driver had to leave alone, as the
+        # fixers tell of code they can't convert.
+        leaves = [child for child in tree.children
+                  if child.type == token.ERRORTOKEN]
+        for leaf, err in zip(leaves, tree.parse_errors):
+            self.fixer_log.append("Line %d of %s: could not parse: %s: %s" %
+                                  (leaf.lineno, name, err.__class__.__name__,
+                                   err))
+
     def refactor_stdin(self, doctests_only=False):
         input = sys.stdin.read()
         if doctests_only:
@@ -373,32 +1658,226 @@ class RefactoringTool(object):
             else:
                 self.log_debug("No changes in stdin")
 
-    def refactor_tree(self, tree, name):
+    def refactor_tree(self, tree, name, lines=None):
         """Refactors a parse tree (modifying the tree in place).
 
         Args:
             tree: a pytree.Node instance representing the root of the tree
                   to be refactored.
             name: a human-readable name for this tree.
+            lines: if given (as LineRanges, or a sequence of (first, last)
+                  pairs), only the nodes on these lines are offered to the
+                  fixers, and the traversal doesn't go into the others;
+                  by default, the lines option.
 
         Returns:
             True if the tree was modified, False otherwise.
         """
-        for fixer in chain(self.pre_order, self.post_order):
+        if lines is None:
+            lines = self.options["lines"]
+        elif not isinstance(lines, LineRanges):
+            lines = LineRanges(lines)
+        pre_order, post_order = self.get_tree_fixers(tree)
+        pre_heads, post_heads = self._get_tree_heads(pre_order, post_order)
+        for fixer in chain(pre_order, post_order):
             fixer.start_tree(tree, name)
 
-        self.traverse_by(self.pre_order_heads, tree.pre_order())
-        self.traverse_by(self.post_order_heads, tree.post_order())
+        self._current_tree = (tree, name)
+        self._tree_fixers = (pre_order, post_order, pre_heads, post_heads)
+        self._lines = lines
+        if self.options["fixpoint"]:
+            self._worklist = []
+        try:
+            self.traverse_tree(tree, pre_heads, post_heads)
+            rounds = 0
+            while self._worklist:
+                if rounds == self.MAX_FIXPOINT_ROUNDS:
+                    self.log_message("No fixed point for %s after %d rounds",
+                                     name, rounds)
+                    break
+                worklist, self._worklist = self._worklist, []
+                self.rematch(tree, worklist, pre_heads, post_heads)
+                rounds += 1
+        finally:
+            self._current_tree = None
+            self._tree_fixers = None
+            self._lines = None
+            self._worklist = None
 
-        for fixer in chain(self.pre_order, self.post_order):
+        for fixer in chain(pre_order, post_order):
             fixer.finish_tree(tree, name)
         return tree.was_changed
 
+    def traverse_tree(self, tree, pre_heads, post_heads):
+        """Traverse an AST once, applying the pre-order fixers to each node
+        on the way down and the post-order fixers on the way up.
+
+        This is a helper method for refactor_tree().  Within each node, the
+        fixers run in the order of their head node dict entries, i.e. by
+        run_order.  If a pre-order fixer replaces a node, the traversal
+        continues into the replacement.
+
+        Function and class bodies the driver left unparsed (see the
+        lazy_parsing option) are parsed when the traversal gets to them,
+        unless no fixer can match in them, and before their def or class
+        is offered to the fixers for it, which may look inside.  The
+        statements it couldn't parse (see the recover option), and the
+        nodes off the lines being refactored, are skipped.
+
+        Args:
+            tree: the root of the AST.
+            pre_heads, post_heads: head node dicts of the pre- and
+                post-order fixers, as returned by _get_headnode_dict().
+
+        Returns:
+            None
+        """
+        node = self._apply_fixers(pre_heads, tree)
+        if node is None:
+            return
+        stack = [(node, iter(node.children))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child.type == token.ERRORTOKEN:
+                    continue
+                if self._lines is not None and not self._on_lines(child):
+                    continue
+                if child.type == token.UNPARSED:
+                    if not self._needs_body(child):
+                        continue
+                    # Go through the statements in its place.
+                    stack.append((None, iter(self._parse_body(child))))
+                    break
+                if self._looks_into_body(child.type, pre_heads, post_heads):
+                    body = child.children[-1].children
+                    if len(body) > 2 and body[2].type == token.UNPARSED:
+                        self._parse_body(body[2])
+                child = self._apply_fixers(pre_heads, child)
+                if child is None:
+                    continue
+                stack.append((child, iter(child.children)))
+                break
+            else:
+                stack.pop()
+                if node is not None:
+                    self._apply_fixers(post_heads, node)
+
+    def _on_lines(self, node):
+        """Return whether node is on the lines being refactored.  Nodes
+        a fixer made up are taken to be."""
+        span = _line_span(node)
+        return span is None or self._lines.overlaps(*span)
+
+    def _looks_into_body(self, node_type, pre_heads, post_heads):
+        return node_type in _body_owners and bool(pre_heads[node_type] or
+                                                  post_heads[node_type])
+
+    def _needs_body(self, leaf):
+        """Return whether a fixer of the tree may match in the unparsed
+        body leaf."""
+        found = self._scan_triggers(leaf.value)
+        pre_order, post_order = self._tree_fixers[:2]
+        for fixer in chain(pre_order, post_order):
+            triggers = self._get_triggers(fixer)
+            if triggers is None or not found.isdisjoint(triggers):
+                return True
+        return False
+
+    def _parse_body(self, leaf):
+        """Replace an unparsed body leaf by its statements; return them."""
+        tree = self._current_tree[0]
+        if "print_function" in getattr(tree, "future_features", ()):
+            self.driver.grammar = pygram.python_grammar_no_print_statement
+        recover = self.options["recover"]
+        try:
+            body = self.driver.parse_body(leaf.value, leaf.prev_sibling.value,
+                                          leaf.lineno, lazy=self._can_defer,
+                                          recover=recover)
+        finally:
+            self.driver.grammar = self.grammar
+        if recover:
+            self._log_parse_errors(body, self._current_tree[1])
+        new = body.children[:-1] # Drop the ENDMARKER
+        for node in new:
+            node.remove()
+        leaf.replace(new)
+        return new
+
+    def rematch(self, tree, nodes, pre_heads, post_heads):
+        """Offer code that transformations produced to the fixers again.
+
+        This is a helper method for refactor_tree().  The statements
+        containing nodes are parsed again (fixers build their replacements
+        by hand, and their patterns expect trees as the parser makes them),
+        traversed again, and then their ancestors are offered to the pre-
+        and post-order fixers, deepest first.  The rest of the tree is not
+        visited.
+        """
+        stmts = {}
+        for node in nodes:
+            if _is_in_tree(node, tree):
+                stmt = _get_statement(node)
+                stmts[id(stmt)] = stmt
+        ancestors = {}
+        for stmt in stmts.values():
+            if any(id(parent) in stmts for parent in _ancestors(stmt)):
+                continue
+            new = self._reparse_statement(stmt, tree)
+            if not new:
+                continue
+            parents = list(_ancestors(new[0]))
+            for depth, parent in enumerate(reversed(parents)):
+                ancestors[id(parent)] = (depth, parent)
+            for node in new:
+                self.traverse_tree(node, pre_heads, post_heads)
+        for depth, node in sorted(ancestors.itervalues(), reverse=True,
+                                  key=operator.itemgetter(0)):
+            if _is_in_tree(node, tree):
+                node = self._apply_fixers(pre_heads, node)
+                if node is not None:
+                    self._apply_fixers(post_heads, node)
+
+    def _reparse_statement(self, stmt, tree):
+        """Replace stmt by a fresh parse of its text.
+
+        Returns the list of new nodes; [stmt] if stmt is the whole tree, or
+        [] if its text doesn't parse on its own, and it is left alone (and
+        not offered to the fixers again).
+        """
+        if stmt is tree:
+            return [stmt]
+        text = unicode(stmt)
+        # A compound statement ends with the indentation of the next line,
+        # which the tokenizer would drop here; see _restore_tail().
+        tail = text[text.rfind(u"\n") + 1:]
+        if tail.strip():
+            return []
+        text = text[:len(text) - len(tail)]
+        if "print_function" in getattr(tree, "future_features", ()):
+            self.driver.grammar = pygram.python_grammar_no_print_statement
+        try:
+            fragment = self.driver.parse_fragment(text)
+        except (parse.ParseError, tokenize.TokenError,
+                IndentationError), err:
+            self.log_debug("Can't parse changed code again: %s: %s",
+                           err.__class__.__name__, err)
+            return []
+        finally:
+            self.driver.grammar = self.grammar
+        new = fragment.children[:-1] # Drop the ENDMARKER
+        if not new or u"".join(map(unicode, new)) != text:
+            return []
+        for node in new:
+            node.remove()
+        stmt.replace(new)
+        if tail:
+            _restore_tail(new, tail)
+        return new
+
     def traverse_by(self, fixers, traversal):
         """Traverse an AST, applying a set of fixers to each node.
 
-        This is a helper method for refactor_tree().
-
         Args:
             fixers: a list of fixer instances.
             traversal: a generator that yields AST nodes.
@@ -409,13 +1888,48 @@ class RefactoringTool(object):
         if not fixers:
             return
         for node in traversal:
-            for fixer in fixers[node.type]:
-                results = fixer.match(node)
-                if results:
-                    new = fixer.transform(node, results)
-                    if new is not None:
-                        node.replace(new)
-                        node = new
+            self._apply_fixers(fixers, node)
+
+    def _apply_fixers(self, fixers, node):
+        """Offer node to the fixers registered for its type.
+
+        Returns the node, or its replacement if a fixer replaced it; None
+        if a fixer replaced it by several nodes, or removed it.
+        """
+        for fixer in fixers[node.type]:
+            results = fixer.match(node)
+            if results:
+                parent = node.parent
+                if parent is not None:
+                    index = _child_index(node)
+                    siblings = len(parent.children)
+                worklist = self._worklist
+                if worklist is not None:
+                    old_text = unicode(node)
+                new = fixer.transform(node, results)
+                if new is not None:
+                    node.replace(new)
+                    node = new
+                if node.parent is None and parent is not None:
+                    # The fixer replaced the node itself; the later fixers
+                    # get what took its place, if that is one node.
+                    changed = parent
+                    if len(parent.children) == siblings:
+                        node = parent.children[index]
+                    else:
+                        node = None
+                else:
+                    changed = node
+                if worklist is not None and (changed is parent or
+                                             unicode(node) != old_text):
+                    worklist.append(changed)
+                if self._has_inactive_fixers():
+                    # The new code may trigger fixers that were left
+                    # out for this tree or not loaded yet.
+                    self._activate_in_tree(unicode(changed))
+                if node is None:
+                    break
+        return node
 
     def processed_file(self, new_text, filename, old_text=None, write=False,
                        encoding=None):
@@ -461,7 +1975,7 @@ class RefactoringTool(object):
     PS1 = ">>> "
     PS2 = "... "
 
-    def refactor_docstring(self, input, filename):
+    def refactor_docstring(self, input, filename, lines=None):
         """Refactors a docstring, looking for doctests.
 
         This returns a modified version of the input string.  It looks
@@ -472,6 +1986,9 @@ class RefactoringTool(object):
         (Unfortunately we can't use the doctest module's parser,
         since, like most parsers, it is not geared towards preserving
         the original source.)
+
+        With lines (as for refactor_tree()), only the code of the doctests
+        on those lines of input is refactored.
         """
         result = []
         block = None
@@ -483,7 +2000,8 @@ class RefactoringTool(object):
             if line.lstrip().startswith(self.PS1):
                 if block is not None:
                     result.extend(self.refactor_doctest(block, block_lineno,
-                                                        indent, filename))
+                                                        indent, filename,
+                                                        lines))
                 block_lineno = lineno
                 block = [line]
                 i = line.find(self.PS1)
@@ -495,16 +2013,17 @@ class RefactoringTool(object):
             else:
                 if block is not None:
                     result.extend(self.refactor_doctest(block, block_lineno,
-                                                        indent, filename))
+                                                        indent, filename,
+                                                        lines))
                 block = None
                 indent = None
                 result.append(line)
         if block is not None:
             result.extend(self.refactor_doctest(block, block_lineno,
-                                                indent, filename))
+                                                indent, filename, lines))
         return u"".join(result)
 
-    def refactor_doctest(self, block, lineno, indent, filename):
+    def refactor_doctest(self, block, lineno, indent, filename, lines=None):
         """Refactors one doctest.
 
         A doctest is given as a block of lines, the first of which starts
@@ -512,6 +2031,7 @@ class RefactoringTool(object):
         with "..." (identically indented).
 
         """
+        self.activate_fixers(u"".join(block))
         try:
             tree = self.parse_block(block, lineno, indent)
         except Exception, err:
@@ -521,7 +2041,7 @@ class RefactoringTool(object):
             self.log_error("Can't parse docstring in %s line %s: %s: %s",
                            filename, lineno, err.__class__.__name__, err)
             return block
-        if self.refactor_tree(tree, filename):
+        if self.refactor_tree(tree, filename, lines):
             new = unicode(tree).splitlines(True)
             # Undo the adjustment of the line numbers in wrap_toks() below.
             clipped, new = new[:lineno-1], new[lineno-1:]
@@ -534,26 +2054,29 @@ class RefactoringTool(object):
         return block
 
     def summarize(self):
+        self._summarize(self.files, self.fixer_log, self.errors)
+
+    def _summarize(self, files, messages, errors):
         if self.wrote:
             were = "were"
         else:
             were = "need to be"
-        if not self.files:
+        if not files:
             self.log_message("No files %s modified.", were)
         else:
             self.log_message("Files that %s modified:", were)
-            for file in self.files:
+            for file in files:
                 self.log_message(file)
-        if self.fixer_log:
+        if messages:
             self.log_message("Warnings/messages while refactoring:")
-            for message in self.fixer_log:
+            for message in messages:
                 self.log_message(message)
-        if self.errors:
-            if len(self.errors) == 1:
+        if errors:
+            if len(errors) == 1:
                 self.log_message("There was 1 error:")
             else:
-                self.log_message("There were %d errors:", len(self.errors))
-            for msg, args, kwds in self.errors:
+                self.log_message("There were %d errors:", len(errors))
+            for msg, args, kwds in errors:
                 self.log_message(msg, *args, **kwds)
 
     def parse_block(self, block, lineno, indent):
@@ -598,60 +2121,1148 @@ class RefactoringTool(object):
             yield ""
 
 
+class EditSession(object):
+
+    """Refactors a text as it is edited, parsing and refactoring again only
+    the statements the edits change.  For editors:
+
+        session = EditSession(tool, text, "buffer.py")
+        fixes = session.fixes # For the whole text
+        fixes = session.edit(offset, old_length, new_text)
+
+    An edit replaces the old_length characters of the text from offset on
+    by new_text.  The smallest statement around it that still parses on
+    its own, at the same indentation, is parsed again and the rest of the
+    tree is kept; failing that, the whole text is parsed again.  (The line
+    numbers of the leaves after an edit aren't brought up to date.)
+
+    Fixes are edits of the same form, one for each statement the fixers
+    would change; edit() returns those in the statements it parsed again.
+    The fixers work on copies, so that tree stays the tree of text.  If a
+    fixer that looks beyond its statement (see needs_whole_tree()) may
+    match there, a copy of the whole tree is refactored instead, and the
+    fixes are those for the whole text.
+    """
+
+    def __init__(self, tool, text, name):
+        self.tool = tool
+        self.name = name
+        self.text = text
+        self.tree = None # None while text doesn't parse
+        self.fixes = self._parse()
+
+    def edit(self, offset, old_length, new_text):
+        """Apply an edit to text; return the fixes for the code it changed,
+        or None if the text doesn't parse."""
+        end = offset + old_length
+        old = unicode(self.tree) if self.tree is not None else None
+        self.text = self.text[:offset] + new_text + self.text[end:]
+        if old is None:
+            return self._parse()
+        for stmt, start, length in _statements_around(self.tree, offset, end):
+            stmt_text = old[start:start + length]
+            if u"__future__" in stmt_text:
+                break
+            new = (stmt_text[:offset - start] + new_text +
+                   stmt_text[end - start:])
+            new_stmts = self._reparse(stmt, stmt_text, new, old, start)
+            if new_stmts is not None:
+                return self._refactor(new_stmts, start)
+        return self._parse()
+
+    def _parse(self):
+        # Parse the whole text; return the fixes for it.
+        self.tree = None
+        data = self.text + u"\n" # As refactor_file() does
+        tokens = tokenize.generate_tokens(driver.generate_lines(data).next)
+        features, tokens = driver.detect_future_features(tokens)
+        tool = self.tool
+        if "print_function" in features:
+            tool.driver.grammar = pygram.python_grammar_no_print_statement
+        try:
+            tree = tool.driver.parse_tokens(tokens)
+        except (parse.ParseError, tokenize.TokenError,
+                IndentationError), err:
+            tool.log_error("Can't parse %s: %s: %s",
+                           self.name, err.__class__.__name__, err)
+            return None
+        finally:
+            tool.driver.grammar = tool.grammar
+        tree.future_features = features
+        self.tree = tree
+        return self._refactor_tree()
+
+    def _reparse(self, stmt, stmt_text, new, old, start):
+        # Put the statements of new, the text of stmt after the edit, in its
+        # place; return them, or None if they don't parse as they would in
+        # the whole text.
+        if u"__future__" in new:
+            return None
+        # A compound statement ends with the indentation of the next line,
+        # which the tokenizer would drop here.
+        tail = new[new.rfind(u"\n") + 1:]
+        if tail.strip() or tail != stmt_text[stmt_text.rfind(u"\n") + 1:]:
+            return None
+        new = new[:len(new) - len(tail)]
+        # The indentation before stmt on its line, if it isn't stmt's own.
+        indent = old[old.rfind(u"\n", 0, start) + 1:start]
+        if indent.strip():
+            return None
+        position = start + len(_first_leaf(stmt).prefix)
+        column = position - (old.rfind(u"\n", 0, position) + 1)
+        tool = self.tool
+        if "print_function" in self.tree.future_features:
+            tool.driver.grammar = pygram.python_grammar_no_print_statement
+        try:
+            body = tool.driver.parse_body(new, indent,
+                                          old.count(u"\n", 0, start) + 1)
+        except (parse.ParseError, tokenize.TokenError, IndentationError):
+            return None
+        finally:
+            tool.driver.grammar = tool.grammar
+        new_stmts = body.children[:-1] # Drop the ENDMARKER
+        # Statements that moved out of a suite would be in the wrong place.
+        if not new_stmts or body.children[-1].prefix or any(
+                _first_leaf(node).column != column for node in new_stmts):
+            return None
+        for node in new_stmts:
+            node.remove()
+        stmt.replace(new_stmts)
+        self.tree.used_names.update(body.used_names)
+        if tail:
+            _restore_tail(new_stmts, tail)
+        return new_stmts
+
+    def _refactor(self, stmts, start):
+        # Return the fixes for stmts, which start at offset start.
+        text = u"".join(map(unicode, stmts))
+        tool = self.tool
+        tool.activate_fixers(text)
+        found = tool._scan_triggers(text)
+        for fixer in chain(tool.pre_order, tool.post_order):
+            if tool._may_match(fixer, found) and needs_whole_tree(fixer):
+                return self._refactor_tree()
+        copies = [node.clone() for node in stmts]
+        tree = pytree.Node(pygram.python_symbols.file_input,
+                           copies + [pytree.Leaf(token.ENDMARKER, u"")])
+        tree.future_features = self.tree.future_features
+        tree.used_names = self.tree.used_names
+        tool.refactor_tree(tree, self.name)
+        return self._get_fixes(stmts, tree.children[:-1], start)
+
+    def _refactor_tree(self):
+        # Return the fixes for the whole text.
+        tool = self.tool
+        tool.activate_fixers(self.text)
+        tree = self.tree.clone()
+        tree.future_features = self.tree.future_features
+        tree.used_names = self.tree.used_names
+        tool.refactor_tree(tree, self.name)
+        return self._get_fixes(self.tree.children, tree.children, 0)
+
+    def _get_fixes(self, old_nodes, new_nodes, start):
+        old_texts = map(unicode, old_nodes)
+        new_texts = map(unicode, new_nodes)
+        if len(old_texts) != len(new_texts):
+            # A statement came or went; make it one fix.
+            old_texts = [u"".join(old_texts)]
+            new_texts = [u"".join(new_texts)]
+        fixes = []
+        for old, new in zip(old_texts, new_texts):
+            if new != old:
+                fixes.append((start, len(old), new))
+            start += len(old)
+        # Take off the \n that _parse() added, if a fix has it.
+        if fixes:
+            start, length, new = fixes[-1]
+            if start + length > len(self.text):
+                fixes[-1] = (start, length - 1, new[:-1])
+        return fixes
+
+
 class MultiprocessingUnsupported(Exception):
     pass
 
 
+class WorkerError(Exception):
+    """A worker process failed to refactor a file."""
+
+
+class FileResult(collections.namedtuple("FileResult",
+        "filename output messages errors time exception")):
+    """What a worker process reports back about one file or string.
+
+    For a file, output is None if the file needs no changes, and else the
+    arguments for processed_file(): (new_text, old_text, write, encoding),
+    or for a file that was streamed, those for processed_stream().
+    For a string, it is the new text, or None if it couldn't be parsed.
+    messages and errors are the fixer_log and errors entries the file
+    produced, time is the number of seconds it took and exception the
+    formatted traceback of an unexpected exception, or None.
+    """
+    __slots__ = ()
+
+
+class _Streamed(collections.namedtuple("_Streamed", "regions wrote")):
+    # The output of a file that a worker refactored with refactor_stream(),
+    # which has already written it: the arguments of its processed_chunk()
+    # calls (but filename) for the parent to print, and wrote, or None if
+    # it never got to processed_stream().
+    __slots__ = ()
+
+
+def _format_error(msg, args):
+    # Errors are sent to the parent preformatted, as their arguments (often
+    # exceptions) can't always be pickled.
+    if args:
+        msg = msg % args
+    return "%s", (msg,)
+
+
+def _get_rss():
+    """Return the resident set size of this process in bytes, or None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Not Linux; make do with the peak, in kilobytes on most systems.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SummarySpool(object):
+
+    """Keeps the entries of a summary in a temporary file.
+
+    Entries are added by kind ("files", "messages" or "errors") and read
+    back in order by get(), so a run's memory use doesn't grow with the
+    number of files it refactors.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.counts = collections.defaultdict(int)
+
+    def add(self, kind, entries):
+        self.file.seek(0, 2)
+        for entry in entries:
+            cPickle.dump((kind, entry), self.file, cPickle.HIGHEST_PROTOCOL)
+            self.counts[kind] += 1
+
+    def count(self, kind):
+        return self.counts[kind]
+
+    def get(self, kind):
+        """Return the entries of a kind, as a sized iterable."""
+        return _SpooledEntries(self, kind)
+
+    def _iter(self, kind):
+        self.file.seek(0)
+        while True:
+            try:
+                entry_kind, entry = cPickle.load(self.file)
+            except EOFError:
+                return
+            if entry_kind == kind:
+                yield entry
+
+    def close(self):
+        self.file.close()
+
+
+class _SpooledEntries(object):
+
+    def __init__(self, spool, kind):
+        self.spool = spool
+        self.kind = kind
+
+    def __len__(self):
+        return self.spool.count(self.kind)
+
+    def __iter__(self):
+        return self.spool._iter(self.kind)
+
+
+def _module_source(name):
+    """Return the contents of the file module name is loaded from, or ""
+    if it can't be found."""
+    try:
+        loader = pkgutil.find_loader(name)
+        filename = loader.get_filename(name)
+        with open(filename, "rb") as f:
+            return f.read()
+    except (ImportError, AttributeError, IOError):
+        return ""
+
+
+def _grammar_source():
+    """Return the contents of Grammar.txt."""
+    with open(pygram._GRAMMAR_FILE, "rb") as f:
+        return f.read()
+
+
+def _fixer_modules(path):
+    """Return the fixer module path and the modules of its package it
+    uses (directly or not), such as fix_imports for fix_imports2, sorted.
+
+    That is judged by the globals of the modules, so path is imported.
+    """
+    package = path.rpartition(".")[0] + "."
+    found = set()
+    pending = [path]
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        try:
+            module = __import__(name, {}, {}, ["*"])
+        except ImportError:
+            continue
+        for value in vars(module).itervalues():
+            if isinstance(value, types.ModuleType):
+                used = value.__name__
+            else:
+                used = getattr(value, "__module__", None)
+            if isinstance(used, str) and used.startswith(package):
+                pending.append(used)
+    return sorted(found)
+
+
+class ResultCache(object):
+
+    """Keeps the results of refactoring files in a directory, by key.
+
+    A result is a JSON object, written to a temporary file and renamed
+    into place, so that any number of processes (and runs) can share the
+    directory.  Results that can't be read or written are taken to be
+    missing.
+    """
+
+    SUFFIX = ".json" # Of the files results are kept in
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + self.SUFFIX)
+
+    def get(self, key):
+        """Return the result stored under key, or None."""
+        try:
+            with open(self._path(key), "rb") as f:
+                return self.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, result):
+        """Store result under key."""
+        path = self._path(key)
+        temp = None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except os.error:
+                    # Another process may have made it.
+                    if not os.path.isdir(os.path.dirname(path)):
+                        raise
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                self.dump(result, f)
+            os.rename(temp, path)
+            temp = None
+        except (IOError, os.error):
+            pass
+        finally:
+            if temp is not None:
+                os.remove(temp)
+
+    def load(self, f):
+        """Read a result from the file f; raise ValueError if it isn't
+        one."""
+        return json.load(f)
+
+    def dump(self, result, f):
+        """Write result to the file f."""
+        json.dump(result, f)
+
+
+class TreeCache(ResultCache):
+
+    """Keeps parse trees, as pytree.dump_tree() serializes them, by key.
+
+    Loading a tree takes a fraction of the time parsing its code does.
+    """
+
+    SUFFIX = ".tree"
+
+    def load(self, f):
+        return pytree.load_tree(f.read())
+
+    def dump(self, tree, f):
+        f.write(pytree.dump_tree(tree))
+
+
+def _task_filename(args, kwargs):
+    return args[0] if args else kwargs["filename"]
+
+
+def _task_name(method, args, kwargs):
+    if method != "refactor_file":
+        return args[1]
+    return _task_filename(args, kwargs)
+
+
+def _file_task(filename, write=False, doctests_only=False):
+    # The arguments of a refactor_file() call.
+    return filename, write, doctests_only
+
+
+class _SplitFile(object):
+
+    """A file being refactored in chunks; see the split_size option."""
+
+    def __init__(self, chunks, old_text, write, encoding):
+        self.chunks = chunks
+        self.outputs = [None] * len(chunks)
+        self.remaining = len(chunks)
+        self.old_text = old_text
+        self.write = write
+        self.encoding = encoding
+        self.time = 0.0
+        self.failed = False
+
+    def get_output(self):
+        """Return the new text, or None if there are no changes."""
+        if self.failed or self.outputs.count(None) == len(self.outputs):
+            return None
+        return u"".join(chunk if output is None else output
+                        for chunk, output in zip(self.chunks, self.outputs))
+
+
+class _TimeLimitExceeded(BaseException):
+    # Not an Exception, so that nothing on the way catches it.
+    pass
+
+
+def _on_time_limit(signum, frame):
+    """SIGALRM handler for the time_limit option."""
+    code = RefactoringTool._apply_fixers.im_func.func_code
+    while frame is not None and frame.f_code is not code:
+        frame = frame.f_back
+    if frame is None:
+        raise _TimeLimitExceeded("")
+    # Before the first fixer, or once a fixer has done away with the node,
+    # there is less to tell.
+    fixer = frame.f_locals.get("fixer")
+    node = frame.f_locals.get("node")
+    where = []
+    if fixer is not None:
+        where.append("in %s" % (fixer.__class__.__name__,))
+    if node is not None:
+        if node.type < 256:
+            node_type = token.tok_name[node.type]
+        else:
+            node_type = pytree.type_repr(node.type)
+        where.append("on a %s node at line %s" % (node_type,
+                                                  node.get_lineno()))
+    if where:
+        raise _TimeLimitExceeded(" (%s)" % " ".join(where))
+    raise _TimeLimitExceeded("")
+
+
+class WorkerPool(object):
+
+    """Worker processes doing the work of a MultiprocessRefactoringTool.
+
+    The workers are forked from the tool when the pool is created, so they
+    start out with its fixers and grammars loaded.  The pool can be used by
+    any number of refactor() and refactor_strings() calls, one at a time,
+    until shutdown() is called.
+
+    With the tool's time_limit option, a worker abandons a task that takes
+    longer, reports it as an error and is replaced by a fresh worker.  A
+    worker that doesn't manage to (or dies) is killed WATCHDOG_GRACE
+    seconds later and replaced, and the tasks it had taken are handed out
+    again.  Workers are also replaced after the number of tasks or the
+    amount of memory set by the max_worker_tasks and max_worker_memory
+    options.
+    """
+
+    WATCHDOG_GRACE = 10 # Seconds
+
+    def __init__(self, tool, num_processes):
+        try:
+            import multiprocessing
+        except ImportError:
+            raise MultiprocessingUnsupported
+        self._multiprocessing = multiprocessing
+        self.tool = tool
+        self.num_processes = num_processes
+        self.time_limit = tool.options["time_limit"]
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.closed = False
+        self.pending = {} # Task id -> task, for tasks not done yet
+        self.processes = []
+        self._held = {} # Worker pid -> ids of the tasks it has taken
+        self._started = {} # Worker pid -> (task id, start time)
+        self._ids = count()
+        self._last_id = -1
+        # Workers skip the tasks with ids up to this; see run().
+        self._cancelled = multiprocessing.Value("l", -1)
+        for i in xrange(num_processes):
+            self._start_worker()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def _start_worker(self):
+        p = self._multiprocessing.Process(
+            target=self.tool._child,
+            args=(self.tasks, self.results, self._cancelled))
+        p.start()
+        self.processes.append(p)
+
+    def run(self, batches, handle_result):
+        """Have the workers do batches of tasks.
+
+        A task is a (key, method, args, kwargs) tuple, asking for
+        method(*args, **kwargs) of the tool to be called.  Blocks until
+        all tasks are done, calling handle_result(key, result) with the
+        FileResult of each task as it comes in.
+
+        If handle_result raises an exception, the rest of the tasks are
+        cancelled: the workers skip those they haven't started, and the
+        results of the others are dropped.  Once the workers are done
+        with them, the exception is raised again; the pool can go on
+        being used.  Other exceptions (such as KeyboardInterrupt) shut the
+        pool down.
+        """
+        if self.closed:
+            raise RuntimeError("the worker pool has been shut down")
+        if self.pending:
+            raise RuntimeError("already doing multiple processes")
+        failure = []
+        def deliver(key, result):
+            if failure:
+                return
+            try:
+                handle_result(key, result)
+            except Exception:
+                failure.append(sys.exc_info())
+                self._cancelled.value = self._last_id
+        try:
+            for batch in batches:
+                self._put([self._add_task(task) for task in batch])
+            while self.pending:
+                try:
+                    message = self.results.get(True, 0.1)
+                except Queue.Empty:
+                    self._watch(deliver)
+                    continue
+                kind, pid = message[:2]
+                if kind == "exit":
+                    for p in self.processes[:]:
+                        if p.pid == pid:
+                            self._replace_worker(p, "exited", deliver)
+                elif kind == "take":
+                    self._held[pid] = list(message[2])
+                elif kind == "start":
+                    self._started[pid] = (message[2], time.time())
+                else:
+                    task_id, result = message[2:]
+                    self._started.pop(pid, None)
+                    if task_id in self._held.get(pid, ()):
+                        self._held[pid].remove(task_id)
+                    if task_id in self.pending:
+                        key = self.pending.pop(task_id)[0]
+                        if result is not None: # Else skipped
+                            deliver(key, result)
+        finally:
+            if self.pending:
+                # We're bailing out; don't wait for the remaining tasks.
+                self.shutdown()
+        if failure:
+            exc_type, exc_value, exc_tb = failure[0]
+            raise exc_type, exc_value, exc_tb
+
+    def _add_task(self, task):
+        task_id = self._last_id = next(self._ids)
+        self.pending[task_id] = task
+        return task_id
+
+    def _put(self, task_ids):
+        if task_ids:
+            self.tasks.put([(task_id,) + self.pending[task_id][1:]
+                            for task_id in task_ids])
+
+    def _watch(self, handle_result):
+        """Replace workers that have exited or are stuck."""
+        for p in self.processes[:]:
+            if p.exitcode is not None:
+                # Workers exit by themselves after exceeding the time limit.
+                reason = "exited with code %s" % (p.exitcode,)
+            elif self.time_limit is not None and p.pid in self._started:
+                task_id, start = self._started[p.pid]
+                elapsed = time.time() - start
+                if elapsed < self.time_limit + self.WATCHDOG_GRACE:
+                    continue
+                p.terminate()
+                reason = "was killed after %.1f seconds" % (elapsed,)
+            else:
+                continue
+            self._replace_worker(p, reason, handle_result)
+
+    def _replace_worker(self, p, reason, handle_result):
+        """Start a new worker instead of p, which has exited or is being
+        killed, and hand out the tasks p hasn't done again.
+
+        The task p was working on, if any, is reported as failed.
+        """
+        p.join()
+        self.processes.remove(p)
+        held = self._held.pop(p.pid, [])
+        if p.pid in self._started:
+            task_id, start = self._started.pop(p.pid)
+            held.remove(task_id)
+            key, method, args, kwargs = self.pending.pop(task_id)
+            name = _task_name(method, args, kwargs)
+            error = _format_error("A worker %s while refactoring %s",
+                                  (reason, name))
+            handle_result(key, FileResult(name, None, [], [error + ({},)],
+                                          time.time() - start, None))
+        self._put([task_id for task_id in held if task_id in self.pending])
+        self._start_worker()
+
+    def shutdown(self):
+        """Stop the workers.
+
+        Idle workers are asked to exit; if the pool is in the middle of
+        run(), they are terminated.  Calling this more than once is fine.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.pending:
+            for p in self.processes:
+                p.terminate()
+        else:
+            for p in self.processes:
+                self.tasks.put(None)
+        for p in self.processes:
+            p.join()
+
+
 class MultiprocessRefactoringTool(RefactoringTool):
 
+    # With the timings_file option, the seconds each file took are kept in
+    # that file (as JSON) to schedule the next runs; see estimate_cost().
+    # With the time_limit option, workers give up on files that take more
+    # than that many seconds; with max_worker_tasks and max_worker_memory
+    # (in megabytes), they are replaced after that many files or once they
+    # use that much memory; see WorkerPool.  With spool_summary, the files,
+    # messages and errors for summarize() are kept in a SummarySpool
+    # rather than in memory.  With split_size, files of at least that many
+    # bytes are refactored in chunks of top-level statements, in parallel,
+    # unless some fixer that may apply needs the whole tree (see
+    # needs_whole_tree()); see split_file().
+    _default_options = dict(RefactoringTool._default_options,
+                            timings_file=None, time_limit=None,
+                            max_worker_tasks=None, max_worker_memory=None,
+                            spool_summary=False, split_size=None)
+
+    BATCH_SIZE = 4 # The most files sent to a worker at once
+    SECONDS_PER_BYTE = 2e-5 # Cost estimate for files without timings
+
     def __init__(self, *args, **kwargs):
         super(MultiprocessRefactoringTool, self).__init__(*args, **kwargs)
-        self.queue = None
-        self.output_lock = None
+        self.pool = None
+        self.timings = {} # Seconds spent on each file
+        self._tasks = None
+        self._splits = {} # Filename -> _SplitFile, see split_file()
+        self._output = None # Set in worker processes, see processed_file()
+        self._regions = None # Likewise, see processed_chunk()
+        self._known_timings = None
+        self._seconds_per_byte = self.SECONDS_PER_BYTE
+        if self.options["spool_summary"]:
+            self.summary = SummarySpool()
+        else:
+            self.summary = None
 
-    def refactor(self, items, write=False, doctests_only=False,
-                 num_processes=1):
+    def start_pool(self, num_processes):
+        """Start a WorkerPool that later calls of refactor() and
+        refactor_strings() use, whatever their num_processes.
+
+        Returns the pool; stop it with shutdown_pool() (or its shutdown()).
+        """
+        if self.pool is not None and not self.pool.closed:
+            raise RuntimeError("a worker pool is already running")
+        self.pool = WorkerPool(self, num_processes)
+        return self.pool
+
+    def shutdown_pool(self):
+        """Stop the pool started by start_pool(), if any."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def _get_pool(self, num_processes):
+        """Return (pool, whether it was started for this call only)."""
+        if self.pool is not None and not self.pool.closed:
+            return self.pool, False
         if num_processes == 1:
-            return super(MultiprocessRefactoringTool, self).refactor(
-                items, write, doctests_only)
+            return None, False
+        return WorkerPool(self, num_processes), True
+
+    def refactor(self, items, write=False, doctests_only=False,
+                 num_processes=1, shard=None):
+        if self._tasks is not None:
+            raise RuntimeError("already doing multiple processes")
+        self.load_timings()
+        pool, temporary = self._get_pool(num_processes)
+        if pool is None:
+            super(MultiprocessRefactoringTool, self).refactor(
+                items, write, doctests_only, shard)
+            self.save_timings()
+            return
         try:
-            import multiprocessing
-        except ImportError:
-            raise MultiprocessingUnsupported
-        if self.queue is not None:
+            tasks = self.collect_tasks(items, write, doctests_only, shard)
+            if self.options["split_size"]:
+                batches = self._split_batches(tasks, pool.num_processes)
+            else:
+                batches = ([(None, "refactor_file", args, kwargs)
+                            for args, kwargs in batch]
+                           for batch in self.schedule(tasks,
+                                                      pool.num_processes))
+            pool.run(batches, self._handle_task_result)
+        finally:
+            self._splits.clear()
+            if temporary:
+                pool.shutdown()
+        self.save_timings()
+
+    def collect_tasks(self, items, write=False, doctests_only=False,
+                      shard=None):
+        """Return the refactor_file() calls refactor() would make, as a
+        list of (args, kwargs) pairs, without making them."""
+        if self._tasks is not None:
             raise RuntimeError("already doing multiple processes")
-        self.queue = multiprocessing.JoinableQueue()
-        self.output_lock = multiprocessing.Lock()
-        processes = [multiprocessing.Process(target=self._child)
-                     for i in xrange(num_processes)]
-        try:
-            for p in processes:
-                p.start()
-            super(MultiprocessRefactoringTool, self).refactor(items, write,
-                                                              doctests_only)
+        self._tasks = []
+        try:
+            super(MultiprocessRefactoringTool, self).refactor(
+                items, write, doctests_only, shard)
+            return self._tasks
+        finally:
+            self._tasks = None
+
+    def refactor_strings(self, sources, num_processes=1):
+        """Refactor a list of (data, name) pairs, as refactor_string()
+        would, in a worker pool if there is one or num_processes > 1.
+
+        Returns a list with the new text of each, or None for those that
+        couldn't be parsed.  Messages and errors are recorded as usual.
+        """
+        pool, temporary = self._get_pool(num_processes)
+        if pool is None:
+            new_texts = []
+            for data, name in sources:
+                tree = self.refactor_string(data, name)
+                new_texts.append(unicode(tree) if tree is not None else None)
+            return new_texts
+        new_texts = [None] * len(sources)
+        def handle_result(i, result):
+            self._merge_result(result)
+            self.flush_summary()
+            new_texts[i] = result.output
+        tasks = [(i, "refactor_string", source, {})
+                 for i, source in enumerate(sources)]
+        costs = [len(data) * self._seconds_per_byte for data, name in sources]
+        try:
+            pool.run(self._batches(tasks, costs, pool.num_processes),
+                     handle_result)
         finally:
-            self.queue.join()
-            for i in xrange(num_processes):
-                self.queue.put(None)
-            for p in processes:
-                if p.is_alive():
-                    p.join()
-            self.queue = None
-
-    def _child(self):
-        task = self.queue.get()
-        while task is not None:
-            args, kwargs = task
+            if temporary:
+                pool.shutdown()
+        return new_texts
+
+    def schedule(self, tasks, num_processes):
+        """Split the refactor_file() calls in tasks into batches.
+
+        The most expensive files (see estimate_cost()) come first, so no
+        worker is left with a big file at the end while the others idle.
+        Batches are sized to take about half of each worker's share of the
+        remaining work, up to BATCH_SIZE files, so they get smaller towards
+        the end; as idle workers take the next batch from the shared queue,
+        the tail is spread over all of them.
+        """
+        costs = [self.estimate_cost(_task_filename(*task)) for task in tasks]
+        return self._batches(tasks, costs, num_processes)
+
+    def _batches(self, tasks, costs, num_processes):
+        order = sorted(xrange(len(tasks)), key=costs.__getitem__,
+                       reverse=True)
+        remaining = sum(costs)
+        batch = []
+        batch_cost = 0
+        for i in order:
+            batch.append(tasks[i])
+            batch_cost += costs[i]
+            if (len(batch) == self.BATCH_SIZE or
+                batch_cost >= remaining / (2 * num_processes)):
+                yield batch
+                remaining -= batch_cost
+                batch = []
+                batch_cost = 0
+        if batch:
+            yield batch
+
+    def _split_batches(self, tasks, num_processes):
+        # Like schedule(), but with big files split into chunks.
+        entries = []
+        costs = []
+        for args, kwargs in tasks:
+            filename = _task_filename(args, kwargs)
+            cost = self.estimate_cost(filename)
+            chunks = self.split_file(num_processes, *args, **kwargs)
+            if chunks is None:
+                entries.append((None, "refactor_file", args, kwargs))
+                costs.append(cost)
+                continue
+            size = sum(len(chunk[2][0]) for chunk in chunks)
+            for chunk in chunks:
+                entries.append(chunk)
+                costs.append(cost * len(chunk[2][0]) / max(size, 1))
+        return self._batches(entries, costs, num_processes)
+
+    def split_file(self, num_processes, filename, write=False,
+                   doctests_only=False):
+        """Split a file into chunks for workers to refactor in parallel.
+
+        Returns a list of pool tasks (key, "refactor_chunk", args, kwargs),
+        or None if the file should be refactored as a whole: because it is
+        smaller than the split_size option, is to be streamed (see the
+        stream_size option), has doctests_only set, has only one top-level
+        statement, or might be changed by a fixer that needs the whole
+        tree.
+        """
+        split_size = self.options["split_size"]
+        if (doctests_only or filename in self._splits or
+                self._should_stream(filename)):
+            return None
+        try:
+            if os.path.getsize(filename) < split_size:
+                return None
+        except os.error:
+            return None
+        input, encoding = self._read_python_source(filename)
+        if input is None:
+            return []
+        if not self.could_match(input):
+            self.log_debug("No fixer triggers in %s", filename)
+            return []
+        self.activate_fixers(input)
+        found = self._scan_triggers(input)
+        for fixer in chain(self.pre_order, self.post_order):
+            if self._may_match(fixer, found) and needs_whole_tree(fixer):
+                self.log_debug("Not splitting %s, for %s", filename,
+                               fixer.__class__.__name__)
+                return None
+        chunk_size = max(split_size // 2, len(input) // (2 * num_processes))
+        chunks = _split_module(input, chunk_size)
+        if chunks is None or len(chunks) < 2:
+            return None
+        self.log_debug("Splitting %s into %d chunks", filename, len(chunks))
+        features = _detect_future_features(input)
+        self._splits[filename] = _SplitFile([text for lineno, text in chunks],
+                                            input, write, encoding)
+        return [((filename, i), "refactor_chunk",
+                 (text, filename, lineno, features), {})
+                for i, (lineno, text) in enumerate(chunks)]
+
+    def estimate_cost(self, filename):
+        """Return the expected number of seconds refactoring filename takes.
+
+        This is the time it took in a previous run if the timings_file
+        option is set and has it, and else based on the file's size.
+        """
+        path = os.path.abspath(filename)
+        if self._known_timings and path in self._known_timings:
+            return self._known_timings[path]
+        try:
+            size = os.path.getsize(filename)
+        except os.error:
+            size = 0
+        return size * self._seconds_per_byte
+
+    def load_timings(self):
+        """Read the timings_file option's file, if any."""
+        filename = self.options["timings_file"]
+        self._known_timings = {}
+        if filename is None or not os.path.exists(filename):
+            return
+        try:
+            with open(filename, "rb") as f:
+                timings = json.load(f)
+        except (IOError, ValueError), err:
+            self.log_message("Can't read timings from %s: %s", filename, err)
+            return
+        self._known_timings = timings
+        # Scale the estimates for new files like the known ones.
+        seconds = size = 0
+        for path, elapsed in timings.iteritems():
             try:
-                super(MultiprocessRefactoringTool, self).refactor_file(
-                    *args, **kwargs)
+                size += os.path.getsize(path)
+            except os.error:
+                continue
+            seconds += elapsed
+        if seconds and size:
+            self._seconds_per_byte = seconds / size
+
+    def save_timings(self):
+        """Add this run's timings to the timings_file option's file."""
+        filename = self.options["timings_file"]
+        if filename is None or not self.timings:
+            return
+        timings = dict((path, elapsed) for path, elapsed
+                       in (self._known_timings or {}).iteritems()
+                       if os.path.exists(path))
+        for name, elapsed in self.timings.iteritems():
+            timings[os.path.abspath(name)] = elapsed
+        temp = filename + ".tmp"
+        try:
+            with open(temp, "wb") as f:
+                json.dump(timings, f)
+            os.rename(temp, filename)
+        except (IOError, os.error), err:
+            self.log_message("Can't write timings to %s: %s", filename, err)
+
+    def _merge_result(self, result):
+        self.fixer_log.extend(result.messages)
+        self.errors.extend(result.errors)
+        if result.exception is not None:
+            raise WorkerError("Can't refactor %s:\n%s" %
+                              (result.filename, result.exception))
+
+    def handle_result(self, result):
+        """Merge the FileResult of a file from a worker into this tool's
+        state."""
+        self._record_time(result.filename, result.time)
+        self._merge_result(result)
+        if isinstance(result.output, _Streamed):
+            for region in result.output.regions:
+                old_text, new_text, old_lineno, new_lineno, first = region
+                self.print_chunk_output(old_text, new_text, result.filename,
+                                        old_lineno, new_lineno, first)
+            if result.output.wrote is not None:
+                super(MultiprocessRefactoringTool, self).processed_stream(
+                    result.filename, result.output.wrote)
+        elif result.output is not None:
+            new_text, old_text, write, encoding = result.output
+            super(MultiprocessRefactoringTool, self).processed_file(
+                new_text, result.filename, old_text, write, encoding)
+        self.flush_summary()
+
+    def _handle_task_result(self, key, result):
+        if key is None:
+            self.handle_result(result)
+        else:
+            self.handle_chunk_result(key, result)
+
+    def handle_chunk_result(self, key, result):
+        """Merge the FileResult of a chunk of a split file; once all of its
+        chunks are in, put the file together again.
+
+        Should a chunk have errors, the file is left alone, as it would be
+        if it had been refactored as a whole.
+        """
+        filename, index = key
+        split = self._splits[filename]
+        self._merge_result(result)
+        split.outputs[index] = result.output
+        split.time += result.time
+        split.failed = split.failed or bool(result.errors)
+        split.remaining -= 1
+        if not split.remaining:
+            del self._splits[filename]
+            self._record_time(filename, split.time)
+            new_text = split.get_output()
+            if new_text is not None:
+                super(MultiprocessRefactoringTool, self).processed_file(
+                    new_text, filename, split.old_text, split.write,
+                    split.encoding)
+            elif not split.failed:
+                self.log_debug("No changes in %s", filename)
+        self.flush_summary()
+
+    def _record_time(self, filename, elapsed):
+        # With a spooled summary, don't keep what isn't asked for either.
+        if self.summary is None or self.options["timings_file"]:
+            self.timings[filename] = elapsed
+
+    def flush_summary(self):
+        """Move files, fixer_log and errors to the summary spool, if any."""
+        if self.summary is None:
+            return
+        self.summary.add("files", self.files)
+        self.summary.add("messages", self.fixer_log)
+        self.summary.add("errors", [_format_error(msg, args) + (kwds,)
+                                    for msg, args, kwds in self.errors])
+        # The fixers hold on to fixer_log.
+        del self.files[:]
+        del self.fixer_log[:]
+        del self.errors[:]
+
+    def has_errors(self):
+        """Whether there were errors, including those in the spool."""
+        if self.summary is not None and self.summary.count("errors"):
+            return True
+        return bool(self.errors)
+
+    def get_summary(self):
+        """Return the files, messages and errors of the run so far."""
+        if self.summary is None:
+            return self.files, self.fixer_log, self.errors
+        self.flush_summary()
+        return (self.summary.get("files"), self.summary.get("messages"),
+                self.summary.get("errors"))
+
+    def summarize(self):
+        self._summarize(*self.get_summary())
+
+    def _child(self, tasks, results, cancelled):
+        pid = os.getpid()
+        time_limit = self.options["time_limit"]
+        if time_limit is not None:
+            signal.signal(signal.SIGALRM, _on_time_limit)
+        done = 0
+        batch = tasks.get()
+        while batch is not None:
+            results.put(("take", pid, [task[0] for task in batch]))
+            for task_id, method, args, kwargs in batch:
+                if task_id <= cancelled.value:
+                    # The pool dropped it; see WorkerPool.run().
+                    results.put(("done", pid, task_id, None))
+                    continue
+                results.put(("start", pid, task_id))
+                result, timed_out = self._run_task(method, args, kwargs,
+                                                   time_limit)
+                results.put(("done", pid, task_id, result))
+                done += 1
+                # After a time-out, who knows what state the fixers were
+                # left in.  Either way, the pool starts a fresh worker and
+                # hands out the rest of the batch again.
+                if timed_out or self._worker_is_spent(done):
+                    results.put(("exit", pid))
+                    return
+            batch = tasks.get()
+
+    def _worker_is_spent(self, done):
+        """Whether a worker that has done that many tasks should exit."""
+        max_tasks = self.options["max_worker_tasks"]
+        if max_tasks is not None and done >= max_tasks:
+            return True
+        max_memory = self.options["max_worker_memory"]
+        if max_memory is not None:
+            rss = _get_rss()
+            return rss is not None and rss > max_memory * 2**20
+        return False
+
+    def _run_task(self, method, args, kwargs, time_limit=None):
+        """Call a method of RefactoringTool in a worker process.
+
+        Returns a FileResult instead of reporting, and whether the task
+        was abandoned for taking longer than time_limit seconds.
+        """
+        name = _task_name(method, args, kwargs)
+        n_messages = len(self.fixer_log)
+        n_errors = len(self.errors)
+        self._output = []
+        self._regions = []
+        value = exception = None
+        timed_out = False
+        start = time.time()
+        try:
+            if time_limit is not None:
+                signal.setitimer(signal.ITIMER_REAL, time_limit)
+            try:
+                value = getattr(super(MultiprocessRefactoringTool, self),
+                                method)(*args, **kwargs)
             finally:
-                self.queue.task_done()
-            task = self.queue.get()
+                if time_limit is not None:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except _TimeLimitExceeded, err:
+            timed_out = True
+            self.errors.append(("Time limit of %g seconds exceeded "
+                                "refactoring %s%s", (time_limit, name, err),
+                                {}))
+        except Exception:
+            exception = traceback.format_exc()
+        elapsed = time.time() - start
+        messages = self.fixer_log[n_messages:]
+        errors = [_format_error(msg, msg_args) + (kwds,)
+                  for msg, msg_args, kwds in self.errors[n_errors:]]
+        # The parent keeps these; don't let them pile up here.
+        del self.fixer_log[n_messages:]
+        del self.errors[n_errors:]
+        if method == "refactor_file":
+            output = self._output[0] if self._output else None
+            if output is None and self._regions:
+                # Its stream stopped at a chunk that didn't parse.
+                output = _Streamed(self._regions, None)
+        elif method == "refactor_string":
+            output = unicode(value) if value is not None else None
+        else:
+            output = value
+        self._output = self._regions = None
+        return FileResult(name, output, messages, errors, elapsed,
+                          exception), timed_out
+
+    def processed_file(self, new_text, filename, old_text=None, write=False,
+                       encoding=None):
+        if self._output is not None:
+            # In a worker process, leave printing and writing to the parent.
+            self._output.append((new_text, old_text, write, encoding))
+        else:
+            super(MultiprocessRefactoringTool, self).processed_file(
+                new_text, filename, old_text, write, encoding)
+
+    def processed_chunk(self, old_text, new_text, filename, old_lineno,
+                        new_lineno, first):
+        if self._regions is not None:
+            # In a worker process; the parent prints them, in one piece.
+            self._regions.append((old_text, new_text, old_lineno,
+                                  new_lineno, first))
+        else:
+            super(MultiprocessRefactoringTool, self).processed_chunk(
+                old_text, new_text, filename, old_lineno, new_lineno, first)
+
+    def processed_stream(self, filename, wrote=False):
+        if self._output is not None:
+            self._output.append(_Streamed(self._regions, wrote))
+        else:
+            super(MultiprocessRefactoringTool, self).processed_stream(
+                filename, wrote)
 
     def refactor_file(self, *args, **kwargs):
-        if self.queue is not None:
-            self.queue.put((args, kwargs))
+        if self._tasks is not None:
+            # Files are handed out once they are all known; see refactor().
+            self._tasks.append((args, kwargs))
         else:
-            return super(MultiprocessRefactoringTool, self).refactor_file(
-                *args, **kwargs)
+            start = time.time()
+            try:
+                return super(MultiprocessRefactoringTool, self).refactor_file(
+                    *args, **kwargs)
+            finally:
+                self._record_time(_task_filename(args, kwargs),
+                                  time.time() - start)
+                self.flush_summary()
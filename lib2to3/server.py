@@ -0,0 +1,203 @@
+"""
+Refactoring server.
+
+Running 2to3 from an editor or a commit hook mostly costs startup: loading
+the grammars and importing and compiling the fixers.  The server (started
+with "2to3 --serve SOCKET") keeps refactoring tools warm between requests,
+one per fixer configuration, each with its own worker pool if -j is given.
+
+Clients (see lib2to3.client) connect to the Unix socket and send requests,
+one JSON object per line; each gets a JSON object on a line back.  A
+request looks like
+
+    {"fix": [], "nofix": [], "print_function": false,
+     "files": ["/abs/path.py"], "write": false, "nobackups": false,
+     "doctests_only": false, "show_diffs": true}
+
+or, to refactor source text instead of files,
+
+    {"source": "print 'hi'\\n", "name": "<stdin>", ...}
+
+and the response has "files" (the files that were processed), "diffs"
+(pairs of a file name and its diff, or null with show_diffs false),
+"messages" (the fixers' warnings), "errors", "wrote" and, for source
+requests, "output" (the new text, or null if it couldn't be parsed).  A
+request that fails altogether gets {"error": "..."}.  {"command":
+"shutdown"} stops the server.
+
+Each connection is served by a thread of its own, so that a client
+that keeps its connection open (an editor, say) doesn't hold up the
+others, but the requests themselves are handled one at a time.
+"""
+
+# Python imports
+import os
+import json
+import logging
+import threading
+import collections
+import SocketServer
+
+# Local imports
+from . import main
+
+
+class ServerRefactoringTool(main.StdoutRefactoringTool):
+    """
+    Keeps the output of a request for the response instead of printing it.
+    """
+
+    def __init__(self, fixers, options, explicit):
+        super(ServerRefactoringTool, self).__init__(fixers, options, explicit,
+                                                    False, True)
+        self.diffs = []
+
+    def reset(self, nobackups=False, show_diffs=True):
+        """Get ready for a new request."""
+        self.nobackups = nobackups
+        self.show_diffs = show_diffs
+        self.wrote = False
+        del self.files[:]
+        del self.errors[:]
+        # The fixers hold on to this list.
+        del self.fixer_log[:]
+        del self.diffs[:]
+
+    def print_output(self, old, new, filename, equal):
+        if equal:
+            return
+        if self.show_diffs:
+            diff = u"\n".join(main.diff_texts(old, new, filename))
+        else:
+            diff = None
+        self.diffs.append((filename, diff))
+
+    def get_errors(self):
+        """Return the request's errors as strings."""
+        errors = []
+        for msg, args, kwds in self.errors:
+            if args:
+                msg = msg % args
+            errors.append(msg)
+        return errors
+
+
+class RefactoringServer(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+
+    MAX_TOOLS = 8 # The most fixer configurations kept warm
+    daemon_threads = True
+    timeout = 0.5 # Seconds serve() waits for a connection between checks
+
+    def __init__(self, socket_path, fixer_pkg, num_processes=1):
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _RequestHandler)
+        self.fixer_pkg = fixer_pkg
+        self.num_processes = num_processes
+        self.tools = collections.OrderedDict() # Least recently used first
+        self.stopping = False
+        self.lock = threading.Lock() # Held while handling a request
+        self.logger = logging.getLogger("RefactoringServer")
+
+    def get_tool(self, request):
+        """Return a warm ServerRefactoringTool for the request's fixers."""
+        fixer_names, explicit = main.get_fixer_names(
+            self.fixer_pkg, request.get("fix", []), request.get("nofix", []))
+        options = {"print_function" : bool(request.get("print_function"))}
+        key = (tuple(fixer_names), tuple(explicit),
+               options["print_function"])
+        tool = self.tools.pop(key, None)
+        if tool is None:
+            if len(self.tools) >= self.MAX_TOOLS:
+                old_key, old_tool = self.tools.popitem(last=False)
+                old_tool.shutdown_pool()
+            self.logger.info("Loading fixers for a new configuration")
+            tool = ServerRefactoringTool(fixer_names, options, explicit)
+            if self.num_processes > 1:
+                tool.start_pool(self.num_processes)
+        self.tools[key] = tool
+        return tool
+
+    def handle_message(self, request):
+        """Return the response to a request."""
+        with self.lock:
+            return self._handle_message(request)
+
+    def _handle_message(self, request):
+        if request.get("command") == "shutdown":
+            self.stopping = True
+            return {}
+        try:
+            tool = self.get_tool(request)
+        except Exception, err:
+            return {"error" : "%s: %s" % (err.__class__.__name__, err)}
+        tool.reset(bool(request.get("nobackups")),
+                   request.get("show_diffs", True))
+        response = {}
+        try:
+            if "source" in request:
+                sources = [(request["source"],
+                            request.get("name", "<stdin>"))]
+                response["output"] = tool.refactor_strings(sources)[0]
+            else:
+                tool.refactor(request.get("files", []),
+                              bool(request.get("write")),
+                              bool(request.get("doctests_only")))
+        except Exception, err:
+            # Don't reuse a tool (or pool) that is in an unknown state.
+            for key, value in self.tools.items():
+                if value is tool:
+                    del self.tools[key]
+            tool.shutdown_pool()
+            return {"error" : "%s: %s" % (err.__class__.__name__, err)}
+        response.update(files=tool.files, diffs=tool.diffs,
+                        messages=tool.fixer_log, errors=tool.get_errors(),
+                        wrote=tool.wrote)
+        return response
+
+    def serve(self):
+        """Handle requests until a client asks for a shutdown."""
+        while not self.stopping:
+            # Times out now and then, so that stopping is noticed.
+            self.handle_request()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        with self.lock:
+            for tool in self.tools.itervalues():
+                tool.shutdown_pool()
+            self.tools.clear()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+            except ValueError, err:
+                response = {"error" : "Bad request: %s" % (err,)}
+            else:
+                response = self.server.handle_message(request)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+            if self.server.stopping:
+                break
+
+
+def serve(socket_path, fixer_pkg, num_processes=1):
+    """Run a RefactoringServer on socket_path until it is shut down.
+
+    Returns a suggested exit status.
+    """
+    server = RefactoringServer(socket_path, fixer_pkg, num_processes)
+    server.logger.info("Serving on %s", socket_path)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
@@ -0,0 +1,146 @@
+"""
+Unit tests for distributed.py.
+"""
+
+import os
+import json
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import unittest
+
+from lib2to3 import main, distributed
+
+
+class TestDistributed(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="2to3-test_distributed")
+        self.tool = main.StdoutRefactoringTool(["lib2to3.fixes.fix_has_key"],
+                                               {}, [], True, False)
+        self.coordinator = distributed.Coordinator(("127.0.0.1", 0),
+                                                   self.tool, "secret")
+        self.coordinator.logger.setLevel(logging.WARNING)
+        self.address = self.coordinator.server_address[:2]
+        self.coordinator.start()
+        self.threads = []
+        self.done = []
+
+    def tearDown(self):
+        self.coordinator.close()
+        for thread in self.threads:
+            thread.join()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, source):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as fp:
+            fp.write(source)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name), "rb") as fp:
+            return fp.read()
+
+    def start_worker(self, before=None):
+        def run():
+            if before is not None:
+                before()
+            self.done.append(distributed.Worker(self.address,
+                                                "secret").run())
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+
+    def test_parse_address(self):
+        self.assertEqual(distributed.parse_address("example.com:80"),
+                         ("example.com", 80))
+        self.assertEqual(distributed.parse_address(":80"), ("localhost", 80))
+        self.assertEqual(distributed.parse_address("80"), ("localhost", 80))
+        self.assertRaises(ValueError, distributed.parse_address, "host")
+        self.assertRaises(ValueError, distributed.parse_address, "host:x")
+
+    def test_token(self):
+        self.write("f.py", "if d.has_key(1): pass\n")
+        def talk(*messages):
+            sock = socket.create_connection(self.address)
+            try:
+                f = sock.makefile("r+b")
+                responses = []
+                for message in messages:
+                    f.write(json.dumps(message) + "\n")
+                    f.flush()
+                    line = f.readline()
+                    if not line:
+                        break
+                    responses.append(json.loads(line))
+                return responses
+            finally:
+                sock.close()
+        responses = []
+        def intruders():
+            for hello in ({"command" : "hello"},
+                          {"command" : "hello", "token" : "guess"},
+                          {"command" : "hello", "token" : 1}):
+                responses.append(talk(hello, {"command" : "next"}))
+            responses.append(talk({"command" : "next",
+                                   "results" : [{"id" : 0,
+                                                 "output" : "evil"}]}))
+        # Then a real worker does the work.
+        self.start_worker(intruders)
+        self.coordinator.refactor([self.dir], True)
+        self.assertEqual(len(responses), 4)
+        for response in responses:
+            # An error, and the connection is closed.
+            self.assertEqual(len(response), 1)
+            self.assertTrue("error" in response[0])
+            self.assertFalse("batch" in response[0])
+        self.assertEqual(self.read("f.py"), "if 1 in d: pass\n")
+
+    def test_refactor(self):
+        for i in xrange(6):
+            self.write("f%d.py" % (i,), "if d.has_key(%d): pass\n" % (i,))
+        self.write("same.py", "x = 1\n")
+        self.write("bad.py", "x = d.has_key(\n")
+        self.start_worker()
+        self.start_worker()
+        self.coordinator.refactor([self.dir], True)
+        self.coordinator.close()
+        for thread in self.threads:
+            thread.join()
+        for i in xrange(6):
+            self.assertEqual(self.read("f%d.py" % (i,)),
+                             "if %d in d: pass\n" % (i,))
+        self.assertEqual(self.read("same.py"), "x = 1\n")
+        # same.py has no has_key, so it isn't even sent.
+        self.assertEqual(sum(self.done), 7)
+        self.assertEqual(len(self.tool.files), 6)
+        self.assertEqual(len(self.tool.errors), 1)
+        msg, args, kwds = self.tool.errors[0]
+        self.assertTrue((msg % args).startswith("Can't parse "))
+
+    def test_lost_worker(self):
+        for i in xrange(3):
+            self.write("f%d.py" % (i,), "if d.has_key(%d): pass\n" % (i,))
+        taken = []
+        def take_batch_and_leave():
+            sock = socket.create_connection(self.address)
+            try:
+                f = sock.makefile("r+b")
+                for command in ("hello", "next"):
+                    f.write(json.dumps({"command" : command,
+                                        "token" : "secret"}) + "\n")
+                    f.flush()
+                    response = json.loads(f.readline())
+                taken.extend(response["batch"])
+            finally:
+                sock.close()
+        self.start_worker(take_batch_and_leave)
+        self.coordinator.refactor([self.dir], True)
+        self.assertTrue(taken)
+        self.assertEqual(len(self.tool.files), 3)
+        for i in xrange(3):
+            self.assertEqual(self.read("f%d.py" % (i,)),
+                             "if %d in d: pass\n" % (i,))
@@ -0,0 +1,156 @@
+"""
+Unit tests for gitrepo.py.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+from lib2to3 import gitrepo, main
+
+
+class TestGitRepo(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="2to3-test_gitrepo")
+        try:
+            self.git("init", "-q")
+        except gitrepo.GitError:
+            shutil.rmtree(self.dir)
+            self.skipTest("git is not available")
+        self.git("config", "user.name", "Test")
+        self.git("config", "user.email", "test@example.com")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def git(self, *args):
+        return gitrepo.run_git(args, self.dir)
+
+    def write(self, name, source="x = 1\n"):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as fp:
+            fp.write(source)
+        return path
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_select_files(self):
+        for name in ("a.py", "b.py", "pkg/c.py", "pkg/d.py", "README",
+                     ".hidden/e.py", "gone.py"):
+            self.write(name)
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "first")
+        self.write("a.py", "x = 2\n")
+        self.write("pkg/c.py", "x = 2\n")
+        self.write("README", "x = 2\n")
+        self.write(".hidden/e.py", "x = 2\n")
+        os.remove(self.path("gone.py"))
+        self.git("add", "pkg/c.py")
+        self.write("new.py")
+        self.write("pkg/new.py")
+        self.write("ignored.py")
+        self.write(".gitignore", "ignored.py\n")
+
+        select = gitrepo.select_files
+        self.assertEqual(select([self.dir], "HEAD"),
+                         [self.path("a.py"), self.path("pkg/c.py")])
+        self.assertEqual(select([self.dir], staged=True),
+                         [self.path("pkg/c.py")])
+        self.assertEqual(select([self.dir], untracked=True),
+                         [self.path("new.py"), self.path("pkg/new.py")])
+        self.assertEqual(select([self.path("pkg")], "HEAD", untracked=True),
+                         [self.path("pkg/c.py"), self.path("pkg/new.py")])
+        # Files are taken as they are.
+        self.assertEqual(select([self.path("README"), self.path("b.py")],
+                                "HEAD"),
+                         [self.path("README")])
+        self.assertEqual(select([self.dir]), [])
+        self.assertRaises(gitrepo.GitError, select, [self.dir], "nonesuch")
+        outside = tempfile.mkdtemp(prefix="2to3-test_gitrepo")
+        try:
+            self.assertRaises(gitrepo.GitError, select, [outside], "HEAD")
+        finally:
+            shutil.rmtree(outside)
+
+    def test_refactor_commit(self):
+        self.write("a.py", "x = d.has_key(1)\n")
+        self.write("pkg/b.py", "# coding: latin-1\ns = '\xe9'\n"
+                   "x = d.has_key(2)\n")
+        self.write("c.py", "x = 1\n")
+        self.write("bad.py", "x = d.has_key(\n")
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "first")
+        # The work tree doesn't matter.
+        os.remove(self.path("a.py"))
+        self.write("c.py", "x = d.has_key(3)\n")
+
+        rt = main.StdoutRefactoringTool(["lib2to3.fixes.fix_has_key"], {},
+                                        [], True, True)
+        changed = list(gitrepo.refactor_commit(rt, "HEAD", cwd=self.dir))
+        self.assertEqual(changed, [
+                ("a.py", u"x = d.has_key(1)\n", u"x = 1 in d\n", "utf-8"),
+                ("pkg/b.py", u"# coding: latin-1\ns = '\xe9'\n"
+                 u"x = d.has_key(2)\n",
+                 u"# coding: latin-1\ns = '\xe9'\nx = 2 in d\n",
+                 "iso-8859-1")])
+        self.assertEqual(len(rt.errors), 1)
+        self.assertEqual(
+            list(gitrepo.refactor_commit(rt, "HEAD", ["pkg"], cwd=self.dir)),
+            changed[1:])
+
+        save_stdout = sys.stdout
+        sys.stdout = out = StringIO.StringIO()
+        try:
+            main.print_git_patch(rt, "HEAD", ["a.py", "pkg"], cwd=self.dir)
+        finally:
+            sys.stdout = save_stdout
+        self.git("checkout", "-q", "--", ".")
+        patch = self.write("patch.diff", out.getvalue())
+        self.git("apply", "-p0", patch)
+        with open(self.path("pkg/b.py"), "rb") as fp:
+            self.assertEqual(fp.read(), "# coding: latin-1\ns = '\xe9'\n"
+                             "x = 2 in d\n")
+        with open(self.path("a.py"), "rb") as fp:
+            self.assertEqual(fp.read(), "x = 1 in d\n")
+        self.assertEqual(rt.get_summary()[0], ["a.py", "pkg/b.py"])
+
+    def test_git_patch_bom_crlf(self):
+        self.write("bom.py", "\xef\xbb\xbfx = d.has_key(1)\ny = 1\n")
+        self.write("crlf.py", "# \xc3\xa9\r\nx = d.has_key(2)\r\n")
+        self.git("config", "core.autocrlf", "false")
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "first")
+
+        rt = main.StdoutRefactoringTool(["lib2to3.fixes.fix_has_key"], {},
+                                        [], True, True)
+        self.assertEqual(gitrepo.decode_source("x = 1\r\ny = 2\r\n"),
+                         (u"x = 1\ny = 2\n", "utf-8"))
+        self.assertEqual(
+            list(gitrepo.refactor_commit(rt, "HEAD", ["crlf.py"],
+                                         cwd=self.dir)),
+            [("crlf.py", u"# \xe9\r\nx = d.has_key(2)\r\n",
+              u"# \xe9\r\nx = 2 in d\r\n", "utf-8")])
+        save_stdout = sys.stdout
+        sys.stdout = out = StringIO.StringIO()
+        try:
+            main.print_git_patch(rt, "HEAD", cwd=self.dir)
+        finally:
+            sys.stdout = save_stdout
+        patch = out.getvalue()
+        # The byte order mark is only in the lines of bom.py.
+        self.assertEqual(patch.count("\xef\xbb\xbf"), 2)
+        self.assertTrue("\n-\xef\xbb\xbfx = d.has_key(1)\n" in patch)
+        self.assertTrue("\n+\xef\xbb\xbfx = 1 in d\n" in patch)
+        self.assertTrue("\n+x = 2 in d\r\n" in patch)
+        self.git("apply", "-p0", self.write("patch.diff", patch))
+        with open(self.path("bom.py"), "rb") as fp:
+            self.assertEqual(fp.read(), "\xef\xbb\xbfx = 1 in d\ny = 1\n")
+        with open(self.path("crlf.py"), "rb") as fp:
+            self.assertEqual(fp.read(), "# \xc3\xa9\r\nx = 2 in d\r\n")
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import sys
+import os
 import codecs
+import shutil
+import tempfile
 import logging
 import StringIO
 import unittest
@@ -39,3 +42,40 @@ class TestMain(unittest.TestCase):
         self.assertTrue("-print 'nothing'" in output)
         self.assertTrue("WARNING: couldn't encode <stdin>'s diff for "
                         "your terminal" in err.getvalue())
+
+    def test_no_fixpoint(self):
+        # The 2to3 fixers would keep changing their own output.
+        err = StringIO.StringIO()
+        self.assertRaises(SystemExit, self.run_2to3_capture,
+                          ["--fixpoint", "-"], StringIO.StringIO(),
+                          StringIO.StringIO(), err)
+        self.assertTrue("no such option: --fixpoint" in err.getvalue())
+
+    def test_merge_reports(self):
+        dir = tempfile.mkdtemp(prefix="2to3-test_main")
+        try:
+            for name in ("a", "b", "c", "d"):
+                with open(os.path.join(dir, name + ".py"), "wb") as f:
+                    f.write("d.has_key(%s)\n" % (name,))
+            reports = []
+            for i in (1, 2):
+                reports.append(os.path.join(dir, "report%d" % (i,)))
+                ret = self.run_2to3_capture(
+                    ["--shard", "%d/2" % (i,), "--report", reports[-1],
+                     dir], StringIO.StringIO(), StringIO.StringIO(),
+                    StringIO.StringIO())
+                self.assertEqual(ret, 0)
+                del logging.root.handlers[:]
+            out = StringIO.StringIO()
+            err = StringIO.StringIO()
+            ret = self.run_2to3_capture(["--merge-reports"] + reports,
+                                        StringIO.StringIO(), out, err)
+            self.assertEqual(ret, 0)
+            for name in ("a", "b", "c", "d"):
+                self.assertEqual(out.getvalue().count("+%s in d\n" % (name,)),
+                                 1)
+                filename = os.path.join(dir, name + ".py")
+                self.assertEqual(err.getvalue().count(
+                    "RefactoringTool: %s\n" % (filename,)), 1)
+        finally:
+            shutil.rmtree(dir)
@@ -16,8 +16,10 @@ import io
 import sys
 
 # Local imports
-from lib2to3.pgen2 import tokenize
+from lib2to3.pgen2 import tokenize, token
+from lib2to3.pgen2 import driver as pgen_driver
 from ..pgen2.parse import ParseError
+from lib2to3.pygram import python_symbols as syms
 
 
 class GrammarTest(support.TestCase):
@@ -213,3 +215,166 @@ def diff(fn, result, encoding):
         return os.system('diff -u "%s" @' % fn)
     finally:
         os.remove("@")
+
+
+class TestDetectFutureFeatures(support.TestCase):
+
+    def detect(self, source):
+        tokens = tokenize.generate_tokens(pgen_driver.generate_lines(source).next)
+        return pgen_driver.detect_future_features(tokens)
+
+    def test_replays_all_tokens(self):
+        source = u"'doc'\nfrom __future__ import (print_function,)\nx = 1\n"
+        expected = list(tokenize.generate_tokens(
+                pgen_driver.generate_lines(source).next))
+        features, tokens = self.detect(source)
+        self.assertEqual(features, frozenset([u"print_function"]))
+        self.assertEqual(list(tokens), expected)
+
+    def test_reads_only_the_header(self):
+        read = []
+        def tokens():
+            for tok in tokenize.generate_tokens(
+                    pgen_driver.generate_lines(u"import x\ny = 1\n").next):
+                read.append(tok)
+                yield tok
+        features, stream = pgen_driver.detect_future_features(tokens())
+        self.assertEqual(features, frozenset())
+        self.assertEqual(len(read), 1)
+        self.assertEqual(len(list(stream)), len(read))
+
+    def test_token_error_is_deferred(self):
+        features, tokens = self.detect(u"from __future__ import (a,\n")
+        self.assertEqual(features, frozenset([u"a"]))
+        self.assertRaises(tokenize.TokenError, list, tokens)
+
+
+class TestParseFragment(support.TestCase):
+
+    def test_indented_statements(self):
+        source = (u"    # comment\n    if x:\n        y = 1\n"
+                  u"        # trailing\n    z()\n")
+        tree = driver.parse_fragment(source)
+        self.assertEqual(unicode(tree), source)
+        self.assertEqual([node.type for node in tree.children],
+                         [syms.if_stmt, syms.simple_stmt, token.ENDMARKER])
+        self.assertEqual(tree.children[0].prefix, u"    # comment\n    ")
+
+    def test_unindented_statement(self):
+        source = u"for x in y:\n    pass\n"
+        tree = driver.parse_fragment(source)
+        self.assertEqual(unicode(tree), source)
+        self.assertEqual(tree.children[0].type, syms.for_stmt)
+
+
+class TestLazyBodies(support.TestCase):
+
+    source = (u"def f(x):\n"
+              u"    # comment\n"
+              u"    return g(x)\n"
+              u"\n"
+              u"class C(object):\n"
+              u"    keep = 1\n"
+              u"    def m(self): return h\n"
+              u"    def n(self):\n"
+              u"        if y:\n"
+              u"            return i\n"
+              u"        # trailing\n"
+              u"z = f(1)\n")
+
+    def parse(self, source, lazy=lambda body: u"keep" not in body):
+        tokens = tokenize.generate_tokens(
+            pgen_driver.generate_lines(source).next)
+        return driver.parse_tokens(tokens, lazy=lazy)
+
+    def unparsed(self, tree):
+        return [node for node in tree.pre_order()
+                if node.type == token.UNPARSED]
+
+    def test_bodies_left_unparsed(self):
+        tree = self.parse(self.source)
+        self.assertEqual(unicode(tree), self.source)
+        f_body, n_body = self.unparsed(tree)
+        self.assertEqual(f_body.value, u"return g(x)\n")
+        self.assertEqual(f_body.prefix, u"")
+        self.assertEqual(f_body.lineno, 3)
+        self.assertEqual(f_body.prev_sibling.prefix, u"    # comment\n")
+        # The one-line method has no body of its own.
+        self.assertEqual(n_body.value,
+                         u"if y:\n            return i\n        # trailing\n")
+        self.assertEqual(n_body.lineno, 9)
+        self.assertTrue(set([u"g", u"h", u"i", u"keep"]) <= tree.used_names)
+
+    def test_parse_body(self):
+        tree = self.parse(self.source)
+        for leaf in self.unparsed(tree):
+            indent = leaf.prev_sibling.value
+            body = driver.parse_body(leaf.value, indent, leaf.lineno)
+            self.assertEqual(unicode(body), leaf.value)
+            self.assertEqual(body.children[0].get_lineno(), leaf.lineno)
+        self.assertEqual(body.children[0].type, syms.if_stmt)
+        self.assertEqual(body.children[0].children[-1].prefix, u"")
+
+    def test_syntax_error_in_body(self):
+        source = u"def f():\n    return return\nx = 1\n"
+        leaf, = self.unparsed(self.parse(source))
+        self.assertRaises(ParseError, driver.parse_body, leaf.value,
+                          u"    ", leaf.lineno)
+        self.assertRaises(ParseError, self.parse, source, None)
+
+
+class TestErrorRecovery(support.TestCase):
+
+    def errors(self, tree):
+        return [(unicode(leaf), leaf.lineno) for leaf in tree.children
+                if leaf.type == token.ERRORTOKEN]
+
+    def test_skip_statements(self):
+        source = (u"x = 1\n"
+                  u"if x:\n"
+                  u"y = 2 2\n"
+                  u"# comment\n"
+                  u"@dec\n"
+                  u"def f(a, b c):\n"
+                  u"    pass\n"
+                  u"try:\n"
+                  u"    pass\n"
+                  u"except:\n"
+                  u"    z = $\n"
+                  u"print 4\n")
+        tree = driver.parse_string(source, recover=True)
+        self.assertEqual(unicode(tree), source)
+        self.assertEqual(self.errors(tree),
+                         [(u"if x:\n", 2), (u"y = 2 2\n", 3),
+                          (u"# comment\n@dec\ndef f(a, b c):\n    pass\n", 5),
+                          (u"try:\n    pass\nexcept:\n    z = $\n", 8)])
+        self.assertEqual(len(tree.parse_errors), 4)
+        self.assertEqual([child.type for child in tree.children],
+                         [syms.simple_stmt] + [token.ERRORTOKEN] * 4 +
+                         [syms.simple_stmt, token.ENDMARKER])
+        self.assertRaises(ParseError, driver.parse_string, source)
+
+    def test_tokenizer_errors(self):
+        # The tokenizer can't go on, so the rest is left as it is.
+        for source in (u"x = 1\n# comment\ny = f(\nz = 2\n",
+                       u'x = 1\n# comment\ny = """\nz = 2\n',
+                       u"x = 1\n# comment\nif y:\n    z\n  w\n"):
+            tree = driver.parse_string(source, recover=True)
+            self.assertEqual(unicode(tree), source)
+            self.assertEqual(self.errors(tree), [(source[6:], 3)])
+            self.assertEqual(tree.children[1].prefix, u"# comment\n")
+            error, = tree.parse_errors
+            self.assertTrue(isinstance(error, (tokenize.TokenError,
+                                               IndentationError)))
+
+    def test_no_errors(self):
+        source = u"def f():\n    return 1\n"
+        tree = driver.parse_string(source, recover=True)
+        self.assertEqual(tree.parse_errors, [])
+        self.assertEqual(tree, driver.parse_string(source))
+
+    def test_parse_body(self):
+        body = u"x = 1 1\n    y = 2\n"
+        tree = driver.parse_body(body, u"    ", 2, recover=True)
+        self.assertEqual(unicode(tree), body)
+        self.assertEqual(self.errors(tree), [(u"x = 1 1\n", 2)])
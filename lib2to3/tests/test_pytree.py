@@ -185,6 +185,10 @@ class TestNodes(support.TestCase):
         n1 = pytree.Node(1000, [l1, l2])
         self.assertEqual(list(n1.pre_order()), [n1, l1, l2])
 
+        l3 = pytree.Leaf(100, "fooey")
+        n2 = pytree.Node(1000, [n1, l3])
+        self.assertEqual(list(n2.pre_order()), [n2, n1, l1, l2, l3])
+
     def test_changed(self):
         l1 = pytree.Leaf(100, "f")
         self.assertFalse(l1.was_changed)
@@ -348,6 +352,37 @@ class TestNodes(support.TestCase):
         self.assertEqual(l1.prev_sibling, None)
         self.assertEqual(p1.prev_sibling, None)
 
+    def test_dump_tree(self):
+        source = (u"# comment\nclass C(object):\n    def f(self, x):\n"
+                  u"        return x ** 2  # square\n\nprint 'caf\xe9'\n")
+        tree = support.parse_string(source)
+        tree.future_features = set(["division"])
+        new = pytree.load_tree(pytree.dump_tree(tree))
+        self.assertEqual(new, tree)
+        self.assertEqual(unicode(new), unicode(tree))
+        self.assertEqual(new.used_names, tree.used_names)
+        self.assertEqual(new.future_features, set(["division"]))
+        self.assertEqual(new.parent, None)
+        old_leaves = [n for n in tree.pre_order() if not n.children]
+        new_leaves = [n for n in new.pre_order() if not n.children]
+        self.assertEqual([(l.prefix, l.lineno, l.column) for l in new_leaves],
+                         [(l.prefix, l.lineno, l.column) for l in old_leaves])
+        for node in new.pre_order():
+            for child in node.children:
+                self.assertTrue(child.parent is node)
+        self.assertFalse(new.was_changed)
+
+        # The new tree is as good as any.
+        string, = [l for l in new_leaves if l.value == u"'caf\xe9'"]
+        string.replace(pytree.Leaf(3, u"'tea'", prefix=u" "))
+        self.assertTrue(new.was_changed)
+        self.assertEqual(unicode(new), unicode(tree).replace(u"'caf\xe9'",
+                                                             u"'tea'"))
+
+        data = pytree.dump_tree(tree)
+        for bad in ("", "junk", data[:-5], data[:-5] + "\0" * 5):
+            self.assertRaises(ValueError, pytree.load_tree, bad)
+
 
 class TestPatterns(support.TestCase):
 
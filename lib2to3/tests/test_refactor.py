@@ -5,14 +5,18 @@ Unit tests for refactor.py.
 import sys
 import os
 import codecs
+import logging
+import json
 import operator
 import StringIO
 import tempfile
 import shutil
+import signal
 import unittest
 import warnings
 
-from lib2to3 import refactor, pygram, fixer_base
+from lib2to3 import refactor, pygram, pytree, fixer_base
+from lib2to3.fixer_util import Leaf, Name
 from lib2to3.pgen2 import token
 
 from . import support
@@ -29,6 +33,8 @@ finally:
 
 _2TO3_FIXERS = refactor.get_fixers_from_package("lib2to3.fixes")
 
+syms = pygram.python_symbols
+
 class TestRefactoringTool(unittest.TestCase):
 
     def setUp(self):
@@ -264,6 +270,500 @@ from __future__ import print_function"""
         out = rt.refactor_docstring(doc, "<test>")
         self.assertNotEqual(out, doc)
 
+    def test_multiprocess_results(self):
+        try:
+            import multiprocessing
+        except ImportError:
+            self.skipTest("multiprocessing is not available")
+
+        class MyRT(refactor.MultiprocessRefactoringTool):
+            def log_error(self, msg, *args, **kwds):
+                self.errors.append((msg, args, kwds))
+            def print_output(self, old_text, new_text, filename, equal):
+                printed.append(filename)
+
+        printed = []
+        sources = {"changed.py" : "if d.has_key(k): pass\n",
+                   "warning.py" : "raise 'spam'\n",
+                   "error.py" : "x = (\n"}
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            for name, source in sources.iteritems():
+                with open(os.path.join(dir, name), "wb") as fp:
+                    fp.write(source)
+            rt = MyRT(_2TO3_FIXERS)
+            rt.refactor([dir], write=True, num_processes=2)
+            with open(os.path.join(dir, "changed.py"), "rb") as fp:
+                self.assertEqual(fp.read(), "if k in d: pass\n")
+        finally:
+            shutil.rmtree(dir)
+        changed = os.path.join(dir, "changed.py")
+        self.assertEqual(rt.files, [changed])
+        self.assertEqual(printed, [changed])
+        self.assertTrue(rt.wrote)
+        self.assertEqual(len(rt.fixer_log), 3)
+        self.assertTrue(rt.fixer_log[0].endswith("warning.py ###"))
+        self.assertEqual(len(rt.errors), 1)
+        msg, args, kwds = rt.errors[0]
+        self.assertTrue((msg % args).startswith("Can't parse "))
+        self.assertEqual(sorted(rt.timings),
+                         sorted(os.path.join(dir, name) for name in sources))
+
+    def test_split_module(self):
+        source = (u"# A module\n"
+                  u"import os\n"
+                  u"x = (1,\n"
+                  u"     2)\n"
+                  u"@decorator\n"
+                  u"\n"
+                  u"def f():\n"
+                  u"    pass\n"
+                  u"if x:\n"
+                  u"    pass\n"
+                  u"# Goes with the else\n"
+                  u"else:\n"
+                  u"    pass\n"
+                  u"try: pass\n"
+                  u"except E: pass\n"
+                  u"finally: pass\n"
+                  u"\n"
+                  u"# Goes with y\n"
+                  u"y = 1; z = 2")
+        chunks = refactor._split_module(source, 0)
+        self.assertEqual([lineno for lineno, text in chunks],
+                         [1, 3, 5, 9, 14, 17])
+        self.assertEqual(u"".join(text for lineno, text in chunks), source)
+        self.assertEqual(chunks[-1], (17, u"\n# Goes with y\ny = 1; z = 2"))
+        chunks = refactor._split_module(source, 40)
+        self.assertEqual([lineno for lineno, text in chunks], [1, 9, 14])
+        self.assertEqual(refactor._split_module(u"x = (\n", 0), None)
+
+    def test_iter_chunks(self):
+        source = [u'"""Docstring"""\n',
+                  u"from __future__ import print_function\n",
+                  u"from os import path\n",
+                  u"x = 1\n",
+                  u"y = 2\n",
+                  u"z = 3\n"]
+        read = []
+        def lines():
+            for line in source:
+                read.append(line)
+                yield line
+        chunks = refactor._iter_chunks(lines(), 0)
+        # The header stays together, and the rest is read as needed.
+        self.assertEqual(next(chunks), (1, u"".join(source[:3])))
+        self.assertEqual(len(read), 4)
+        self.assertEqual(list(chunks),
+                         [(4, u"x = 1\n"), (5, u"y = 2\n"), (6, u"z = 3\n")])
+
+        # With recover, what can't be tokenized is the last chunk.
+        source[4:] = [u"y = (\n", u"z = 3\n"]
+        self.assertRaises(refactor.tokenize.TokenError, list,
+                          refactor._iter_chunks(source, 0))
+        self.assertEqual(list(refactor._iter_chunks(source, 0, True))[1:],
+                         [(4, u"x = 1\n"), (5, u"y = (\nz = 3\n")])
+
+    def test_refactor_stream(self):
+        class MyRT(refactor.MultiprocessRefactoringTool):
+            STREAM_CHUNK_SIZE = 1
+            def log_error(self, msg, *args, **kwds):
+                self.errors.append((msg, args, kwds))
+            def print_chunk_output(self, old_text, new_text, filename,
+                                   old_lineno, new_lineno, first):
+                printed.append((old_text, new_text, old_lineno, new_lineno,
+                                first))
+
+        source = ("from __future__ import print_function\n"
+                  "print(d.has_key(1), file=f)\n"
+                  "x = 1\n"
+                  "y = 2\n"
+                  "z = 3\n"
+                  "if d.has_key(2):\n"
+                  "    pass\n"
+                  "w = 4\n"
+                  "v = 5\n"
+                  "u = 6\n"
+                  "t = 7\n"
+                  "s = 8\n"
+                  "r = 9\n"
+                  "q = 10\n"
+                  "p = 11\n"
+                  "o = d.has_key(3)\n")
+        expected = source.replace("d.has_key(1)", "1 in d").replace(
+            "d.has_key(2)", "2 in d").replace("d.has_key(3)", "3 in d")
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            for name in ("a.py", "b.py", "c.py"):
+                with open(os.path.join(dir, name), "wb") as fp:
+                    fp.write(source)
+            with open(os.path.join(dir, "next.py"), "wb") as fp:
+                fp.write(source + "it.next()\n")
+            with open(os.path.join(dir, "bad.py"), "wb") as fp:
+                fp.write(source + "x = d.has_key(\n")
+            printed = []
+            rt = MyRT(_2TO3_FIXERS, {"stream_size" : 0})
+            filename = os.path.join(dir, "a.py")
+            self.assertTrue(rt.refactor_stream(filename, True))
+            with open(filename, "rb") as fp:
+                self.assertEqual(fp.read(), expected)
+            self.assertEqual(rt.files, [filename])
+            self.assertTrue(rt.wrote)
+
+            # Changes close together make one region, with context.
+            self.assertEqual(len(printed), 2)
+            lines = source.splitlines(True)
+            new_lines = expected.splitlines(True)
+            self.assertEqual(printed[0], ("".join(lines[:10]),
+                                          "".join(new_lines[:10]), 1, 1,
+                                          True))
+            self.assertEqual(printed[1], ("".join(lines[12:]),
+                                          "".join(new_lines[12:]), 13, 13,
+                                          False))
+
+            # fix_next needs the whole tree.
+            self.assertFalse(rt.refactor_stream(os.path.join(dir, "next.py")))
+            self.assertTrue(rt.refactor_stream(os.path.join(dir, "bad.py"),
+                                               True))
+            with open(os.path.join(dir, "bad.py"), "rb") as fp:
+                self.assertEqual(fp.read(), source + "x = d.has_key(\n")
+            self.assertEqual(rt.files, [filename])
+            self.assertEqual(len(rt.errors), 1)
+
+            # Workers stream files too, but leave the printing to the parent.
+            del printed[:]
+            rt = MyRT(_2TO3_FIXERS, {"stream_size" : 0})
+            rt.refactor([os.path.join(dir, name) for name in ("b.py", "c.py")],
+                        True, num_processes=2)
+            self.assertEqual(printed, [printed[0], printed[1]] * 2)
+            self.assertEqual([region[-1] for region in printed[:2]],
+                             [True, False])
+            for name in ("b.py", "c.py"):
+                with open(os.path.join(dir, name), "rb") as fp:
+                    self.assertEqual(fp.read(), expected)
+            self.assertEqual(sorted(rt.files),
+                             [os.path.join(dir, "b.py"),
+                              os.path.join(dir, "c.py")])
+            self.assertTrue(rt.wrote)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_needs_whole_tree(self):
+        def needs_whole_tree(name):
+            name, fixer = refactor._get_fixer_class("lib2to3.fixes.fix_" +
+                                                    name)
+            return refactor.needs_whole_tree(fixer({}, []))
+        self.assertFalse(needs_whole_tree("has_key"))
+        self.assertFalse(needs_whole_tree("ne"))
+        self.assertTrue(needs_whole_tree("next")) # start_tree()
+        self.assertTrue(needs_whole_tree("filter")) # ConditionalFix
+        self.assertTrue(needs_whole_tree("reduce")) # touch_import()
+
+    def test_split_files(self):
+        try:
+            import multiprocessing
+        except ImportError:
+            self.skipTest("multiprocessing is not available")
+
+        class MyRT(refactor.MultiprocessRefactoringTool):
+            def log_error(self, msg, *args, **kwds):
+                self.errors.append((msg, args, kwds))
+
+        statements = ["if d.has_key(%d):\n    pass\n" % (i,)
+                      for i in xrange(20)]
+        sources = {"split.py" : "".join(statements),
+                   "whole.py" : "".join(statements) + "x = it.next()\n",
+                   "error.py" : "".join(statements) + "x = d.has_key(k) +\n"}
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            for name, source in sources.iteritems():
+                with open(os.path.join(dir, name), "wb") as fp:
+                    fp.write(source)
+            rt = MyRT(_2TO3_FIXERS, {"split_size" : 100})
+            tasks = rt.collect_tasks([dir], True)
+            self.assertEqual(
+                [len(rt.split_file(2, *args, **kwargs) or [])
+                 for args, kwargs in tasks], [4, 4, 0])
+            rt._splits.clear()
+            rt.refactor([dir], write=True, num_processes=2)
+            expected = "".join("if %d in d:\n    pass\n" % (i,)
+                               for i in xrange(20))
+            with open(os.path.join(dir, "split.py"), "rb") as fp:
+                self.assertEqual(fp.read(), expected)
+            with open(os.path.join(dir, "whole.py"), "rb") as fp:
+                self.assertEqual(fp.read(), expected + "x = next(it)\n")
+            with open(os.path.join(dir, "error.py"), "rb") as fp:
+                self.assertEqual(fp.read(), sources["error.py"])
+        finally:
+            shutil.rmtree(dir)
+        self.assertEqual(len(rt.errors), 1)
+        msg, args, kwds = rt.errors[0]
+        self.assertTrue((msg % args).startswith("Can't parse "))
+        self.assertTrue("(41, " in msg % args, msg % args)
+        self.assertEqual(sorted(rt.timings),
+                         sorted(os.path.join(dir, name) for name in sources))
+
+    def test_worker_pool(self):
+        try:
+            import multiprocessing
+        except ImportError:
+            self.skipTest("multiprocessing is not available")
+        rt = refactor.MultiprocessRefactoringTool(_2TO3_FIXERS)
+        sources = [(u"if d.has_key(k): pass\n", "<a>"),
+                   (u"x = (\n", "<b>"),
+                   (u"x <> y\n", "<c>")]
+        expected = [u"if k in d: pass\n", None, u"x != y\n"]
+        rt.log_error = lambda msg, *args: rt.errors.append((msg, args, {}))
+        self.assertEqual(rt.refactor_strings(sources), expected)
+        self.assertEqual(len(rt.errors), 1)
+
+        pool = rt.start_pool(2)
+        try:
+            self.assertRaises(RuntimeError, rt.start_pool, 2)
+            pids = [p.pid for p in pool.processes]
+            for i in range(2):
+                self.assertEqual(rt.refactor_strings(sources), expected)
+            self.assertEqual(len(rt.errors), 3)
+            dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+            try:
+                with open(os.path.join(dir, "a.py"), "wb") as fp:
+                    fp.write("x <> y\n")
+                rt.refactor([dir], write=True)
+                with open(os.path.join(dir, "a.py"), "rb") as fp:
+                    self.assertEqual(fp.read(), "x != y\n")
+            finally:
+                shutil.rmtree(dir)
+            # A failing callback cancels the rest of a run, not the pool.
+            done = []
+            def handle_result(key, result):
+                done.append(key)
+                raise ValueError("bad result")
+            tasks = [(i, "refactor_string", source, {})
+                     for i, source in enumerate(sources * 20)]
+            self.assertRaises(ValueError, pool.run, [tasks], handle_result)
+            self.assertEqual(len(done), 1)
+            self.assertFalse(pool.closed)
+            self.assertEqual(pool.pending, {})
+            self.assertEqual(rt.refactor_strings(sources), expected)
+            # The same workers did all of it.
+            self.assertEqual([p.pid for p in pool.processes], pids)
+            self.assertTrue(all(p.is_alive() for p in pool.processes))
+        finally:
+            rt.shutdown_pool()
+        self.assertTrue(pool.closed)
+        self.assertFalse(any(p.is_alive() for p in pool.processes))
+        self.assertRaises(RuntimeError, pool.run, [], None)
+
+    def test_worker_time_limit(self):
+        try:
+            import multiprocessing
+        except ImportError:
+            self.skipTest("multiprocessing is not available")
+
+        class SlowFix(fixer_base.BaseFix):
+            PATTERN = "'slow' | 'stuck'"
+            def transform(self, node, results):
+                if node.value == u"stuck":
+                    # Defeat the worker's own timer.
+                    signal.signal(signal.SIGALRM, signal.SIG_IGN)
+                while True:
+                    pass
+
+        class MyRT(refactor.MultiprocessRefactoringTool):
+            def log_error(self, msg, *args, **kwds):
+                self.errors.append((msg, args, kwds))
+
+        rt = MyRT(["lib2to3.fixes.fix_ne"], {"time_limit" : 0.2})
+        rt.post_order.append(SlowFix(rt.options, rt.fixer_log))
+        sources = [(u"x <> 1\n", "<a>"), (u"y = slow\n", "<b>"),
+                   (u"x <> 2\n", "<c>"), (u"z = stuck\n", "<d>"),
+                   (u"x <> 3\n", "<e>")]
+        save_grace = refactor.WorkerPool.WATCHDOG_GRACE
+        refactor.WorkerPool.WATCHDOG_GRACE = 0.5
+        try:
+            pool = rt.start_pool(1)
+            pid = pool.processes[0].pid
+            new_texts = rt.refactor_strings(sources)
+        finally:
+            refactor.WorkerPool.WATCHDOG_GRACE = save_grace
+            rt.shutdown_pool()
+        self.assertEqual(new_texts, [u"x != 1\n", None, u"x != 2\n", None,
+                                     u"x != 3\n"])
+        errors = sorted(msg % args for msg, args, kwds in rt.errors)
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith("A worker was killed after "))
+        self.assertTrue(errors[0].endswith(" seconds while refactoring <d>"))
+        self.assertEqual(errors[1],
+                         "Time limit of 0.2 seconds exceeded refactoring <b> "
+                         "(in SlowFix on a NAME node at line 1)")
+        # Both times the worker was replaced.
+        self.assertNotEqual(pool.processes[0].pid, pid)
+
+    def test_time_limit_where(self):
+        class RemoveFix(fixer_base.BaseFix):
+            PATTERN = "'gone'"
+            def transform(self, node, results):
+                node.remove()
+
+        class MyRT(refactor.RefactoringTool):
+            def _has_inactive_fixers(self):
+                return True
+            def _activate_in_tree(self, text):
+                # As if the alarm went off here, after node was removed.
+                try:
+                    refactor._on_time_limit(signal.SIGALRM, sys._getframe())
+                except refactor._TimeLimitExceeded, err:
+                    raised.append(str(err))
+
+        raised = []
+        rt = MyRT([])
+        rt.post_order.append(RemoveFix(rt.options, rt.fixer_log))
+        rt.post_order_heads = refactor._get_headnode_dict(rt.post_order)
+        rt.refactor_string(u"x = [gone, 1]\n", "<test>")
+        self.assertEqual(raised, [" (in RemoveFix)"])
+        self.assertRaises(refactor._TimeLimitExceeded,
+                          refactor._on_time_limit, signal.SIGALRM,
+                          sys._getframe())
+
+    def test_worker_recycling(self):
+        try:
+            import multiprocessing
+        except ImportError:
+            self.skipTest("multiprocessing is not available")
+        rt = refactor.MultiprocessRefactoringTool(["lib2to3.fixes.fix_ne"],
+                                                  {"max_worker_tasks" : 2})
+        sources = [(u"x <> %d\n" % i, "<%d>" % i) for i in range(5)]
+        pool = rt.start_pool(1)
+        try:
+            pid = pool.processes[0].pid
+            self.assertEqual(rt.refactor_strings(sources),
+                             [u"x != %d\n" % i for i in range(5)])
+            self.assertNotEqual(pool.processes[0].pid, pid)
+        finally:
+            rt.shutdown_pool()
+        self.assertEqual(rt.errors, [])
+
+    def test_spool_summary(self):
+        messages = []
+
+        class MyRT(refactor.MultiprocessRefactoringTool):
+            def log_error(self, msg, *args, **kwds):
+                self.errors.append((msg, args, kwds))
+            def print_output(self, old_text, new_text, filename, equal):
+                pass
+            def log_message(self, msg, *args):
+                messages.append(msg % args)
+
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            files = []
+            for name, source in (("a.py", "x <> y\n"),
+                                 ("b.py", "raise 'spam'\n"),
+                                 ("c.py", "x <> (\n")):
+                files.append(os.path.join(dir, name))
+                with open(files[-1], "wb") as fp:
+                    fp.write(source)
+            rt = MyRT(["lib2to3.fixes.fix_ne", "lib2to3.fixes.fix_raise"],
+                      {"spool_summary" : True})
+            rt.refactor(files)
+        finally:
+            shutil.rmtree(dir)
+        # Nothing is kept in memory, not even the timings.
+        self.assertEqual((rt.files, rt.fixer_log, rt.errors, rt.timings),
+                         ([], [], [], {}))
+        self.assertTrue(rt.has_errors())
+        rt.summarize()
+        self.assertEqual(messages[:2],
+                         ["Files that need to be modified:", files[0]])
+        self.assertEqual(messages[2], "Warnings/messages while refactoring:")
+        self.assertEqual(messages[-2], "There was 1 error:")
+        self.assertTrue(messages[-1].startswith("Can't parse " + files[2]))
+
+    def test_fixer_logger(self):
+        rt = self.rt()
+        rt.refactor_string(u"x = 1\n", "<no logger for me>")
+        self.assertFalse("<no logger for me>" in
+                         logging.Logger.manager.loggerDict)
+
+    def test_shard(self):
+        self.assertEqual(refactor.Shard.parse("2/3"),
+                         refactor.Shard(2, 3, "hash"))
+        self.assertEqual(str(refactor.Shard(2, 3, "size")), "2/3")
+        for spec in ("0/3", "4/3", "1/0", "1", "a/b"):
+            self.assertRaises(ValueError, refactor.Shard.parse, spec)
+        self.assertRaises(ValueError, refactor.Shard, 1, 2, "name")
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            filenames = []
+            for i, size in enumerate([50, 40, 30, 20, 10, 10, 10, 10]):
+                filename = os.path.join(dir, "f%d.py" % (i,))
+                with open(filename, "wb") as f:
+                    f.write("x" * size)
+                filenames.append(filename)
+            for by in refactor.Shard.METHODS:
+                shards = [refactor.Shard(i, 3, by).select(filenames)
+                          for i in (1, 2, 3)]
+                self.assertEqual(sorted(sum(shards, [])), filenames)
+                for shard in shards:
+                    self.assertEqual(shard, sorted(shard))
+                self.assertEqual(refactor.Shard(2, 3, by).select(filenames),
+                                 shards[1])
+            totals = [sum(os.path.getsize(filename) for filename in shard)
+                      for shard in shards]
+            self.assertEqual(sorted(totals), [60, 60, 60])
+
+            # Only the shard's files are refactored.
+            got = []
+            def mock_refactor_file(self, f, *args):
+                got.append(f)
+            save_func = refactor.RefactoringTool.refactor_file
+            refactor.RefactoringTool.refactor_file = mock_refactor_file
+            try:
+                self.rt().refactor([dir], shard=refactor.Shard(1, 3, "size"))
+            finally:
+                refactor.RefactoringTool.refactor_file = save_func
+            self.assertEqual(got, shards[0])
+        finally:
+            shutil.rmtree(dir)
+
+    def test_multiprocess_schedule(self):
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        timings_file = os.path.join(dir, "timings.json")
+        def path(name):
+            return os.path.join(dir, name)
+        try:
+            sizes = {"a.py" : 10, "b.py" : 1000, "c.py" : 100}
+            for i in range(5):
+                sizes["small%d.py" % i] = 1
+            for name, size in sizes.iteritems():
+                with open(path(name), "wb") as fp:
+                    fp.write("#" * size)
+            with open(timings_file, "wb") as fp:
+                fp.write('{"%s": 5.0}' % path("a.py"))
+            rt = refactor.MultiprocessRefactoringTool(
+                [], {"timings_file" : timings_file})
+            rt.load_timings()
+            # a.py took 5 seconds for 10 bytes; the others are scaled alike.
+            self.assertEqual(rt.estimate_cost(path("a.py")), 5.0)
+            self.assertEqual(rt.estimate_cost(path("b.py")), 500.0)
+            tasks = [((path(name), False, False), {})
+                     for name in sorted(sizes)]
+            batches = [[args[0] for args, kwargs in batch]
+                       for batch in rt.schedule(tasks, 2)]
+            self.assertEqual(batches[:3], [[path("b.py")], [path("c.py")],
+                                           [path("a.py")]])
+            self.assertEqual(sorted(sum(batches, [])),
+                             sorted(map(path, sizes)))
+            for batch in batches:
+                self.assertTrue(len(batch) <= rt.BATCH_SIZE)
+
+            rt.refactor([path("c.py")])
+            with open(timings_file, "rb") as fp:
+                self.assertEqual(sorted(json.load(fp)),
+                                 [path("a.py"), path("c.py")])
+        finally:
+            shutil.rmtree(dir)
+
     def test_explicit(self):
         from myfixes.fix_explicit import FixExplicit
 
@@ -276,3 +776,695 @@ from __future__ import print_function"""
                 break
         else:
             self.fail("explicit fixer not loaded")
+
+    def test_get_fixer_triggers(self):
+        class NoneFix(fixer_base.BaseFix):
+            pass
+
+        class AnyFix(fixer_base.BaseFix):
+            PATTERN = "power< any* >"
+
+        class NameFix(fixer_base.BaseFix):
+            PATTERN = "power< 'print' trailer< '.' 'has_key' > >"
+
+        class AltFix(fixer_base.BaseFix):
+            PATTERN = "'xrange' | power< 'range' any* >"
+
+        class OptionalFix(fixer_base.BaseFix):
+            PATTERN = "'xrange' | power< ['range'] any* >"
+
+        class DeclaredFix(fixer_base.BaseFix):
+            PATTERN = "print_stmt"
+            triggers = [u"print"]
+
+        run = refactor.get_fixer_triggers
+        fs = frozenset
+        self.assertEqual(run(NoneFix({}, [])), None)
+        self.assertEqual(run(AnyFix({}, [])), None)
+        self.assertEqual(run(NameFix({}, [])), fs([u"has_key"]))
+        self.assertEqual(run(AltFix({}, [])), fs([u"xrange", u"range"]))
+        self.assertEqual(run(OptionalFix({}, [])), None)
+        self.assertEqual(run(DeclaredFix({}, [])), fs([u"print"]))
+
+    def test_fixer_manifest(self):
+        # Regenerate with scripts/generate_manifest.py if this fails.
+        self.assertEqual(refactor.get_fixer_manifest("lib2to3.fixes"),
+                         refactor.build_fixer_manifest("lib2to3.fixes"))
+        self.assertEqual(refactor.get_fixer_manifest("myfixes"), {})
+
+    def test_lazy_fixers(self):
+        fixers = ["lib2to3.fixes.fix_has_key", "lib2to3.fixes.fix_ne",
+                  "lib2to3.fixes.fix_print", "lib2to3.fixes.fix_unicode"]
+        rt = self.rt({"lazy_fixers" : True}, fixers,
+                     ["lib2to3.fixes.fix_unicode"])
+        loaded = lambda: [f.__class__.__name__
+                          for f in rt.pre_order + rt.post_order]
+        # Untriggered fixers are not loaded; implicit ones are skipped.
+        self.assertEqual(loaded(), ["FixUnicode"])
+        tree = rt.refactor_string(u"x = 1 <> 2\n", "<test>")
+        self.assertEqual(unicode(tree), u"x = 1 != 2\n")
+        self.assertEqual(loaded(), ["FixNe", "FixUnicode"])
+        tree = rt.refactor_string(u"d.has_key(k)\n", "<test>")
+        self.assertEqual(unicode(tree), u"k in d\n")
+        self.assertEqual(loaded(), ["FixHasKey", "FixNe", "FixUnicode"])
+
+    def test_lazy_fixers_triggered_by_transform(self):
+        fixers = ["lib2to3.fixes.fix_idioms", "lib2to3.fixes.fix_isinstance"]
+        rt = self.rt({"lazy_fixers" : True}, fixers, True)
+        eager = self.rt(fixers=fixers, explicit=True)
+        src = u"if type(x) == (int, int):\n    pass\n"
+        self.assertEqual(unicode(rt.refactor_string(src, "<test>")),
+                         unicode(eager.refactor_string(src, "<test>")))
+        # fix_idioms introduced "isinstance", so fix_isinstance was loaded.
+        self.assertEqual([f.__class__.__name__ for f in rt.post_order],
+                         ["FixIdioms", "FixIsinstance"])
+
+    def test_find_triggers(self):
+        fixers = ["lib2to3.fixes.fix_has_key", "lib2to3.fixes.fix_ne",
+                  "lib2to3.fixes.fix_repr"]
+        rt = self.rt(fixers=fixers)
+        run = rt.find_triggers
+        self.assertEqual(run(u"x = 1\n"), set())
+        self.assertEqual(run(u"d.has_key(k) and a <> `b`\n"),
+                         set([u"has_key", u"<>", u"`"]))
+        # Only whole identifiers count.
+        self.assertEqual(run(u"d.has_keys(k)\nnot_has_key = 1\n"), set())
+        self.assertFalse(rt.could_match(u"x = 1\n"))
+        self.assertTrue(rt.could_match(u"x = 1 <> 2\n"))
+        # fix_unicode matches any STRING, so nothing can be ruled out.
+        rt = self.rt(fixers=fixers + ["lib2to3.fixes.fix_unicode"],
+                     explicit=True)
+        self.assertEqual(run(u"x = 1\n"), set())
+        self.assertEqual(rt.find_triggers(u"x = 1\n"), None)
+        self.assertTrue(rt.could_match(u"x = 1\n"))
+
+    def test_refactor_file_skips_untriggered(self):
+        class MyRT(refactor.RefactoringTool):
+            def refactor_string(self, data, name):
+                parsed.append(name)
+                return super(MyRT, self).refactor_string(data, name)
+
+        parsed = []
+        rt = MyRT(["lib2to3.fixes.fix_has_key"])
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            clean = os.path.join(dir, "clean.py")
+            dirty = os.path.join(dir, "dirty.py")
+            with open(clean, "wb") as fp:
+                fp.write("x = 'has_keys'\n")
+            with open(dirty, "wb") as fp:
+                fp.write("d.has_key(x)\n")
+            rt.refactor([clean, dirty], True)
+            with open(dirty, "rb") as fp:
+                self.assertEqual(fp.read(), "x in d\n")
+        finally:
+            shutil.rmtree(dir)
+        self.assertEqual(parsed, [dirty])
+
+    def test_get_tree_fixers(self):
+        fixers = ["lib2to3.fixes.fix_has_key", "lib2to3.fixes.fix_xrange",
+                  "lib2to3.fixes.fix_ne", "lib2to3.fixes.fix_next"]
+        rt = self.rt(fixers=fixers)
+        names = lambda fixers: [f.__class__.__name__ for f in fixers]
+        self.assertEqual(rt.get_required_names(rt.post_order[0]),
+                         frozenset([u"has_key"]))
+        # fix_ne needs "<>", which the parser does not record.
+        self.assertEqual(rt.get_required_names(rt.post_order[2]), None)
+        tree = rt.driver.parse_string(u"for i in xrange(3): pass\n")
+        pre, post = rt.get_tree_fixers(tree)
+        self.assertEqual(names(pre), [])
+        self.assertEqual(names(post), ["FixXrange", "FixNe"])
+        tree = rt.driver.parse_string(u"it.next()\nd.has_key(x)\n")
+        pre, post = rt.get_tree_fixers(tree)
+        self.assertEqual(names(pre), ["FixNext"])
+        self.assertEqual(names(post), ["FixHasKey", "FixNe"])
+
+        tree = rt.refactor_string(u"for i in xrange(3): it.next()\n", "<t>")
+        self.assertEqual(unicode(tree), u"for i in range(3): next(it)\n")
+
+    def test_tree_fixers_triggered_by_transform(self):
+        # fix_idioms introduces "isinstance", which fix_isinstance needs.
+        fixers = ["lib2to3.fixes.fix_idioms", "lib2to3.fixes.fix_isinstance"]
+        rt = self.rt(fixers=fixers, explicit=True)
+        log = []
+
+        class Recorder(object):
+            def __init__(self, fixer):
+                self.fixer = fixer
+            def __getattr__(self, name):
+                return getattr(self.fixer, name)
+            def start_tree(self, tree, name):
+                log.append(self.fixer.__class__.__name__)
+                self.fixer.start_tree(tree, name)
+
+        rt.post_order[:] = [Recorder(f) for f in rt.post_order]
+        rt.refactor_string(u"if type(x) == int:\n    pass\n", "<test>")
+        self.assertEqual(log, ["FixIdioms", "FixIsinstance"])
+        del log[:]
+        rt.refactor_string(u"x = 1\n", "<test>")
+        self.assertEqual(log, [])
+
+    def test_traverse_tree(self):
+        events = []
+
+        class PreFix(fixer_base.BaseFix):
+            order = "pre"
+            PATTERN = "power< 'f' trailer< '(' any* ')' > >"
+            def transform(self, node, results):
+                events.append(("pre", unicode(node)))
+                return pytree.Node(node.type, [ch.clone() for ch in
+                                               node.children[:1]] +
+                                   [pytree.Node(syms.trailer,
+                                                [Leaf(token.LPAR, u"("),
+                                                 Name(u"g"),
+                                                 Leaf(token.RPAR, u")")])],
+                                   prefix=node.prefix)
+
+        class PostFix(fixer_base.BaseFix):
+            PATTERN = "NAME"
+            def transform(self, node, results):
+                events.append(("post", node.value))
+
+        rt = self.rt(fixers=[])
+        pre = PreFix({}, [])
+        post = PostFix({}, [])
+        tree = support.parse_string(u"f(x)\ny\n")
+        rt.traverse_tree(tree, refactor._get_headnode_dict([pre]),
+                         refactor._get_headnode_dict([post]))
+        self.assertEqual(unicode(tree), u"f(g)\ny\n\n\n")
+        # Each node is visited once; the replacement is descended into.
+        self.assertEqual(events, [("pre", u"f(x)"), ("post", u"f"),
+                                  ("post", u"g"), ("post", u"y")])
+
+    def test_traverse_tree_node_replaced_by_fixer(self):
+        # fix_next replaces the node itself, then fix_dict is offered
+        # what took its place.
+        rt = self.rt(fixers=["lib2to3.fixes.fix_next",
+                             "lib2to3.fixes.fix_dict"])
+        tree = rt.refactor_string(u"k, v = d.iteritems().next()\n", "<test>")
+        self.assertEqual(unicode(tree), u"k, v = next(d.iteritems())\n")
+
+    def test_lazy_parsing(self):
+        source = (u"def f(d):\n"
+                  u"    return d.has_key(1)\n"
+                  u"def g(d):\n"
+                  u"    return d.get(1)\n"
+                  u"class C:\n"
+                  u"    def m(self):\n"
+                  u"        x = 1\n"
+                  u"    def n(self, d):\n"
+                  u"        return d.has_key(2)\n")
+        def unparsed(tree):
+            return [unicode(node) for node in tree.pre_order()
+                    if node.type == token.UNPARSED]
+
+        fixers = ["lib2to3.fixes.fix_has_key"]
+        rt = self.rt({"lazy_parsing" : True}, fixers)
+        tree = rt.refactor_string(source, "<test>")
+        expected = unicode(self.rt(fixers=fixers).refactor_string(source,
+                                                                  "<test>"))
+        self.assertEqual(unicode(tree), expected)
+        self.assertEqual(unparsed(tree),
+                         [u"return d.get(1)\n", u"x = 1\n"])
+
+        # Only bodies a fixer of the tree may match in are parsed.
+        tree = rt.driver.parse_string(source)
+        self.assertEqual(len(unparsed(tree)), 0)
+        tree = rt.driver.parse_tokens(
+            refactor.tokenize.generate_tokens(
+                refactor.driver.generate_lines(source).next),
+            lazy=lambda body: True)
+        rt.refactor_tree(tree, "<test>")
+        self.assertEqual(unicode(tree), expected)
+        self.assertEqual(unparsed(tree),
+                         [u"return d.get(1)\n", u"x = 1\n"])
+
+        # The fixers for a def get its body parsed.
+        fixers.append("lib2to3.fixes.fix_tuple_params")
+        tree = self.rt({"lazy_parsing" : True}, fixers).refactor_string(
+            source + u"def h((a, b)):\n    return a\n", "<test>")
+        self.assertEqual(unparsed(tree), [])
+        self.assertTrue(unicode(tree).endswith(
+                u"def h(xxx_todo_changeme):\n    (a, b) = xxx_todo_changeme\n"
+                u"    return a\n"))
+
+        # Syntax errors go unnoticed in the bodies left unparsed.
+        rt = self.rt({"lazy_parsing" : True}, fixers[:1])
+        bad = u"def f():\n    return return\n"
+        self.assertTrue(rt.refactor_string(bad + u"x.has_key(1)\n", "<test>"))
+        self.assertRaises(refactor.parse.ParseError, rt.refactor_string,
+                          bad + u"    x.has_key(1)\n", "<test>")
+
+    def test_recover(self):
+        source = (u"x = d.has_key(1)\n"
+                  u"y = d.has_key(2) 2\n"
+                  u"def f():\n"
+                  u"    return d.has_key(3)\n"
+                  u"def g():\n"
+                  u"    return return\n"
+                  u"z = d.has_key(4)\n")
+        expected = (u"x = 1 in d\n"
+                    u"y = d.has_key(2) 2\n"
+                    u"def f():\n"
+                    u"    return 3 in d\n"
+                    u"def g():\n"
+                    u"    return return\n"
+                    u"z = 4 in d\n")
+        fixers = ["lib2to3.fixes.fix_has_key"]
+        self.assertRaises(refactor.parse.ParseError,
+                          self.rt(fixers=fixers).refactor_string, source,
+                          "<test>")
+        # The body of g is left unparsed with lazy_parsing.
+        for options, n_errors in (({"recover" : True}, 2),
+                                  ({"recover" : True, "lazy_parsing" : True},
+                                   1)):
+            rt = self.rt(options, fixers)
+            tree = rt.refactor_string(source, "<test>")
+            self.assertEqual(unicode(tree), expected)
+            self.assertEqual(len(rt.fixer_log), n_errors)
+            self.assertTrue(rt.fixer_log[0].startswith(
+                    "Line 2 of <test>: could not parse: ParseError: "))
+        # A body the traversal parses is recovered from on its own.
+        body = u"def g():\n    x = d.has_key(5) 5\n    return d.has_key(6)\n"
+        tree = rt.driver.parse_tokens(
+            refactor.tokenize.generate_tokens(
+                refactor.driver.generate_lines(body).next),
+            lazy=lambda body: True)
+        rt.refactor_tree(tree, "<test>")
+        self.assertEqual(unicode(tree), body.replace(u"d.has_key(6)",
+                                                     u"6 in d"))
+        self.assertTrue(rt.fixer_log[-1].startswith("Line 2 of <test>: "))
+
+        # The rest of a file the tokenizer gives up on is left alone.
+        rt = self.rt({"recover" : True}, fixers)
+        for rest in (u"s = '\n", u"s = d.has_key(\n"):
+            self.assertEqual(rt.refactor_text(source + rest + u"\n",
+                                              "<test>"),
+                             expected + rest)
+
+    def test_edit_session(self):
+        def apply(text, fixes):
+            for start, length, new in reversed(fixes):
+                text = text[:start] + new + text[start + length:]
+            return text
+
+        class RecordingTool(refactor.RefactoringTool):
+            def log_error(self, msg, *args, **kwargs):
+                self.errors.append(msg % args)
+        rt = RecordingTool(["lib2to3.fixes.fix_has_key"], None, None)
+        rt.errors = []
+        source = (u"import os\n"
+                  u"class C:\n"
+                  u"    def f(self):\n"
+                  u"        return d.has_key(1)\n"
+                  u"\n"
+                  u"    def g(self):\n"
+                  u"        x = 1\n"
+                  u"        return x\n")
+        session = refactor.EditSession(rt, source, "<test>")
+        self.assertEqual(apply(source, session.fixes),
+                         source.replace(u"d.has_key(1)", u"1 in d"))
+
+        # Only the statement that was edited is parsed again.
+        cls = session.tree.children[1]
+        f = cls.children[-1].children[2]
+        offset = source.index(u"x = 1")
+        fixes = session.edit(offset, 5, u"x = d.has_key(x)")
+        self.assertEqual(fixes, [(offset, 17, u"x = x in d\n")])
+        self.assertTrue(session.tree.children[1] is cls)
+        self.assertTrue(cls.children[-1].children[2] is f)
+        self.assertEqual(unicode(session.tree), session.text + u"\n")
+
+        # A line inserted before g is parsed with f.
+        offset = session.text.index(u"    def g")
+        fixes = session.edit(offset, 0, u"    y = d.has_key(2)\n")
+        self.assertEqual(len(fixes), 2)
+        self.assertEqual(apply(session.text, fixes),
+                         session.text.replace(u"d.has_key(1)", u"1 in d")
+                         .replace(u"d.has_key(2)", u"2 in d"))
+        self.assertTrue(session.tree.children[1] is cls)
+        self.assertEqual(unicode(session.tree), session.text + u"\n")
+
+        # Bad indentation means parsing it all again, to no avail, and so
+        # does the edit that fixes it.
+        offset = session.text.index(u"        return x")
+        self.assertEqual(session.edit(offset, 6, u""), None)
+        self.assertEqual(len(rt.errors), 1)
+        self.assertTrue(session.tree is None)
+        fixes = session.edit(offset, 0, u"      ")
+        self.assertTrue(session.tree.children[1] is not cls)
+        self.assertEqual(unicode(session.tree), session.text + u"\n")
+        self.assertEqual(apply(session.text, fixes),
+                         session.text.replace(u"d.has_key(", u"(")
+                         .replace(u"(1)", u"1 in d")
+                         .replace(u"(2)", u"2 in d")
+                         .replace(u"(x)", u"x in d"))
+
+    def test_line_ranges(self):
+        ranges = refactor.LineRanges.parse("30,10-20,21-22,5")
+        self.assertEqual(list(ranges), [(5, 5), (10, 22), (30, 30)])
+        self.assertEqual(str(ranges), "5,10-22,30")
+        self.assertTrue(ranges.overlaps(22, 40))
+        self.assertTrue(ranges.overlaps(1, 5))
+        self.assertFalse(ranges.overlaps(23, 29))
+        self.assertFalse(ranges.overlaps(31, 50))
+        for spec in ("", "x", "3-1", "0", "1-2-3"):
+            self.assertRaises(ValueError, refactor.LineRanges.parse, spec)
+
+        source = (u"a = d.has_key(1)\n"
+                  u"class C:\n"
+                  u"    def f(self):\n"
+                  u"        b = d.has_key(2)\n"
+                  u"        c = d.has_key(\n"
+                  u"            3)\n"
+                  u"\n"
+                  u"# d.has_key(4)\n"
+                  u"e = d.has_key(5)\n")
+        def fixed(*keys):
+            text = source.replace(u"(\n            3)", u"(3)")
+            for key in keys:
+                text = text.replace(u"d.has_key(%d)" % key, u"%d in d" % key)
+            return text.replace(u"d.has_key(3)", u"d.has_key(\n            3)")
+        rt = self.rt(fixers=["lib2to3.fixes.fix_has_key"])
+        for lines, keys in (([(2, 3)], ()),
+                            ([(4, 4)], (2,)),
+                            ([(6, 6)], (3,)),
+                            ([(7, 8)], ()),
+                            ([(1, 1), (9, 9)], (1, 5)),
+                            (None, (1, 2, 3, 5))):
+            tree = rt.refactor_string(source, "<test>", lines)
+            self.assertEqual(unicode(tree), fixed(*keys))
+        rt = self.rt({"lines" : [(9, 10)]}, ["lib2to3.fixes.fix_has_key"])
+        self.assertEqual(unicode(rt.refactor_string(source, "<test>")),
+                         fixed(5))
+
+        # Streamed chunks off the lines aren't parsed.
+        class MyRT(refactor.RefactoringTool):
+            STREAM_CHUNK_SIZE = 1
+            def refactor_chunk(self, text, *args):
+                chunks.append(text)
+                return super(MyRT, self).refactor_chunk(text, *args)
+        chunks = []
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            filename = os.path.join(dir, "a.py")
+            with open(filename, "wb") as fp:
+                fp.write(source.encode("ascii"))
+            rt = MyRT(["lib2to3.fixes.fix_has_key"], {"stream_size" : 0})
+            rt.refactor_file(filename, True, lines=[(4, 4)])
+            with open(filename, "rb") as fp:
+                self.assertEqual(fp.read(), fixed(2))
+            self.assertEqual(len(chunks), 1)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_result_cache(self):
+        class MyRT(refactor.RefactoringTool):
+            def log_error(self, msg, *args, **kwds):
+                self.errors.append((msg, args, kwds))
+            def refactor_text(self, input, filename, *args):
+                refactored.append(os.path.basename(filename))
+                return super(MyRT, self).refactor_text(input, filename,
+                                                       *args)
+            def print_output(self, old, new, filename, equal):
+                printed.append((os.path.basename(filename), new))
+
+        def run(fixers=("lib2to3.fixes.fix_has_key",
+                        "lib2to3.fixes.fix_raise"), options=None):
+            del refactored[:]
+            del printed[:]
+            rt = MyRT(list(fixers), dict(options or {}, cache_dir=cache))
+            rt.refactor([dir])
+            return rt
+        refactored = []
+        printed = []
+        dir = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            cache = os.path.join(dir, "cache")
+            src = os.path.join(dir, "src")
+            os.mkdir(src)
+            for name, source in (("a.py", "x = d.has_key(1)\nraise 'a'\n"),
+                                 ("b.py", "x = 1\n"),
+                                 ("c.py", "raise E, V\n"),
+                                 ("bad.py", "x = d.has_key(\n")):
+                with open(os.path.join(src, name), "wb") as fp:
+                    fp.write(source)
+            dir = src
+            first = run()
+            self.assertEqual(refactored, ["a.py", "bad.py", "c.py"])
+            self.assertEqual(len(first.errors), 1)
+            first_printed = printed[:]
+            self.assertEqual([name for name, new in first_printed],
+                             ["a.py", "c.py"])
+
+            # Only the file with errors is refactored again.
+            second = run()
+            self.assertEqual(refactored, ["bad.py"])
+            self.assertEqual(printed, first_printed)
+            self.assertEqual(second.fixer_log, first.fixer_log)
+            self.assertEqual(len(second.errors), 1)
+
+            # Other fixers, options, lines or text mean other results.
+            run(["lib2to3.fixes.fix_has_key"])
+            self.assertEqual(refactored, ["a.py", "bad.py"])
+            # Twice for c.py, clean for fix_has_key but not fix_raise.
+            run(["lib2to3.fixes.fix_raise", "lib2to3.fixes.fix_has_key"])
+            self.assertEqual(refactored, ["a.py", "bad.py", "c.py", "c.py"])
+            run(options={"print_function" : True})
+            self.assertEqual(refactored, ["a.py", "bad.py", "c.py"])
+            run(options={"lines" : [(1, 1)]})
+            self.assertEqual(refactored, ["a.py", "bad.py", "c.py"])
+            with open(os.path.join(src, "a.py"), "ab") as fp:
+                fp.write("y = 2\n")
+            run()
+            self.assertEqual(refactored, ["a.py", "bad.py"])
+
+            # Results that can't be read are missing.
+            results = refactor.ResultCache(cache)
+            results.put("ab" * 20, {"output" : None})
+            self.assertEqual(results.get("ab" * 20), {"output" : None})
+            with open(os.path.join(cache, "ab", "ab" * 19 + ".json"),
+                      "wb") as fp:
+                fp.write("{")
+            self.assertEqual(results.get("ab" * 20), None)
+            self.assertEqual(results.get("cd" * 20), None)
+        finally:
+            shutil.rmtree(os.path.dirname(dir))
+
+    def test_cached_parse_errors(self):
+        source = u"x = = 1\ny = d.has_key(1)\n"
+        cache = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            logs = []
+            for name in ("a.py", "b.py", "a.py"):
+                rt = refactor.RefactoringTool(
+                    ["lib2to3.fixes.fix_has_key"],
+                    {"cache_dir" : cache, "recover" : True})
+                self.assertEqual(rt._refactor_input(source, name, False,
+                                                    None),
+                                 u"x = = 1\ny = 1 in d\n")
+                self.assertEqual(rt.errors, [])
+                logs.append(rt.fixer_log)
+            # The results are shared, but each names its own file.
+            self.assertEqual(len(logs[0]), 1)
+            self.assertTrue(logs[0][0].startswith("Line 1 of a.py: "),
+                            logs[0])
+            self.assertEqual(logs[1], [logs[0][0].replace("a.py", "b.py")])
+            self.assertEqual(logs[2], logs[0])
+        finally:
+            shutil.rmtree(cache)
+
+    def test_fixer_modules(self):
+        self.assertEqual(refactor._fixer_modules("lib2to3.fixes.fix_ne"),
+                         ["lib2to3.fixes.fix_ne"])
+        for name in ("imports2", "urllib"):
+            self.assertEqual(
+                refactor._fixer_modules("lib2to3.fixes.fix_" + name),
+                ["lib2to3.fixes.fix_imports", "lib2to3.fixes.fix_" + name])
+
+        # Clean records for fix_imports2 go with changes to fix_imports.
+        rt = refactor.RefactoringTool([])
+        fixer_id = rt._fixer_id("lib2to3.fixes.fix_imports2")
+        save_source = refactor._module_source
+        def module_source(name):
+            source = save_source(name)
+            if name == "lib2to3.fixes.fix_imports":
+                source += "\n# changed\n"
+            return source
+        refactor._module_source = module_source
+        try:
+            rt = refactor.RefactoringTool([])
+            self.assertNotEqual(rt._fixer_id("lib2to3.fixes.fix_imports2"),
+                                fixer_id)
+        finally:
+            refactor._module_source = save_source
+
+    def test_clean_records(self):
+        class MyRT(refactor.RefactoringTool):
+            def get_tree_fixers(self, tree):
+                pre_order, post_order = super(MyRT,
+                                              self).get_tree_fixers(tree)
+                seen.append(sorted(f.__class__.__name__
+                                   for f in pre_order + post_order))
+                return pre_order, post_order
+
+        def run(*names):
+            del seen[:]
+            rt = MyRT(["lib2to3.fixes.fix_" + name for name in names],
+                      {"cache_dir" : cache}, explicit=True)
+            results = [rt._refactor_input(source, name, False, None)
+                       for name, source in files]
+            return results, rt.fixer_log
+        seen = []
+        files = [("a.py", u"has_key = 1\ny = 1 <> 2\n"),
+                 ("b.py", u"has_key = next\n"),
+                 ("c.py", u"has_key = 1\nraise 'c'\n")]
+        cache = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            self.assertEqual(run("has_key"), ([None, None, None], []))
+            self.assertEqual(seen, [["FixHasKey"]] * 3)
+
+            # Only the new fixer runs, on the files clean for the others;
+            # all of them once it changes something.
+            results, log = run("has_key", "ne", "raise")
+            self.assertEqual(results, [u"has_key = 1\ny = 1 != 2\n",
+                                       None, None])
+            self.assertEqual(len(log), 3)
+            self.assertEqual(seen, [["FixNe"], ["FixHasKey", "FixNe"],
+                                    ["FixNe"], ["FixNe", "FixRaise"]])
+            self.assertEqual(run("has_key", "ne", "raise"), (results, log))
+            self.assertEqual(seen, [])
+
+            # Nor is c.py clean for fix_ne, as fix_raise warned about it.
+            self.assertEqual(run("has_key", "ne", "raise", "apply"),
+                             (results, log))
+            self.assertEqual(seen, [["FixNe"], ["FixHasKey", "FixNe"], [],
+                                    ["FixNe", "FixRaise"]])
+
+            # A fixer that needs the whole tree is run with all of them.
+            run("has_key", "ne", "raise", "apply", "next")
+            self.assertEqual(seen, [["FixHasKey", "FixNe"],
+                                    ["FixHasKey", "FixNe", "FixNext"],
+                                    ["FixHasKey", "FixNe", "FixRaise"]])
+        finally:
+            shutil.rmtree(cache)
+
+    def test_tree_cache(self):
+        def parse(source, options={}):
+            rt = refactor.RefactoringTool(
+                ["lib2to3.fixes.fix_has_key"],
+                dict(options, cache_dir=cache))
+            rt.log_error = lambda msg, *args: None
+            parse_tokens = rt.driver.parse_tokens
+            def counting_parse_tokens(*args, **kwds):
+                parsed.append(source)
+                return parse_tokens(*args, **kwds)
+            rt.driver.parse_tokens = counting_parse_tokens
+            return rt.refactor_string(source, "<test>")
+        parsed = []
+        cache = tempfile.mkdtemp(prefix="2to3-test_refactor")
+        try:
+            source = u"def f(d):\n    return d.has_key(1)\n"
+            tree = parse(source)
+            self.assertEqual(len(parsed), 1)
+            self.assertEqual(unicode(parse(source)), unicode(tree))
+            self.assertEqual(len(parsed), 1)
+            self.assertEqual(parse(source).used_names, tree.used_names)
+            self.assertEqual(len(parsed), 1)
+
+            # The grammar makes for other trees.
+            parse(source, {"print_function" : True})
+            self.assertEqual(len(parsed), 2)
+            parse(u"from __future__ import print_function\n" + source)
+            self.assertEqual(len(parsed), 3)
+            tree = parse(u"from __future__ import print_function\n" +
+                            source)
+            self.assertEqual(len(parsed), 3)
+            self.assertEqual(tree.future_features,
+                             set([u"print_function"]))
+
+            # Trees with errors or unparsed bodies aren't kept.
+            bad = u"x = )\ny = d.has_key(2)\n"
+            for i in range(2):
+                tree = parse(bad, {"recover" : True})
+                self.assertEqual(unicode(tree), u"x = )\ny = 2 in d\n")
+            self.assertEqual(len(parsed), 5)
+            self.assertEqual(parse(source, {"recover" : True}).parse_errors,
+                             [])
+            self.assertEqual(len(parsed), 5)
+            for i in range(2):
+                parse(u"def g():\n    pass\n", {"lazy_parsing" : True})
+            self.assertEqual(len(parsed), 7)
+        finally:
+            shutil.rmtree(cache)
+
+    def test_fixpoint(self):
+        visited = []
+
+        class RenameFix(fixer_base.BaseFix):
+            run_order = 6
+            PATTERN = "power< 'a' trailer< '(' ')' > >"
+            def transform(self, node, results):
+                name = node.children[0]
+                name.replace(Name(u"b", prefix=name.prefix))
+
+        class CallFix(fixer_base.BaseFix):
+            PATTERN = "power< 'b' trailer< '(' ')' > >"
+            def match(self, node):
+                visited.append(unicode(node).strip())
+                return super(CallFix, self).match(node)
+            def transform(self, node, results):
+                return Name(u"c", prefix=node.prefix)
+
+        def refactor_string(source, options):
+            rt = self.rt(options, fixers=[])
+            rt.post_order = [CallFix(rt.options, rt.fixer_log),
+                             RenameFix(rt.options, rt.fixer_log)]
+            return unicode(rt.refactor_string(source, "<test>"))
+
+        source = u"x = a()\nif y:\n    b()\n    z = a()\n"
+        # Without it, CallFix never sees the calls RenameFix changes.
+        self.assertEqual(refactor_string(source, None),
+                         u"x = b()\nif y:\n    c\n    z = b()\n")
+        self.assertEqual(refactor_string(source, {"fixpoint" : True}),
+                         u"x = c\nif y:\n    c\n    z = c\n")
+
+        # Only the changed statement is visited again (CallFix only starts
+        # once RenameFix has introduced a "b").
+        del visited[:]
+        refactor_string(u"a()\nd()\n", {"fixpoint" : True})
+        self.assertEqual(visited, [u"d()", u"b()"])
+
+    def test_fixpoint_nested_statement(self):
+        # The for statement's text ends with the indentation of "x = 1";
+        # parsed again without it, fix_dict sees the list() it added.
+        source = (u"class A:\n"
+                  u"    def f(self):\n"
+                  u"        for key, value in methods.items():\n"
+                  u"            pass\n"
+                  u"        x = 1\n")
+        rt = self.rt({"fixpoint" : True}, ["lib2to3.fixes.fix_dict"])
+        tree = rt.refactor_string(source, "<test>")
+        self.assertEqual(unicode(tree), source.replace(
+                u"methods.items()", u"list(methods.items())"))
+
+    def test_fixpoint_gives_up(self):
+        class GrowFix(fixer_base.BaseFix):
+            PATTERN = "power< 'f' trailer< '(' args=any* ')' > >"
+            def transform(self, node, results):
+                args = [arg.clone() for arg in results["args"]]
+                node.children[1].replace(pytree.Node(syms.trailer,
+                    [Leaf(token.LPAR, u"(")] + args +
+                    [Leaf(token.COMMA, u","), Name(u"x", prefix=u" "),
+                     Leaf(token.RPAR, u")")]))
+
+        rt = self.rt({"fixpoint" : True}, fixers=[])
+        rt.post_order = [GrowFix(rt.options, rt.fixer_log)]
+        messages = []
+        rt.log_message = lambda msg, *args: messages.append(msg % args)
+        tree = rt.refactor_string(u"f(x)\n", "<test>")
+        rounds = rt.MAX_FIXPOINT_ROUNDS
+        self.assertEqual(unicode(tree),
+                         u"f(x%s)\n" % (u", x" * (rounds + 1)))
+        self.assertEqual(messages, ["No fixed point for <test> after %d "
+                                    "rounds" % rounds])
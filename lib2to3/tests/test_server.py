@@ -0,0 +1,143 @@
+"""
+Unit tests for server.py and client.py.
+"""
+
+import os
+import sys
+import json
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import unittest
+import StringIO
+
+from lib2to3 import server, client
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="2to3-test_server")
+        self.socket = os.path.join(self.dir, "socket")
+        self.server = server.RefactoringServer(self.socket, "lib2to3.fixes")
+        self.server.logger.setLevel(logging.WARNING)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        if not self.server.stopping:
+            client.request(self.socket, {"command" : "shutdown"})
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, source):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as fp:
+            fp.write(source)
+        return path
+
+    def test_refactor_files(self):
+        path = self.write("a.py", "if d.has_key(k): pass\n")
+        bad = self.write("b.py", "x = d.has_key(\n")
+        response = client.request(self.socket, {"files" : [path, bad],
+                                                "fix" : ["has_key"]})
+        self.assertEqual(response["files"], [path])
+        [(filename, diff)] = response["diffs"]
+        self.assertEqual(filename, path)
+        self.assertTrue("+if k in d: pass" in diff)
+        self.assertEqual(len(response["errors"]), 1)
+        self.assertTrue(response["errors"][0].startswith("Can't parse "))
+        self.assertFalse(response["wrote"])
+
+        response = client.request(self.socket, {"files" : [path],
+                                                "fix" : ["has_key"],
+                                                "write" : True,
+                                                "nobackups" : True})
+        self.assertTrue(response["wrote"])
+        self.assertEqual(response["errors"], [])
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), "if k in d: pass\n")
+        # Both requests were served by the same tool.
+        self.assertEqual(len(self.server.tools), 1)
+
+    def test_refactor_source(self):
+        response = client.request(self.socket, {"source" : u"x <> y\n",
+                                                "fix" : ["ne"]})
+        self.assertEqual(response["output"], u"x != y\n")
+        response = client.request(self.socket, {"source" : u"raise 'a'\n",
+                                                "fix" : ["raise"]})
+        self.assertEqual(response["output"], u"raise 'a'\n")
+        self.assertEqual(len(response["messages"]), 3)
+        self.assertEqual(len(self.server.tools), 2)
+
+    def test_concurrent_clients(self):
+        def connect():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(10)
+            sock.connect(self.socket)
+            return sock, sock.makefile("rb")
+        def ask(sock, f, source):
+            sock.sendall(json.dumps({"source" : source, "fix" : ["ne"]}) +
+                         "\n")
+            return json.loads(f.readline())["output"]
+
+        # A client that keeps its connection open doesn't hold up others.
+        held, held_file = connect()
+        other, other_file = connect()
+        try:
+            self.assertEqual(ask(held, held_file, u"x <> 1\n"), u"x != 1\n")
+            self.assertEqual(ask(other, other_file, u"x <> 2\n"),
+                             u"x != 2\n")
+            self.assertEqual(client.request(self.socket,
+                                            {"source" : u"x <> 3\n",
+                                             "fix" : ["ne"]})["output"],
+                             u"x != 3\n")
+            self.assertEqual(ask(held, held_file, u"x <> 4\n"), u"x != 4\n")
+        finally:
+            for f in (held_file, other_file, held, other):
+                f.close()
+
+    def test_bad_request(self):
+        response = client.request(self.socket, {"fix" : ["no_such_fixer"]})
+        self.assertTrue("error" in response)
+
+    def test_client_main(self):
+        path = self.write("a.py", "x <> y\n")
+        save_stdout, save_stderr = sys.stdout, sys.stderr
+        sys.stdout = out = StringIO.StringIO()
+        sys.stderr = err = StringIO.StringIO()
+        try:
+            ret = client.main(["-s", self.socket, "-f", "ne", path])
+        finally:
+            sys.stdout, sys.stderr = save_stdout, save_stderr
+        self.assertEqual(ret, 0)
+        self.assertTrue("+x != y" in out.getvalue())
+        self.assertTrue("Files that need to be modified:" in err.getvalue())
+
+    def test_client_stdin(self):
+        save_stdin, save_stdout, save_stderr = (sys.stdin, sys.stdout,
+                                                sys.stderr)
+        sys.stdout = out = StringIO.StringIO()
+        sys.stderr = err = StringIO.StringIO()
+        try:
+            sys.stdin = StringIO.StringIO("# coding: latin-1\n"
+                                          "s = '\xe9'\nx <> y\n")
+            ret = client.main(["-s", self.socket, "-f", "ne", "-"])
+            self.assertEqual(ret, 0)
+            sys.stdin = StringIO.StringIO("# coding: utf-8\ns = '\xe9'\n")
+            bad_ret = client.main(["-s", self.socket, "-f", "ne", "-"])
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = (save_stdin, save_stdout,
+                                                 save_stderr)
+        self.assertTrue(u"+x != y" in out.getvalue())
+        self.assertEqual(bad_ret, 2)
+        self.assertTrue("Can't decode stdin: " in err.getvalue())
+
+    def test_shutdown(self):
+        self.assertEqual(client.request(self.socket,
+                                        {"command" : "shutdown"}), {})
+        self.thread.join()
+        self.assertTrue(self.server.stopping)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""Script that regenerates the fixer manifest of a fixer package.
+
+The manifest records the order, run_order, explicit flag, head types and
+trigger values of every fixer, so that RefactoringTool can decide which
+fixers a file needs without importing them (see the "lazy_fixers" option).
+It has to be regenerated whenever a fixer is added or its PATTERN, order,
+run_order, explicit flag or triggers change; test_refactor checks this.
+
+Usage:
+
+    python scripts/generate_manifest.py [fixer_pkg]
+
+fixer_pkg defaults to lib2to3.fixes.
+"""
+
+# Python imports
+import os
+import sys
+import pprint
+
+# Local imports
+from lib2to3 import refactor
+
+HEADER = '''\
+"""Manifest of the fixers in this package.
+
+Generated by scripts/generate_manifest.py; do not edit.
+"""
+
+'''
+
+
+def main(args):
+    pkg_name = args[0] if args else "lib2to3.fixes"
+    manifest = refactor.build_fixer_manifest(pkg_name)
+    pkg = __import__(pkg_name, {}, {}, ["*"])
+    filename = os.path.join(os.path.dirname(pkg.__file__), "manifest.py")
+    with open(filename, "w") as f:
+        f.write(HEADER)
+        f.write("MANIFEST = ")
+        f.write(pprint.pformat(manifest))
+        f.write("\n")
+    print "Wrote %d fixers to %s" % (len(manifest), filename)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))